@@ -0,0 +1,170 @@
+"""
+Benchmark for the downstream HTTP calls made while placing an order.
+
+It starts local stub product and user services and replays the downstream
+part of the order flow (stock reservation, user check, user update) against them.
+The "per_call" mode creates a new HTTP client for every helper call and the
+"shared" mode reuses one pooled client per service; both make the calls one
+after another. The "fan_out" mode uses shared clients and runs the stock
+reservation and the user check concurrently, like post_order does with
+ORDER_USER_CHECK=true.
+The stubs can add a fixed delay to every response to mimic slow services.
+
+Usage:
+    python bench_downstream.py --orders 2000 --concurrency 20
+    python bench_downstream.py --product-delay-ms 40 --user-delay-ms 30
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import threading
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI
+
+from models import Order
+from schemas import OrderItemRequestSchema, OrderRequestSchema
+from utils import create_client, fan_out, reserve_products, user_update, validate_user
+
+
+def build_product_stub(delay: float) -> FastAPI:
+    """Build a stub product service that always has enough stock."""
+    stub = FastAPI()
+
+    @stub.post("/product/reserve")
+    async def reserve(request: dict):
+        await asyncio.sleep(delay)
+        return [
+            {
+                "id": item["product_id"],
+                "name": f"p{item['product_id']}",
+                "price": 10,
+                "stock_left": 10**9,
+            }
+            for item in request["items"]
+        ]
+
+    return stub
+
+
+def build_user_stub(delay: float) -> FastAPI:
+    """Build a stub user service where every user exists."""
+    stub = FastAPI()
+
+    @stub.get("/user/{user_id}")
+    async def get_user(user_id: int):
+        await asyncio.sleep(delay)
+        return {"id": user_id, "name": "stub", "orders": []}
+
+    @stub.put("/user/{user_id}")
+    async def put_user(user_id: int):
+        await asyncio.sleep(delay)
+        return {"id": user_id}
+
+    return stub
+
+
+def start_server(stub: FastAPI, port: int) -> uvicorn.Server:
+    """Run a stub app with uvicorn in a background thread."""
+    server = uvicorn.Server(
+        uvicorn.Config(stub, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+async def place_order(request, urls, clients, concurrent):
+    """Run the downstream calls of one order and return its latency in ms."""
+    (product_url, user_url), (product_client, user_client) = urls, clients
+    start = time.perf_counter()
+    calls = [
+        lambda: reserve_products(request, product_url, client=product_client),
+        lambda: validate_user(request.user_id, user_url, client=user_client),
+    ]
+    if concurrent:
+        await fan_out(calls)
+    else:
+        for call in calls:
+            await call()
+    await user_update(
+        Order(id=1, user_id=request.user_id), user_url, client=user_client
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+async def run_mode(mode: str, args) -> dict:
+    """Place all orders in the given mode and summarise the latencies."""
+    product_url = f"http://127.0.0.1:{args.product_port}/product"
+    user_url = f"http://127.0.0.1:{args.user_port}/user"
+    request = OrderRequestSchema(
+        user_id=1,
+        items=[
+            OrderItemRequestSchema(product_id=i, number=1)
+            for i in range(1, args.items + 1)
+        ],
+    )
+    semaphore = asyncio.Semaphore(args.concurrency)
+    product_client, user_client = create_client("product"), create_client("user")
+
+    async def one_order():
+        async with semaphore:
+            if mode != "per_call":
+                return await place_order(
+                    request,
+                    (product_url, user_url),
+                    (product_client, user_client),
+                    concurrent=mode == "fan_out",
+                )
+            async with httpx.AsyncClient() as per_product, httpx.AsyncClient() as per_user:
+                return await place_order(
+                    request, (product_url, user_url), (per_product, per_user), False
+                )
+
+    start = time.perf_counter()
+    latencies = sorted(await asyncio.gather(*(one_order() for _ in range(args.orders))))
+    elapsed = time.perf_counter() - start
+    await product_client.aclose()
+    await user_client.aclose()
+    return {
+        "mode": mode,
+        "orders": args.orders,
+        "orders_per_sec": round(args.orders / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+    }
+
+
+def main():
+    """Parse arguments, start the stubs and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--items", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--product-port", type=int, default=18001)
+    parser.add_argument("--user-port", type=int, default=18002)
+    parser.add_argument("--product-delay-ms", type=float, default=0)
+    parser.add_argument("--user-delay-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    servers = [
+        start_server(
+            build_product_stub(args.product_delay_ms / 1000), args.product_port
+        ),
+        start_server(build_user_stub(args.user_delay_ms / 1000), args.user_port),
+    ]
+    results = [
+        asyncio.run(run_mode(mode, args)) for mode in ("per_call", "shared", "fan_out")
+    ]
+    for server in servers:
+        server.should_exit = True
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark for saving orders with their items.
+
+It compares the old per-item persistence (add, commit and refresh for every
+order item) with save_order, which flushes the order once, inserts all items
+with one multi-row INSERT ... RETURNING and commits once. Rows written by the
+benchmark use a negative user ID and are deleted afterwards.
+
+Usage:
+    ENV=local python bench_order_insert.py --orders 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import models
+from database import Async_Order_Session, Order_Session, get_engine
+from migrate import migrate
+from schemas import OrderItemRequestSchema, OrderRequestSchema
+from utils import generate_order, save_order
+
+BENCH_USER_ID = -1
+
+
+def build_order(num_items: int):
+    """Build the reserved products and the request for an order of num_items items."""
+    products = [
+        {"id": i, "price": 10, "order_number": 2, "item_total": 20}
+        for i in range(1, num_items + 1)
+    ]
+    request = OrderRequestSchema(
+        user_id=BENCH_USER_ID,
+        items=[OrderItemRequestSchema(product_id=p["id"], number=2) for p in products],
+    )
+    return products, request
+
+
+async def save_order_per_item(db, products, request):
+    """Save an order the old way, with one commit per item."""
+    order = generate_order(products, request)
+    db.add(order)
+    await db.commit()
+    await db.refresh(order)
+    for product in products:
+        item = models.OrderItem(
+            order_id=order.id,
+            product_id=product["id"],
+            product_num=product["order_number"],
+            price=product["price"],
+            item_total=product["item_total"],
+        )
+        db.add(item)
+        await db.commit()
+        await db.refresh(item)
+    return order
+
+
+async def run(save, num_items: int, num_orders: int) -> float:
+    """Save num_orders orders with the given function and return orders per second."""
+    products, request = build_order(num_items)
+    async with Async_Order_Session() as db:
+        start = time.perf_counter()
+        for _ in range(num_orders):
+            await save(db, products, request)
+        return num_orders / (time.perf_counter() - start)
+
+
+def cleanup():
+    """Delete every order, item and outbox event written by the benchmark."""
+    db = Order_Session()
+    try:
+        orders = db.query(models.Order).filter(models.Order.user_id == BENCH_USER_ID)
+        order_ids = orders.with_entities(models.Order.id).scalar_subquery()
+        db.query(models.OrderItem).filter(
+            models.OrderItem.order_id.in_(order_ids)
+        ).delete(synchronize_session=False)
+        orders.delete(synchronize_session=False)
+        db.query(models.OutboxEvent).filter(
+            models.OutboxEvent.partition_key == BENCH_USER_ID
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_all(num_orders: int) -> list:
+    """Run both persistence paths for 1, 10 and 100-item orders."""
+    results = []
+    for num_items in (1, 10, 100):
+        for mode, save in (("per_item", save_order_per_item), ("bulk", save_order)):
+            orders_per_sec = await run(save, num_items, num_orders)
+            results.append(
+                {
+                    "mode": mode,
+                    "items_per_order": num_items,
+                    "orders_per_sec": round(orders_per_sec, 1),
+                    "items_per_sec": round(orders_per_sec * num_items, 1),
+                }
+            )
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=200)
+    args = parser.parse_args()
+
+    migrate(get_engine())
+    try:
+        results = asyncio.run(run_all(args.orders))
+    finally:
+        cleanup()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark for looking up an order's items with and without the order_id index.
+
+It seeds a scratch schema with orders and their items (1M items by default),
+then calls get_items_by_id for random orders, first without the
+(order_id, id) index on order_items and again after creating it. The scratch
+schema is dropped afterwards, so the service tables are never touched.
+
+Usage:
+    ENV=local python bench_order_items_index.py --items 1000000 --lookups 200
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+import models
+from database import dispose_engines, get_async_engine, get_engine
+from main import get_items_by_id
+
+BENCH_SCHEMA = "bench_order_items"
+ITEMS_PER_ORDER = 10
+ITEM_INDEXES = models.OrderItem.__table__.indexes
+
+
+def seed(num_items: int) -> int:
+    """Create the scratch tables without the order_id index and fill them."""
+    num_orders = num_items // ITEMS_PER_ORDER
+    with get_engine().begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {BENCH_SCHEMA}"))
+        scratch = connection.execution_options(
+            schema_translate_map={None: BENCH_SCHEMA}
+        )
+        models.Base.metadata.create_all(scratch)
+        for index in ITEM_INDEXES:
+            index.drop(scratch)
+        connection.execute(
+            text(
+                f"INSERT INTO {BENCH_SCHEMA}.orders (user_id, order_total) "
+                "SELECT o % 1000, 100 FROM generate_series(1, :orders) AS o"
+            ),
+            {"orders": num_orders},
+        )
+        connection.execute(
+            text(
+                f"INSERT INTO {BENCH_SCHEMA}.order_items "
+                "(order_id, product_id, product_num, price, item_total) "
+                "SELECT o, i, 1, 10, 10 FROM generate_series(1, :orders) AS o, "
+                "generate_series(1, :per_order) AS i"
+            ),
+            {"orders": num_orders, "per_order": ITEMS_PER_ORDER},
+        )
+    analyze()
+    return num_orders
+
+
+def analyze():
+    """Refresh planner statistics for the scratch tables."""
+    with get_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"ANALYZE {BENCH_SCHEMA}.orders, {BENCH_SCHEMA}.order_items"))
+
+
+def create_index():
+    """Create the order_items indexes in the scratch schema."""
+    with get_engine().begin() as connection:
+        scratch = connection.execution_options(
+            schema_translate_map={None: BENCH_SCHEMA}
+        )
+        for index in ITEM_INDEXES:
+            index.create(scratch)
+    analyze()
+
+
+async def time_lookups(order_ids, label: str) -> dict:
+    """Call get_items_by_id for every order ID and summarise the latencies."""
+    session = sessionmaker(
+        get_async_engine().execution_options(schema_translate_map={None: BENCH_SCHEMA}),
+        class_=AsyncSession,
+        expire_on_commit=False,
+    )
+    latencies = []
+    async with session() as db:
+        for order_id in order_ids:
+            start = time.perf_counter()
+            await get_items_by_id(order_id, db)
+            latencies.append((time.perf_counter() - start) * 1000)
+            db.expunge_all()
+    latencies.sort()
+    return {
+        "index": label,
+        "lookups": len(latencies),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)], 3),
+    }
+
+
+async def run_all(num_orders: int, lookups: int) -> list:
+    """Time the lookups before and after creating the index."""
+    order_ids = [random.randint(1, num_orders) for _ in range(lookups)]
+    before = await time_lookups(order_ids, "none")
+    create_index()
+    after = await time_lookups(order_ids, "order_id")
+    await dispose_engines()
+    return [before, after]
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    try:
+        num_orders = seed(args.items)
+        results = asyncio.run(run_all(num_orders, args.lookups))
+    finally:
+        with get_engine().begin() as connection:
+            connection.execute(text(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE"))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
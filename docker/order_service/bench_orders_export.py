@@ -0,0 +1,144 @@
+"""
+Benchmark for exporting orders with GET /orders/export against reading them
+one at a time with GET /order/{id} and GET /order/items/{id}.
+
+It seeds orders with ITEMS_PER_ORDER items each for a bench user, then reads a
+sample of them one at a time through httpx's ASGI transport and exports a
+tenth of them and all of them by iterating the export response body, so peak
+memory can be compared between the two export sizes. Orders written by the
+benchmark are deleted afterwards.
+
+Usage:
+    ENV=local python bench_orders_export.py --orders 200000 --single 2000
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+
+import httpx
+from sqlalchemy import text
+
+from database import dispose_engines, get_engine
+from main import app, get_orders_export
+
+BENCH_USER_ID = -1
+ITEMS_PER_ORDER = 3
+
+
+def seed(num_orders: int) -> tuple:
+    """Insert the bench orders and their items and return their ID range."""
+    with get_engine().begin() as connection:
+        order_ids = connection.execute(
+            text(
+                "INSERT INTO orders (user_id, order_total) "
+                "SELECT :user_id, o FROM generate_series(1, :orders) AS o "
+                "RETURNING id"
+            ),
+            {"user_id": BENCH_USER_ID, "orders": num_orders},
+        ).scalars()
+        order_ids = sorted(order_ids)
+        connection.execute(
+            text(
+                "INSERT INTO order_items "
+                "(order_id, product_id, product_num, price, item_total) "
+                "SELECT o, i, 1, 10, 10 FROM generate_series(:first, :last) AS o, "
+                "generate_series(1, :per_order) AS i"
+            ),
+            {
+                "first": order_ids[0],
+                "last": order_ids[-1],
+                "per_order": ITEMS_PER_ORDER,
+            },
+        )
+    return order_ids[0], order_ids[-1]
+
+
+def cleanup(first: int, last: int):
+    """Delete the bench orders and their items."""
+    with get_engine().begin() as connection:
+        bounds = {"first": first, "last": last}
+        connection.execute(
+            text("DELETE FROM order_items WHERE order_id BETWEEN :first AND :last"),
+            bounds,
+        )
+        connection.execute(
+            text("DELETE FROM orders WHERE id BETWEEN :first AND :last"), bounds
+        )
+
+
+def max_rss_mb() -> float:
+    """Return the peak resident set size of this process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_single(first: int, orders: int) -> dict:
+    """Read orders and their items with two requests per order."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        start = time.perf_counter()
+        for order_id in range(first, first + orders):
+            (await client.get(f"/order/{order_id}")).raise_for_status()
+            (await client.get(f"/order/items/{order_id}")).raise_for_status()
+        seconds = time.perf_counter() - start
+    return {
+        "mode": "single",
+        "orders": orders,
+        "seconds": round(seconds, 3),
+        "orders_per_sec": round(orders / seconds, 1),
+    }
+
+
+async def run_export(first: int, last: int, export_format: str) -> dict:
+    """Export the orders in the ID range and count the bytes produced."""
+    start = time.perf_counter()
+    response = await get_orders_export(
+        export_format=export_format, min_id=first, max_id=last, since=None, until=None
+    )
+    size = 0
+    async for chunk in response.body_iterator:
+        size += len(chunk)
+    seconds = time.perf_counter() - start
+    orders = last - first + 1
+    return {
+        "mode": f"export_{export_format}",
+        "orders": orders,
+        "megabytes": round(size / 2**20, 1),
+        "seconds": round(seconds, 3),
+        "orders_per_sec": round(orders / seconds, 1),
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+
+
+async def run_all(first: int, last: int, single: int) -> list:
+    """Run the single mode and exports of a tenth and all of the bench orders."""
+    results = [await run_single(first, single)]
+    tenth = first + (last - first + 1) // 10 - 1
+    for export_format in ("ndjson", "csv"):
+        results.append(await run_export(first, tenth, export_format))
+        results.append(await run_export(first, last, export_format))
+    await dispose_engines()
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--single", type=int, default=2000)
+    args = parser.parse_args()
+
+    first, last = seed(args.orders)
+    try:
+        results = asyncio.run(run_all(first, last, min(args.single, args.orders)))
+    finally:
+        cleanup(first, last)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
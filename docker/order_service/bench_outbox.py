@@ -0,0 +1,142 @@
+"""
+Benchmark for POST /order latency and outbox delivery throughput.
+
+It sends orders to the order service app in process, through httpx's ASGI
+transport, with local stand-ins for the product and user services. The
+stand-in user service takes --user-delay seconds to add an order to a user,
+which the order response no longer waits for. The outbox is then drained
+with dispatch_batch against the same stand-in to measure deliveries per
+second. Orders and events written by the benchmark are deleted afterwards.
+
+Usage:
+    ENV=local python bench_outbox.py --orders 1000 --users 100 --user-delay 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+from sqlalchemy import delete, select
+
+import main
+import models
+from database import Async_Order_Session, dispose_engines
+from main import app, get_product_client, get_user_client, lifespan, outbox_handlers
+from outbox import dispatch_batch
+
+
+def stand_in_clients(user_delay: float) -> tuple:
+    """Build clients answering for the product and user services."""
+
+    async def product_handler(request: httpx.Request):
+        body = json.loads(request.content)
+        products = [
+            {"id": item["product_id"], "name": "Bench", "price": 5, "stock_left": 9}
+            for item in body.get("items", [])
+        ]
+        return httpx.Response(200, json=products)
+
+    async def user_handler(request: httpx.Request):
+        if request.method == "PUT":
+            await asyncio.sleep(user_delay)
+        return httpx.Response(200, json={"id": 1, "name": "Bench", "orders": []})
+
+    return (
+        httpx.AsyncClient(transport=httpx.MockTransport(product_handler)),
+        httpx.AsyncClient(transport=httpx.MockTransport(user_handler)),
+    )
+
+
+async def post_orders(num_orders: int, num_users: int) -> list:
+    """Post the orders one after another and return their latencies in ms."""
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for i in range(num_orders):
+            body = {
+                "user_id": -(1 + i % num_users),
+                "items": [{"product_id": 1, "number": 1}],
+            }
+            start = time.perf_counter()
+            (await client.post("/order", json=body)).raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+    return sorted(latencies)
+
+
+async def drain(handlers: dict) -> int:
+    """Dispatch outbox events until none are due and return how many were sent."""
+    total = 0
+    while claimed := await dispatch_batch(Async_Order_Session, handlers):
+        total += claimed
+    return total
+
+
+async def cleanup(num_users: int):
+    """Delete the bench orders, their items and any undelivered events."""
+    async with Async_Order_Session() as db:
+        bench_orders = select(models.Order.id).where(
+            models.Order.user_id.between(-num_users, -1)
+        )
+        await db.execute(
+            delete(models.OrderItem)
+            .where(models.OrderItem.order_id.in_(bench_orders))
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            delete(models.Order)
+            .where(models.Order.user_id.between(-num_users, -1))
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            delete(models.OutboxEvent)
+            .where(models.OutboxEvent.partition_key.between(-num_users, -1))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+async def run(num_orders: int, num_users: int, user_delay: float) -> dict:
+    """Post the orders, then drain their outbox events."""
+    main.OUTBOX_DISPATCHER = False
+    product_client, user_client = stand_in_clients(user_delay)
+    app.dependency_overrides[get_product_client] = lambda: product_client
+    app.dependency_overrides[get_user_client] = lambda: user_client
+    try:
+        async with lifespan(app):
+            latencies = await post_orders(num_orders, num_users)
+            start = time.perf_counter()
+            delivered = await drain(outbox_handlers(user_client, product_client))
+            drain_seconds = time.perf_counter() - start
+    finally:
+        await cleanup(num_users)
+        await dispose_engines()
+    return {
+        "orders": num_orders,
+        "users": num_users,
+        "user_delay_ms": user_delay * 1000,
+        "post_p50_ms": round(statistics.median(latencies), 2),
+        "post_p99_ms": round(latencies[max(int(len(latencies) * 0.99) - 1, 0)], 2),
+        "delivered": delivered,
+        "drain_seconds": round(drain_seconds, 3),
+        "deliveries_per_sec": round(delivered / drain_seconds, 1),
+    }
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--user-delay", type=float, default=0.05)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(run(args.orders, args.users, args.user_delay))
+    print(json.dumps(result, indent=2))
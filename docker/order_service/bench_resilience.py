@@ -0,0 +1,100 @@
+"""
+Benchmark for stock reservations while the product service hangs.
+
+It starts a stub product service that answers after --product-delay-ms and
+sends reservations to it at a fixed rate for a fixed duration, first with a
+plain pooled client and then with the resilient client from create_client.
+The plain client keeps every call waiting for the full HTTP timeout, so
+waiting calls pile up; the resilient client times out at the reservation
+timeout, opens the circuit breaker and then fails the rest at once. It reports
+the peak number of calls in flight, latencies and the outcomes.
+
+Usage:
+    python bench_resilience.py --rate 100 --duration 10 --product-delay-ms 30000
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+
+import httpx
+from fastapi import HTTPException
+
+from bench_downstream import build_product_stub, start_server
+from schemas import OrderItemRequestSchema, OrderRequestSchema
+from utils import HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT, create_client, reserve_products
+
+
+def plain_client() -> httpx.AsyncClient:
+    """Build a pooled client without the resilience layer."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100),
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+async def run_mode(mode: str, args) -> dict:
+    """Send reservations at the given rate and summarise what happened."""
+    client = create_client("product") if mode == "resilient" else plain_client()
+    product_url = f"http://127.0.0.1:{args.product_port}/product"
+    request = OrderRequestSchema(
+        user_id=1, items=[OrderItemRequestSchema(product_id=1, number=1)]
+    )
+    in_flight = peak = 0
+    latencies, outcomes = [], Counter()
+
+    async def reserve():
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        start = time.perf_counter()
+        try:
+            await reserve_products(request, product_url, client=client)
+            outcomes["ok"] += 1
+        except HTTPException as e:
+            outcomes[str(e.status_code)] += 1
+        latencies.append((time.perf_counter() - start) * 1000)
+        in_flight -= 1
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(int(args.rate * args.duration)):
+        await asyncio.sleep(max(0.0, start + i / args.rate - time.perf_counter()))
+        tasks.append(asyncio.create_task(reserve()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await client.aclose()
+    latencies.sort()
+    return {
+        "mode": mode,
+        "requests": len(latencies),
+        "peak_in_flight": peak,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1], 2),
+        "outcomes": dict(outcomes),
+        "seconds": round(elapsed, 2),
+    }
+
+
+def main():
+    """Parse arguments, start the stub and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rate", type=float, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--product-port", type=int, default=18003)
+    parser.add_argument("--product-delay-ms", type=float, default=30000)
+    args = parser.parse_args()
+
+    server = start_server(
+        build_product_stub(args.product_delay_ms / 1000), args.product_port
+    )
+    results = [asyncio.run(run_mode(mode, args)) for mode in ("plain", "resilient")]
+    server.should_exit = True
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark for serializing a list of order items.
+
+It builds ROWS OrderItem model instances in memory and returns them from a
+one-route FastAPI app driven directly through ASGI, in three ways: the
+route's response_model with the default JSONResponse, which validates and
+encodes every object through FastAPI, the same with ORJSONResponse, and the
+prebuilt ORDER_ITEM_LIST_ADAPTER through adapter_response, which the list
+routes use. It also times the adapter on its own. Timings are noisy on shared
+machines, so the fastest of several rounds is used.
+
+Usage:
+    python bench_serialization.py --rows 10000 --rounds 7
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from bench_metrics import SCOPE as METRICS_SCOPE, receive, send
+from models import OrderItem
+from schemas import ORDER_ITEM_LIST_ADAPTER, OrderItemSchema
+from serialization import adapter_response, orjson_available
+
+SCOPE = {**METRICS_SCOPE, "path": "/items", "raw_path": b"/items"}
+
+
+def build_rows(rows: int) -> list:
+    """Build order item model instances like those a query returns."""
+    return [
+        OrderItem(
+            id=i,
+            order_id=i // 3,
+            product_id=i % 100,
+            product_num=2,
+            price=9.99,
+            item_total=19.98,
+        )
+        for i in range(rows)
+    ]
+
+
+def build_app(mode: str, items: list) -> FastAPI:
+    """Build a one-route app returning the items in the given way."""
+    if mode == "response_model":
+        bench_app = FastAPI(default_response_class=JSONResponse)
+    else:
+        bench_app = FastAPI(default_response_class=ORJSONResponse)
+
+    @bench_app.get("/items", response_model=list[OrderItemSchema])
+    async def get_items():
+        if mode == "adapter":
+            return adapter_response(ORDER_ITEM_LIST_ADAPTER, items)
+        return items
+
+    return bench_app
+
+
+async def time_requests(asgi_app, requests: int) -> float:
+    """Send the requests one after another and return milliseconds per request."""
+    start = time.perf_counter()
+    for _ in range(requests):
+        await asgi_app(dict(SCOPE), receive, send)
+    return (time.perf_counter() - start) / requests * 1000
+
+
+def time_adapter(items: list, requests: int) -> float:
+    """Return milliseconds per validate and dump of the items with the adapter."""
+    start = time.perf_counter()
+    for _ in range(requests):
+        ORDER_ITEM_LIST_ADAPTER.dump_json(
+            ORDER_ITEM_LIST_ADAPTER.validate_python(items, from_attributes=True)
+        )
+    return (time.perf_counter() - start) / requests * 1000
+
+
+async def run(rows: int, requests: int, rounds: int) -> list:
+    """Time every mode over several rounds and keep the fastest round of each."""
+    items = build_rows(rows)
+    modes = ["response_model", "adapter"]
+    if orjson_available():
+        modes.insert(1, "response_model_orjson")
+    timings = {}
+    for mode in modes:
+        bench_app = build_app(mode, items)
+        await time_requests(bench_app, 1)
+        round_ms = []
+        for _ in range(rounds):
+            round_ms.append(await time_requests(bench_app, requests))
+        timings[mode] = min(round_ms)
+    timings["adapter_only"] = min(time_adapter(items, requests) for _ in range(rounds))
+    baseline = timings["response_model"]
+    return [
+        {
+            "mode": mode,
+            "rows": rows,
+            "ms_per_request": round(ms, 2),
+            "speedup": round(baseline / ms, 1),
+        }
+        for mode, ms in timings.items()
+    ]
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=7)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.rows, args.requests, args.rounds))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark for the time from starting a process to serving its first request.
+
+Every run starts a fresh Python process that imports main, runs the app's
+lifespan and sends GET /readyz through httpx's ASGI transport, and the wall
+time until that first response is measured from the parent, so interpreter
+start-up is included. Three ways of starting are compared against a database
+that is already migrated: create_all repeats the schema checks the service
+used to run at import (create_all and a checkfirst for every index),
+migrate_on_startup runs the migrations first, as MIGRATE_ON_STARTUP=true
+does, and lazy is the default, which does no schema work. The schema step is
+timed on its own and its statements are counted, since on a remote database
+each of them costs a network round trip. The median of several runs is
+reported.
+
+Usage:
+    ENV=local python bench_startup.py --runs 9
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from sqlalchemy import event
+
+import models
+from database import get_engine
+from migrate import migrate
+
+MODES = ("create_all", "migrate_on_startup", "lazy")
+
+
+async def first_request(app, lifespan) -> int:
+    """Start the app and return the status of its first GET /readyz."""
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            return (await client.get("/readyz")).status_code
+
+
+def child(mode: str):
+    """Start the service the given way and print the timings as JSON."""
+    start = time.perf_counter()
+    service = importlib.import_module("main")
+    imported = time.perf_counter()
+
+    statements = []
+    event.listen(
+        get_engine(),
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    schema_start = time.perf_counter()
+    if mode == "create_all":
+        models.Base.metadata.create_all(get_engine())
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(get_engine(), checkfirst=True)
+    elif mode == "migrate_on_startup":
+        migrate(get_engine())
+    schema_done = time.perf_counter()
+
+    status = asyncio.run(first_request(service.app, service.lifespan))
+    print(
+        json.dumps(
+            {
+                "import_ms": (imported - start) * 1000,
+                "schema_ms": (schema_done - schema_start) * 1000,
+                "schema_statements": len(statements),
+                "first_request_ms": (time.perf_counter() - schema_done) * 1000,
+                "status": status,
+            }
+        )
+    )
+
+
+def start_child(mode: str) -> dict:
+    """Run one child process and return its timings, with the wall time."""
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", mode],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    timing = json.loads(output.splitlines()[-1])
+    assert timing["status"] == 200, timing
+    timing["wall_ms"] = (time.perf_counter() - start) * 1000
+    return timing
+
+
+def summarise(mode: str, timings: list) -> dict:
+    """Return the median of every timing of a mode."""
+    result = {"mode": mode, "runs": len(timings)}
+    for key in ("wall_ms", "import_ms", "schema_ms", "first_request_ms"):
+        result[key] = round(statistics.median(t[key] for t in timings), 1)
+    result["schema_statements"] = timings[0]["schema_statements"]
+    return result
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=9)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    migrate(get_engine())
+    timings = {mode: [] for mode in MODES}
+    # Modes take turns, so drift on the machine affects them alike
+    for _ in range(args.runs):
+        for mode in MODES:
+            timings[mode].append(start_child(mode))
+    print(json.dumps([summarise(mode, timings[mode]) for mode in MODES], indent=2))
+
+
+if __name__ == "__main__":
+    main()
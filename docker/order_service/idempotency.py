@@ -0,0 +1,232 @@
+# idempotency.py
+"""
+This module contains the Idempotency-Key handling for POST /order.
+The first request with a key claims it by inserting a row; retries with the same
+key get the stored response back without any downstream calls, and duplicates
+that arrive while the first request is still running wait for it to finish.
+A claim is a lease: if its request has not stored a response after
+IDEMPOTENCY_LEASE seconds, for instance because the pod died, the key can be
+claimed again. The claim time fences off the earlier holder, whose writes to
+the key no longer match. Keys expire after IDEMPOTENCY_TTL seconds and are
+deleted in batches.
+"""
+
+import os
+import asyncio
+import hashlib
+from datetime import timedelta
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import clean_up_forever, delete_in_batches
+from models import IdempotencyKey
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", "60"))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "10"))
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.05"))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.getenv("IDEMPOTENCY_CLEANUP_INTERVAL", "300"))
+IDEMPOTENCY_CLEANUP_BATCH = int(os.getenv("IDEMPOTENCY_CLEANUP_BATCH", "1000"))
+
+
+def request_fingerprint(request: BaseModel) -> str:
+    """Return the SHA-256 of the request body, used to detect a reused key."""
+    return hashlib.sha256(request.model_dump_json().encode()).hexdigest()
+
+
+def expired():
+    """SQL condition matching keys older than the TTL."""
+    return IdempotencyKey.created_at < func.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+
+
+def lease_expired():
+    """SQL condition matching keys still in progress after the lease."""
+    return IdempotencyKey.status_code.is_(None) & (
+        IdempotencyKey.claimed_at < func.now() - timedelta(seconds=IDEMPOTENCY_LEASE)
+    )
+
+
+def held(key: str, claimed_at):
+    """SQL condition matching a key only while this claim still holds it."""
+    return (IdempotencyKey.key == key) & (IdempotencyKey.claimed_at == claimed_at)
+
+
+async def claim_key(db: AsyncSession, key: str, fingerprint: str):
+    """
+    Claims an idempotency key for this request.
+
+    The key is inserted, or taken over if the existing row has expired or its
+    lease has run out, in one statement, so of several concurrent requests
+    exactly one claims it.
+
+    Args:
+        db (AsyncSession): The database session.
+        key (str): The Idempotency-Key header value.
+        fingerprint (str): The request fingerprint.
+
+    Returns:
+        datetime | None: The claim time, which the later writes to the key
+        must match, or None if the key is held by another request.
+    """
+    statement = (
+        insert(IdempotencyKey)
+        .values(key=key, request_hash=fingerprint)
+        .on_conflict_do_update(
+            index_elements=[IdempotencyKey.key],
+            set_={
+                "request_hash": fingerprint,
+                "status_code": None,
+                "response_body": None,
+                "created_at": func.now(),
+                "claimed_at": func.now(),
+            },
+            where=expired() | lease_expired(),
+        )
+        .returning(IdempotencyKey.claimed_at)
+    )
+    claimed_at = (await db.execute(statement)).scalar()
+    await db.commit()
+    return claimed_at
+
+
+async def wait_for_key(
+    db: AsyncSession,
+    key: str,
+    fingerprint: str,
+    timeout: float = IDEMPOTENCY_WAIT_TIMEOUT,
+):
+    """
+    Waits for the request holding a key to store its response.
+
+    Args:
+        db (AsyncSession): The database session.
+        key (str): The Idempotency-Key header value.
+        fingerprint (str): The request fingerprint.
+        timeout (float): Seconds to wait before giving up.
+
+    Returns:
+        IdempotencyKey | None: The finished row, or None if the key was released
+        or its lease ran out, and it can be claimed again.
+
+    Raises:
+        HTTPException: 422 if the key was used for a different request,
+        409 if the first request is still running after the timeout.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        result = await db.execute(
+            select(IdempotencyKey, lease_expired())
+            .where(IdempotencyKey.key == key)
+            .execution_options(populate_existing=True)
+        )
+        row, lapsed = result.first() or (None, True)
+        await db.commit()
+        if row is None:
+            return None
+        if row.request_hash != fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was already used for a different request",
+            )
+        if row.status_code is not None:
+            return row
+        if lapsed:
+            return None
+        if asyncio.get_running_loop().time() > deadline:
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this Idempotency-Key is still in progress",
+            )
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+async def store_response(
+    db: AsyncSession, key: str, claimed_at, status_code: int, body
+) -> bool:
+    """
+    Stores the response of the request holding a key, without committing, so
+    it can be stored in the transaction that saves the order.
+
+    Args:
+        db (AsyncSession): The database session.
+        key (str): The Idempotency-Key header value.
+        claimed_at (datetime): The claim time returned by claim_key.
+        status_code (int): The response status code.
+        body: The JSON response body.
+
+    Returns:
+        bool: False if the claim was lost to another request after its lease.
+    """
+    result = await db.execute(
+        update(IdempotencyKey)
+        .where(held(key, claimed_at))
+        .values(status_code=status_code, response_body=body)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+async def complete_key(db: AsyncSession, key: str, claimed_at, status_code: int, body):
+    """
+    Stores the response of the request holding a key and commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        key (str): The Idempotency-Key header value.
+        claimed_at (datetime): The claim time returned by claim_key.
+        status_code (int): The response status code.
+        body: The JSON response body.
+    """
+    await store_response(db, key, claimed_at, status_code, body)
+    await db.commit()
+
+
+async def release_key(db: AsyncSession, key: str, claimed_at):
+    """
+    Deletes a claimed key so the request can be retried.
+
+    Args:
+        db (AsyncSession): The database session.
+        key (str): The Idempotency-Key header value.
+        claimed_at (datetime): The claim time returned by claim_key.
+    """
+    await db.execute(
+        delete(IdempotencyKey)
+        .where(held(key, claimed_at))
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+
+
+async def purge_expired_keys(session_factory, batch: int = IDEMPOTENCY_CLEANUP_BATCH):
+    """
+    Deletes expired keys in batches, one short transaction per batch.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        batch (int): Maximum number of rows deleted per transaction.
+
+    Returns:
+        int: The number of keys deleted.
+    """
+    return await delete_in_batches(
+        session_factory, IdempotencyKey.key, expired(), batch
+    )
+
+
+async def purge_expired_keys_forever(
+    session_factory, interval: float = IDEMPOTENCY_CLEANUP_INTERVAL
+):
+    """
+    Deletes expired keys every interval seconds, starting one interval after
+    startup, until cancelled.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        interval (float): Seconds between cleanups.
+    """
+    await clean_up_forever(
+        purge_expired_keys, session_factory, interval, "expired idempotency keys"
+    )
@@ -1,18 +1,57 @@
 """This module provides order-related APIs for order creation and retrieval."""
 
+import asyncio
 import logging
 import os
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Literal
 import httpx
-from sqlalchemy.orm import Session
-from fastapi import FastAPI, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 import models
-from database import engine, get_db
-from schemas import OrderRequestSchema, OrderItemSchema, OrderSchema
+from database import (
+    Async_Order_Session,
+    dispose_engines,
+    get_db,
+    get_engine,
+    init_engines,
+    pool_status,
+)
+from idempotency import (
+    claim_key,
+    complete_key,
+    purge_expired_keys_forever,
+    release_key,
+    request_fingerprint,
+    wait_for_key,
+)
+from order_export import export_orders
+from metrics import MetricsMiddleware, render_metrics
+from migrate import HEAD, MIGRATE_ON_STARTUP, current_version, migrate
+from outbox import OUTBOX_DISPATCHER, dispatch_forever, outbox_event
+from outbox import purge_dead_events_forever
+from schemas import (
+    ORDER_ITEM_LIST_ADAPTER,
+    ORDER_PAGE_ADAPTER,
+    OrderRequestSchema,
+    OrderItemSchema,
+    OrderSchema,
+    OrderPageSchema,
+)
+from serialization import adapter_response, default_response_class
 from utils import (
-    validate_product_stock,
-    generate_order,
-    generate_order_items,
-    product_update,
+    create_client,
+    fan_out,
+    list_orders,
+    validate_user,
+    reserve_products,
+    save_order,
+    release_stock,
     user_update,
 )
 
@@ -38,11 +77,84 @@ else:
     USER_SERVICE_URL = DEFAULT_USER_SERVICE_URL
     PRODUCT_SERVICE_URL = DEFAULT_PRODUCT_SERVICE_URL
 
-models.Base.metadata.create_all(engine)
+# Explicit overrides, e.g. for pointing the service at local stubs
+USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", USER_SERVICE_URL)
+PRODUCT_SERVICE_URL = os.getenv("PRODUCT_SERVICE_URL", PRODUCT_SERVICE_URL)
+
+# Check that the user exists while reserving the stock. Off by default, so
+# placing an order does not depend on the user service; an order for an
+# unknown user is caught when its outbox event is refused with a 404.
+ORDER_USER_CHECK = os.getenv("ORDER_USER_CHECK", "false").lower() == "true"
 
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+
+def outbox_handlers(
+    user_client: httpx.AsyncClient, product_client: httpx.AsyncClient
+) -> dict:
+    """Map each outbox topic to the function delivering its payload."""
+
+    async def deliver_user_order(payload: dict):
+        order = OrderSchema.model_validate(payload)
+        await user_update(order, USER_SERVICE_URL, client=user_client)
+
+    async def deliver_stock_release(payload: dict):
+        await release_stock(
+            payload["reservation_id"], PRODUCT_SERVICE_URL, client=product_client
+        )
+
+    return {"user_order": deliver_user_order, "stock_release": deliver_stock_release}
+
+
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI):
+    """
+    Create the database engines and one pooled HTTP client per downstream
+    service for the app lifetime, delete expired idempotency keys and old dead
+    outbox events, and deliver outbox events in the background.
+    """
+    init_engines()
+    if MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrate, get_engine())
+    fastapi_app.state.product_client = create_client("product")
+    # The optional user check reads users; the product calls only reserve and release
+    fastapi_app.state.user_client = create_client("user", revalidate=True)
+    fastapi_app.state.outbox_wakeup = asyncio.Event()
+    tasks = [
+        asyncio.create_task(purge_expired_keys_forever(Async_Order_Session)),
+        asyncio.create_task(purge_dead_events_forever(Async_Order_Session)),
+    ]
+    if OUTBOX_DISPATCHER:
+        dispatcher = dispatch_forever(
+            Async_Order_Session,
+            outbox_handlers(
+                fastapi_app.state.user_client, fastapi_app.state.product_client
+            ),
+            fastapi_app.state.outbox_wakeup,
+        )
+        tasks.append(asyncio.create_task(dispatcher))
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        await fastapi_app.state.product_client.aclose()
+        await fastapi_app.state.user_client.aclose()
+        await dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=default_response_class())
+app.add_middleware(MetricsMiddleware)
+
+
+def get_product_client(http_request: Request) -> httpx.AsyncClient:
+    """Dependency returning the shared HTTP client for the product service."""
+    return http_request.app.state.product_client
+
+
+def get_user_client(http_request: Request) -> httpx.AsyncClient:
+    """Dependency returning the shared HTTP client for the user service."""
+    return http_request.app.state.user_client
 
 
 @app.get("/")
@@ -51,31 +163,196 @@ def get_index():
     return {"msg": "Order service", "url": USER_SERVICE_URL}
 
 
-@app.post("/order")
-async def post_order(request: OrderRequestSchema, db: Session = Depends(get_db)):
-    """Handles the creation of an order."""
+@app.get("/metrics")
+def get_metrics():
+    """Serve request, database and downstream call metrics in Prometheus text format."""
+    return Response(
+        render_metrics({"db_pool": pool_status()}),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/db/pool")
+def get_pool_status():
+    """Report database connection pool occupancy and checkout wait time."""
+    return pool_status()
+
+
+@app.get("/healthz")
+def get_healthz():
+    """Report that the process is up, without touching the database."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def get_readyz(db: AsyncSession = Depends(get_db)):
+    """
+    Report whether the service can take traffic.
+
+    Returns:
+        dict: The schema version, if the database answers and is migrated.
+        A 503 response otherwise.
+    """
     try:
-        # Validate product stock
-        products = await validate_product_stock(
-            request, f"{PRODUCT_SERVICE_URL}/getlist", client=httpx.AsyncClient()
+        version = await db.run_sync(current_version)
+    except (SQLAlchemyError, OSError) as e:
+        return JSONResponse(
+            {"status": "unavailable", "detail": str(e)}, status_code=503
         )
+    if version < HEAD:
+        return JSONResponse(
+            {"status": "unmigrated", "schema_version": version, "required": HEAD},
+            status_code=503,
+        )
+    return {"status": "ready", "schema_version": version}
+
+
+async def release_reservation(
+    db: AsyncSession,
+    reservation_id: str,
+    user_id: int,
+    product_client: httpx.AsyncClient,
+):
+    """
+    Give the stock of a reservation back. If the product service cannot take
+    the release now, it is queued in the outbox, which retries it until it
+    does, so the stock of an order that failed is never lost.
+    """
+    try:
+        await release_stock(reservation_id, PRODUCT_SERVICE_URL, client=product_client)
+    except HTTPException as e:
+        logging.warning(
+            "Release of reservation %s queued in the outbox: %s",
+            reservation_id,
+            e.detail,
+        )
+        db.add(
+            outbox_event("stock_release", user_id, {"reservation_id": reservation_id})
+        )
+        await db.commit()
+
+
+async def create_order(
+    request: OrderRequestSchema,
+    db: AsyncSession,
+    product_client: httpx.AsyncClient,
+    user_client: httpx.AsyncClient,
+    claim: tuple = None,
+) -> OrderSchema:
+    """
+    Reserve the stock, check the user with ORDER_USER_CHECK, and save the
+    order, storing the response for the claimed Idempotency-Key, if any, in the
+    same transaction.
+
+    The stock is reserved under a new reservation ID. If the order fails, the
+    reservation is released by that ID, also when its outcome is unknown.
+    """
+    reservation_id = uuid.uuid4().hex
+    calls = [
+        lambda: reserve_products(
+            request,
+            PRODUCT_SERVICE_URL,
+            client=product_client,
+            reservation_id=reservation_id,
+        )
+    ]
+    if ORDER_USER_CHECK:
+        # Check the user concurrently with the reservation
+        calls.append(
+            lambda: validate_user(request.user_id, USER_SERVICE_URL, client=user_client)
+        )
+    outcomes = await fan_out(calls)
+    products, reserve_error = outcomes[0]
+    user_error = outcomes[1][1] if ORDER_USER_CHECK else None
+    if reserve_error or user_error:
+        # Give the reserved stock back unless the reservation was refused; after
+        # a timeout or a server error it may have been made all the same
+        refused = (
+            isinstance(reserve_error, HTTPException)
+            and 400 <= reserve_error.status_code < 500
+        )
+        if not refused:
+            await release_reservation(
+                db, reservation_id, request.user_id, product_client
+            )
+        raise reserve_error or user_error
+
+    try:
+        # Save the order and its items in one transaction
+        return await save_order(db, products, request, claim)
+    except SQLAlchemyError as e:
+        # Give the reserved stock back if the order could not be saved
+        await db.rollback()
+        await release_reservation(db, reservation_id, request.user_id, product_client)
+        raise HTTPException(status_code=500, detail="Order could not be saved") from e
+    except HTTPException:
+        # The key was taken over, and the request holding it now places the order
+        await release_reservation(db, reservation_id, request.user_id, product_client)
+        raise
 
-        # Generate and save the order
-        order = generate_order(products, request)
-        db.add(order)
-        db.commit()
-        db.refresh(order)
 
-        # Generate and save the order items
-        items = generate_order_items(products, order)
-        for item in items:
-            db.add(item)
-            db.commit()
-            db.refresh(item)
+@app.post("/order", response_model=OrderSchema)
+async def post_order(
+    request: OrderRequestSchema,
+    db: AsyncSession = Depends(get_db),
+    product_client: httpx.AsyncClient = Depends(get_product_client),
+    user_client: httpx.AsyncClient = Depends(get_user_client),
+    idempotency_key: str = Header(None, max_length=255),
+):
+    """
+    Handles the creation of an order.
 
-        # Update the product stock and user information
-        await product_update(products, PRODUCT_SERVICE_URL, client=httpx.AsyncClient())
-        await user_update(order, USER_SERVICE_URL, client=httpx.AsyncClient())
+    With an Idempotency-Key header, the response is stored with the order, or
+    once the order is rejected, and a retry with the same key gets it back
+    without any downstream calls. A retry arriving while the first request is
+    still running waits for it, and takes the key over if the first request
+    has not finished after the lease. Server errors release the key so it can
+    be retried.
+
+    The order is added to the user through the outbox after the response, so
+    the user service being slow or down does not hold up the order.
+    """
+    try:
+        if idempotency_key is None:
+            order = await create_order(request, db, product_client, user_client)
+        else:
+            fingerprint = request_fingerprint(request)
+            claimed_at = await claim_key(db, idempotency_key, fingerprint)
+            while claimed_at is None:
+                stored = await wait_for_key(db, idempotency_key, fingerprint)
+                if stored is not None:
+                    return JSONResponse(
+                        stored.response_body,
+                        status_code=stored.status_code,
+                        headers={"Idempotent-Replayed": "true"},
+                    )
+                claimed_at = await claim_key(db, idempotency_key, fingerprint)
+            try:
+                order = await create_order(
+                    request,
+                    db,
+                    product_client,
+                    user_client,
+                    (idempotency_key, claimed_at),
+                )
+            except HTTPException as e:
+                if e.status_code >= 500:
+                    await release_key(db, idempotency_key, claimed_at)
+                else:
+                    await complete_key(
+                        db,
+                        idempotency_key,
+                        claimed_at,
+                        e.status_code,
+                        {"detail": e.detail},
+                    )
+                raise
+            except Exception:
+                await release_key(db, idempotency_key, claimed_at)
+                raise
+
+        # Have the dispatcher deliver the order's outbox events now
+        app.state.outbox_wakeup.set()
 
         return order
 
@@ -85,20 +362,70 @@ async def post_order(request: OrderRequestSchema, db: Session = Depends(get_db))
 
 
 @app.get("/order/{order_id}", response_model=OrderSchema)
-def get_order_by_id(order_id: int, db: Session = Depends(get_db)):
+async def get_order_by_id(order_id: int, db: AsyncSession = Depends(get_db)):
     """Retrieve an order by its ID."""
-    order = db.query(models.Order).filter(models.Order.id == order_id).first()
+    order = await db.get(models.Order, order_id)
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     return order
 
 
 @app.get("/order/items/{order_id}", response_model=list[OrderItemSchema])
-def get_items_by_id(order_id: int, db: Session = Depends(get_db)):
+async def get_items_by_id(order_id: int, db: AsyncSession = Depends(get_db)):
     """Retrieve order items by order ID."""
-    items = (
-        db.query(models.OrderItem).filter(models.OrderItem.order_id == order_id).all()
+    result = await db.execute(
+        select(models.OrderItem).where(models.OrderItem.order_id == order_id)
     )
+    items = result.scalars().all()
     if not items:
         raise HTTPException(status_code=404, detail="Items not found")
-    return items
+    return adapter_response(ORDER_ITEM_LIST_ADAPTER, items)
+
+
+@app.get("/orders", response_model=OrderPageSchema, response_model_exclude_unset=True)
+async def get_orders(
+    user_id: int = None,
+    after: int = None,
+    limit: int = Query(50, gt=0, le=500),
+    include: Literal["items"] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    List orders page by page, optionally for one user.
+
+    Pass the previous page's next_after as after to read the next page, and
+    include=items to get each order's items in the same response.
+    """
+    page = await list_orders(
+        db, user_id=user_id, after=after, limit=limit, include_items=include == "items"
+    )
+    return adapter_response(ORDER_PAGE_ADAPTER, page, exclude_unset=True)
+
+
+@app.get("/orders/export")
+async def get_orders_export(
+    export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    min_id: int = None,
+    max_id: int = None,
+    since: datetime = None,
+    until: datetime = None,
+):
+    """
+    Stream orders with their items for bulk consumers such as analytics jobs.
+
+    NDJSON has one order per line with its items nested; CSV has one line per
+    item. Filter by an inclusive ID range, a created_at range (since inclusive,
+    until exclusive), or both.
+    """
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_orders(
+            Async_Order_Session,
+            export_format,
+            min_id=min_id,
+            max_id=max_id,
+            since=since,
+            until=until,
+        ),
+        media_type=media_type,
+    )
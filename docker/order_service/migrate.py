@@ -0,0 +1,116 @@
+# migrate.py
+"""
+This module applies the versioned schema migrations listed in migrations.py.
+The service no longer creates or alters tables when it is imported: run this
+once per deployment (the Kubernetes manifests run it as a pre-sync Job)
+before new pods start, or set MIGRATE_ON_STARTUP=true to have the app run it
+in its lifespan, which is handy locally and with docker compose.
+
+Applied versions are recorded per service in the schema_versions table. Each
+migration runs in its own transaction under an advisory lock, so replicas or
+jobs started together apply every migration once, and a failed migration is
+rolled back and retried on the next run. The statements use IF NOT EXISTS, so
+databases created before migrations were versioned are brought up to date too.
+
+Usage:
+    ENV=local python migrate.py            # apply pending migrations
+    ENV=local python migrate.py --status   # print the current version
+"""
+
+import os
+import argparse
+import logging
+from sqlalchemy import text
+from migrations import MIGRATIONS, SERVICE
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() == "true"
+
+# The version the code expects; /readyz fails until the database has it
+HEAD = MIGRATIONS[-1][0]
+
+CREATE_SCHEMA_VERSIONS = text(
+    "CREATE TABLE IF NOT EXISTS schema_versions ("
+    "service VARCHAR NOT NULL, version INTEGER NOT NULL, "
+    "description VARCHAR NOT NULL, "
+    "applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (service, version))"
+)
+# One lock for all services, as they may share a database
+LOCK = text("SELECT pg_advisory_xact_lock(hashtext('schema_versions'))")
+RECORD = text(
+    "INSERT INTO schema_versions (service, version, description) "
+    "VALUES (:service, :version, :description)"
+)
+
+
+def current_version(connection) -> int:
+    """
+    Returns the latest migration applied to the database for this service.
+
+    Args:
+        connection: A Connection or Session.
+
+    Returns:
+        int: The version, or 0 if nothing has been applied.
+    """
+    if connection.execute(text("SELECT to_regclass('schema_versions')")).scalar():
+        return connection.execute(
+            text(
+                "SELECT coalesce(max(version), 0) FROM schema_versions "
+                "WHERE service = :service"
+            ),
+            {"service": SERVICE},
+        ).scalar()
+    return 0
+
+
+def migrate(bind, target: int = HEAD) -> list:
+    """
+    Applies every pending migration up to the target version.
+
+    Args:
+        bind (Engine): The database engine.
+        target (int): The version to migrate to.
+
+    Returns:
+        list[int]: The versions applied by this call.
+    """
+    # Most starts find the schema up to date; that needs no lock
+    with bind.connect() as connection:
+        if current_version(connection) >= target:
+            return []
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version > target:
+            break
+        with bind.begin() as connection:
+            connection.execute(LOCK)
+            connection.execute(CREATE_SCHEMA_VERSIONS)
+            if current_version(connection) >= version:
+                continue
+            logging.info("Applying %s migration %d: %s", SERVICE, version, description)
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(
+                RECORD,
+                {"service": SERVICE, "version": version, "description": description},
+            )
+        applied.append(version)
+    return applied
+
+
+if __name__ == "__main__":
+    from database import get_engine  # pylint: disable=C0415
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--target", type=int, default=HEAD)
+    parser.add_argument("--status", action="store_true")
+    args = parser.parse_args()
+    if args.status:
+        with get_engine().connect() as status_connection:
+            current = current_version(status_connection)
+        logging.info("%s schema at version %d of %d", SERVICE, current, HEAD)
+    else:
+        done = migrate(get_engine(), args.target)
+        logging.info("%s schema migrated, applied %s", SERVICE, done or "nothing")
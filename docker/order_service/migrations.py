@@ -0,0 +1,93 @@
+# migrations.py
+"""
+This module lists the schema migrations of the order service, applied in
+order by migrate.py. Add new changes as a new version at the end; never edit
+a migration that has been released, as databases that already have it will
+not run it again.
+"""
+
+SERVICE = "order"
+
+# (version, description, SQL statements run in one transaction)
+MIGRATIONS = (
+    (
+        1,
+        "create orders and order_items",
+        (
+            "CREATE TABLE IF NOT EXISTS orders ("
+            "id SERIAL PRIMARY KEY, "
+            "user_id INTEGER NOT NULL, "
+            "order_total FLOAT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS ix_orders_id ON orders (id)",
+            "CREATE TABLE IF NOT EXISTS order_items ("
+            "id SERIAL PRIMARY KEY, "
+            "order_id INTEGER NOT NULL, "
+            "product_id INTEGER NOT NULL, "
+            "product_num INTEGER NOT NULL, "
+            "price FLOAT NOT NULL, "
+            "item_total FLOAT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS ix_order_items_id ON order_items (id)",
+        ),
+    ),
+    (
+        2,
+        "index orders by user and items by order",
+        (
+            "CREATE INDEX IF NOT EXISTS ix_orders_user_id_id "
+            "ON orders (user_id, id) INCLUDE (order_total)",
+            "CREATE INDEX IF NOT EXISTS ix_order_items_order_id_id "
+            "ON order_items (order_id, id)",
+        ),
+    ),
+    (
+        3,
+        "create idempotency_keys",
+        (
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            "key VARCHAR PRIMARY KEY, "
+            "request_hash VARCHAR NOT NULL, "
+            "status_code INTEGER, "
+            "response_body JSONB, "
+            "created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())",
+            "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_created_at "
+            "ON idempotency_keys (created_at)",
+        ),
+    ),
+    (
+        4,
+        "add orders.created_at",
+        (
+            # Orders placed before the column existed get the upgrade time
+            "ALTER TABLE orders ADD COLUMN IF NOT EXISTS "
+            "created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+            "CREATE INDEX IF NOT EXISTS ix_orders_created_at ON orders (created_at)",
+        ),
+    ),
+    (
+        5,
+        "create outbox_events",
+        (
+            "CREATE TABLE IF NOT EXISTS outbox_events ("
+            "id BIGSERIAL PRIMARY KEY, "
+            "topic VARCHAR NOT NULL, "
+            "partition_key INTEGER NOT NULL, "
+            "payload JSONB NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "available_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(), "
+            "last_error VARCHAR, "
+            "dead_at TIMESTAMP WITH TIME ZONE, "
+            "created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())",
+            "CREATE INDEX IF NOT EXISTS ix_outbox_events_partition_key_id "
+            "ON outbox_events (partition_key, id) WHERE dead_at IS NULL",
+        ),
+    ),
+    (
+        6,
+        "add idempotency_keys.claimed_at for claim leases",
+        (
+            # Keys claimed before the column existed get the upgrade time
+            "ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS "
+            "claimed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()",
+        ),
+    ),
+)
@@ -3,8 +3,22 @@
 This module contains the SQLAlchemy models for the application. 
 It defines the 'Order' model with basic attributes like:
  'id', 'user_id', 'product_id', 'product_num'.
+It also defines 'IdempotencyKey', which records the outcome of POST /order
+requests sent with an Idempotency-Key header, and 'OutboxEvent', which holds
+side effects of an order until they are delivered to other services.
 """
-from sqlalchemy import Column, Integer, Float
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    Float,
+    String,
+    func,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -18,12 +32,25 @@ class Order(Base):
         id (int): Primary key for the order.
         user_id (int): ID of the user associated with the order.
         order_total (float): Total amount for the order.
+        created_at (datetime): When the order was placed.
     """
 
     __tablename__ = "orders"
+    # Covers the user's order listing, so pages are read from the index alone
+    __table_args__ = (
+        Index(
+            "ix_orders_user_id_id",
+            "user_id",
+            "id",
+            postgresql_include=["order_total"],
+        ),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
     order_total = Column(Float, nullable=False)
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), index=True
+    )
 
     def __repr__(self):
         # A string representation of the order object
@@ -44,6 +71,8 @@ class OrderItem(Base):
     """
 
     __tablename__ = "order_items"
+    # Finds an order's items without scanning every order's items
+    __table_args__ = (Index("ix_order_items_order_id_id", "order_id", "id"),)
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(Integer, nullable=False)
     product_id = Column(Integer, nullable=False)
@@ -55,3 +84,88 @@ class OrderItem(Base):
         # A string representation of the order item object
         return f"<OrderItem(order_id={self.order_id}, product_id={self.product_id}, " \
                f"product_num={self.product_num}, item_total={self.item_total})>"
+
+
+class IdempotencyKey(Base):
+    """
+    IdempotencyKey model recording a POST /order request made with an Idempotency-Key.
+
+    A row without a status code is a request still in progress; once it
+    finishes, the status code and response body are stored and replayed to
+    any retry with the same key until the row expires. A request still in
+    progress after the lease can have its key taken over.
+
+    Attributes:
+        key (str): The Idempotency-Key header value.
+        request_hash (str): SHA-256 of the request body, to reject a reused key.
+        status_code (int): Status code of the stored response, None while in progress.
+        response_body (dict): The stored JSON response.
+        created_at (datetime): When the key was claimed, used for expiry.
+        claimed_at (datetime): When the current request claimed the key, used
+            for the lease and to fence off earlier holders.
+    """
+
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    request_hash = Column(String, nullable=False)
+    status_code = Column(Integer)
+    response_body = Column(JSONB)
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), index=True
+    )
+    claimed_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    def __repr__(self):
+        # A string representation of the idempotency key object
+        return f"<IdempotencyKey(key={self.key}, status_code={self.status_code})>"
+
+
+class OutboxEvent(Base):
+    """
+    OutboxEvent model holding a side effect of an order for another service.
+
+    Events are written in the same transaction as the order and deleted once
+    delivered. Events with the same partition key are delivered one at a time
+    in ID order; an event that keeps failing is marked dead and skipped.
+
+    Attributes:
+        id (int): Primary key, also the delivery order within a partition.
+        topic (str): What to deliver, e.g. "user_order".
+        partition_key (int): Events with the same key are delivered in order.
+        payload (dict): The data to deliver.
+        attempts (int): Delivery attempts so far.
+        available_at (datetime): When the event may next be attempted.
+        last_error (str): The error of the last failed attempt.
+        dead_at (datetime): When delivery was given up, None while pending.
+        created_at (datetime): When the event was written.
+    """
+
+    __tablename__ = "outbox_events"
+    # Finds the oldest pending event of each partition
+    __table_args__ = (
+        Index(
+            "ix_outbox_events_partition_key_id",
+            "partition_key",
+            "id",
+            postgresql_where=text("dead_at IS NULL"),
+        ),
+    )
+    id = Column(BigInteger, primary_key=True)
+    topic = Column(String, nullable=False)
+    partition_key = Column(Integer, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    attempts = Column(Integer, nullable=False, server_default="0")
+    available_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+    last_error = Column(String)
+    dead_at = Column(DateTime(timezone=True))
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    def __repr__(self):
+        # A string representation of the outbox event object
+        return f"<OutboxEvent(id={self.id}, topic={self.topic})>"
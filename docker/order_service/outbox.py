@@ -0,0 +1,207 @@
+# outbox.py
+"""
+This module contains the transactional outbox for side effects of an order.
+POST /order writes an outbox event in the same transaction as the order and
+returns; a dispatcher, running in the service or as worker.py, claims pending
+events in batches and delivers them. Events are leased rather than locked while
+they are delivered, so no transaction is held open across downstream calls.
+Events with the same partition key (the user ID) are delivered one at a time in
+order, failed deliveries are retried with exponential backoff, and events that
+keep failing or are rejected outright are marked dead. Dead events are kept
+OUTBOX_DEAD_TTL seconds for inspection and then deleted in batches.
+"""
+
+import os
+import random
+import asyncio
+import logging
+from datetime import timedelta
+from fastapi import HTTPException
+from sqlalchemy import delete, func, text, update
+from database import clean_up_forever, delete_in_batches
+from models import OutboxEvent
+from metrics import Counter
+
+OUTBOX_DISPATCHER = os.getenv("OUTBOX_DISPATCHER", "true").lower() == "true"
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "30"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "0.5"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_DEAD_TTL = int(os.getenv("OUTBOX_DEAD_TTL", "604800"))
+OUTBOX_CLEANUP_INTERVAL = float(os.getenv("OUTBOX_CLEANUP_INTERVAL", "300"))
+OUTBOX_CLEANUP_BATCH = int(os.getenv("OUTBOX_CLEANUP_BATCH", "1000"))
+
+OUTBOX_EVENTS = Counter(
+    "outbox_events_total",
+    "Outbox delivery attempts, by topic and outcome.",
+    ("topic", "outcome"),
+)
+
+# Takes the oldest pending event of each partition that is due, and leases it
+# by moving available_at past the lease; a later event of the same partition
+# waits until the earlier one is deleted or dead.
+CLAIM_EVENTS = text(
+    "UPDATE outbox_events SET attempts = attempts + 1, "
+    "available_at = now() + make_interval(secs => :lease) "
+    "WHERE id IN ("
+    "SELECT id FROM outbox_events AS event "
+    "WHERE dead_at IS NULL AND available_at <= now() "
+    "AND NOT EXISTS (SELECT 1 FROM outbox_events AS earlier "
+    "WHERE earlier.partition_key = event.partition_key "
+    "AND earlier.id < event.id AND earlier.dead_at IS NULL) "
+    "ORDER BY id LIMIT :batch FOR UPDATE SKIP LOCKED) "
+    "RETURNING id, topic, payload, attempts"
+)
+
+
+def outbox_event(topic: str, partition_key: int, payload: dict) -> OutboxEvent:
+    """Build an outbox event to add to the session of the change it belongs to."""
+    return OutboxEvent(topic=topic, partition_key=partition_key, payload=payload)
+
+
+def backoff(attempts: int) -> float:
+    """Return seconds before the next attempt: exponential, capped, with jitter."""
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def permanent(error: Exception) -> bool:
+    """Return True if retrying the delivery cannot succeed."""
+    return (
+        isinstance(error, HTTPException)
+        and 400 <= error.status_code < 500
+        and error.status_code not in (408, 429)
+    )
+
+
+async def deliver(event, handlers: dict, semaphore: asyncio.Semaphore):
+    """Run the handler for one event and return the error, or None on success."""
+    async with semaphore:
+        try:
+            await handlers[event["topic"]](event["payload"])
+        except Exception as e:  # pylint: disable=W0718
+            return e
+    return None
+
+
+async def dispatch_batch(
+    session_factory, handlers: dict, batch: int = OUTBOX_BATCH_SIZE
+) -> int:
+    """
+    Claims and delivers one batch of due outbox events.
+
+    Delivered events are deleted. Failed ones are scheduled again after a
+    backoff, or marked dead when the error is permanent or they have run out
+    of attempts.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        handlers (dict): Async function taking the payload, for every topic.
+        batch (int): Maximum number of events claimed.
+
+    Returns:
+        int: The number of events claimed.
+    """
+    async with session_factory() as db:
+        result = await db.execute(CLAIM_EVENTS, {"lease": OUTBOX_LEASE, "batch": batch})
+        events = result.mappings().all()
+        await db.commit()
+    if not events:
+        return 0
+
+    semaphore = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    errors = await asyncio.gather(
+        *(deliver(event, handlers, semaphore) for event in events)
+    )
+
+    delivered = []
+    async with session_factory() as db:
+        for event, error in zip(events, errors):
+            if error is None:
+                delivered.append(event["id"])
+                OUTBOX_EVENTS.inc(event["topic"], "delivered")
+                continue
+            values = {"last_error": repr(error)[:1000]}
+            if permanent(error) or event["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+                values["dead_at"] = func.now()
+                OUTBOX_EVENTS.inc(event["topic"], "dead")
+                logging.error("Outbox event %d is dead: %r", event["id"], error)
+            else:
+                delay = timedelta(seconds=backoff(event["attempts"]))
+                values["available_at"] = func.now() + delay
+                OUTBOX_EVENTS.inc(event["topic"], "retry")
+            await db.execute(
+                update(OutboxEvent).where(OutboxEvent.id == event["id"]).values(values)
+            )
+        if delivered:
+            await db.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(delivered)))
+        await db.commit()
+    return len(events)
+
+
+async def dispatch_forever(
+    session_factory,
+    handlers: dict,
+    wakeup: asyncio.Event,
+    interval: float = OUTBOX_POLL_INTERVAL,
+):
+    """
+    Delivers outbox events until cancelled.
+
+    Full batches are followed by the next one straight away; otherwise the
+    dispatcher waits until woken up by a new order or interval seconds pass,
+    which also picks up retries and events written by other replicas.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        handlers (dict): Async function taking the payload, for every topic.
+        wakeup (asyncio.Event): Set to have pending events dispatched now.
+        interval (float): Seconds between polls when idle.
+    """
+    while True:
+        wakeup.clear()
+        try:
+            claimed = await dispatch_batch(session_factory, handlers)
+        except Exception:  # pylint: disable=W0718
+            logging.exception("Outbox dispatch failed")
+            claimed = 0
+        if claimed < OUTBOX_BATCH_SIZE:
+            try:
+                await asyncio.wait_for(wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def purge_dead_events(session_factory, batch: int = OUTBOX_CLEANUP_BATCH):
+    """
+    Deletes events dead for longer than OUTBOX_DEAD_TTL in batches, one short
+    transaction per batch.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        batch (int): Maximum number of rows deleted per transaction.
+
+    Returns:
+        int: The number of events deleted.
+    """
+    old = OutboxEvent.dead_at < func.now() - timedelta(seconds=OUTBOX_DEAD_TTL)
+    return await delete_in_batches(session_factory, OutboxEvent.id, old, batch)
+
+
+async def purge_dead_events_forever(
+    session_factory, interval: float = OUTBOX_CLEANUP_INTERVAL
+):
+    """
+    Deletes old dead events every interval seconds, starting one interval
+    after startup, until cancelled.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        interval (float): Seconds between cleanups.
+    """
+    await clean_up_forever(
+        purge_dead_events, session_factory, interval, "dead outbox events"
+    )
@@ -0,0 +1,293 @@
+# resilience.py
+"""
+This module contains the resilience layer for calls to the user and product
+services. ResilientTransport wraps the HTTP transport of a downstream client
+and gives every call a timeout for its endpoint, retries calls that are safe
+to repeat with jittered backoff while a retry budget allows it, and stops
+calling a service that keeps failing with a circuit breaker. While the breaker
+is open, calls fail at once with a 503 response instead of waiting on a
+service that is down, and after a cool-down a probe call decides whether to
+close it again.
+"""
+
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+import httpx
+from metrics import Counter, Gauge
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "10"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.05"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SEC = float(os.getenv("RETRY_BUDGET_MIN_PER_SEC", "2"))
+RETRY_BUDGET_BURST = float(os.getenv("RETRY_BUDGET_BURST", "20"))
+
+# Timeout and whether a retry is safe, per endpoint. Reserving stock is not
+# retried, as a caller without a reservation ID would take the stock twice;
+# releasing a reservation and adding an order to a user are safe to repeat.
+# Calls to other endpoints keep the client timeout and are not retried.
+ENDPOINTS = (
+    ("GET", r"/user/\d+$", float(os.getenv("HTTP_TIMEOUT_USER_GET", "1")), True),
+    ("PUT", r"/user/\d+$", float(os.getenv("HTTP_TIMEOUT_USER_PUT", "2")), True),
+    (
+        "POST",
+        r"/product/reserve$",
+        float(os.getenv("HTTP_TIMEOUT_PRODUCT_RESERVE", "3")),
+        False,
+    ),
+    (
+        "POST",
+        r"/product/reserve/[^/]+/release$",
+        float(os.getenv("HTTP_TIMEOUT_PRODUCT_RELEASE", "3")),
+        True,
+    ),
+)
+ENDPOINT_PATTERNS = [
+    (method, re.compile(pattern), timeout, retry)
+    for method, pattern, timeout, retry in ENDPOINTS
+]
+
+# Responses that mean the service is in trouble rather than rejecting the call
+FAILURE_STATUSES = (500, 502, 503, 504)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state",
+    "Circuit breaker state per downstream service: 0 closed, 1 half-open, 2 open.",
+    ("service",),
+)
+CIRCUIT_TRIPS = Counter(
+    "circuit_breaker_trips_total",
+    "Times the circuit breaker opened, per downstream service.",
+    ("service",),
+)
+DOWNSTREAM_RETRIES = Counter(
+    "downstream_retries_total",
+    "Retries of downstream calls, and retries refused by the budget.",
+    ("service", "outcome"),
+)
+
+
+def endpoint_policy(request: httpx.Request) -> tuple:
+    """Return the (timeout, retry) policy for a request; a None timeout is unlimited."""
+    for method, pattern, timeout, retry in ENDPOINT_PATTERNS:
+        if request.method == method and pattern.search(request.url.path):
+            return timeout, retry
+    return None, False
+
+
+class CircuitBreaker:  # pylint: disable=R0902
+    """
+    Circuit breaker for one downstream service.
+
+    After failure_threshold failures in a row the breaker opens and calls are
+    refused. Once reset_timeout seconds have passed it is half-open and lets
+    up to half_open_probes calls through: a success closes it, a failure
+    opens it again for another reset_timeout.
+
+    Attributes:
+        service (str): The service name, used as the metrics label.
+        state (str): "closed", "half_open" or "open".
+        failures (int): Failures in a row while closed.
+        opened_at (float): Monotonic time the breaker last opened.
+        probes (int): Probe calls in flight while half-open.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+        half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES,
+    ):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.state = CLOSED
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], service)
+
+    def set_state(self, state: str):
+        """Move to a state and publish it."""
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+            if self.state != OPEN:
+                CIRCUIT_TRIPS.inc(self.service)
+                logging.warning("Circuit breaker for %s opened", self.service)
+        self.state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], self.service)
+
+    def retry_after(self) -> float:
+        """Return seconds until an open breaker lets a probe through."""
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        """Return True if a call may go ahead, counting it as a probe if half-open."""
+        if self.state == OPEN and self.retry_after() == 0:
+            self.set_state(HALF_OPEN)
+            self.probes = 0
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and self.probes < self.half_open_probes:
+            self.probes += 1
+            return True
+        return False
+
+    def release_probe(self):
+        """Free the probe slot of a half-open call that was cancelled."""
+        if self.state == HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def record_success(self):
+        """Record a call that the service handled."""
+        self.failures = 0
+        if self.state != CLOSED:
+            self.set_state(CLOSED)
+
+    def record_failure(self):
+        """Record a call that failed because of the service."""
+        if self.state == HALF_OPEN:
+            self.set_state(OPEN)
+            return
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.failure_threshold:
+            self.set_state(OPEN)
+
+
+class RetryBudget:
+    """
+    Limits retries to a share of the calls, so retries cannot multiply the
+    load on a service that is already struggling.
+
+    Every call deposits ratio tokens, min_per_second tokens are added over
+    time so that a quiet client can still retry, and every retry spends one.
+    At most burst tokens are kept.
+    """
+
+    def __init__(
+        self,
+        ratio: float = RETRY_BUDGET_RATIO,
+        min_per_second: float = RETRY_BUDGET_MIN_PER_SEC,
+        burst: float = RETRY_BUDGET_BURST,
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, amount: float = 0.0):
+        """Add the tokens earned since the last update, plus amount."""
+        now = time.monotonic()
+        earned = (now - self.updated) * self.min_per_second + amount
+        self.tokens = min(self.burst, self.tokens + earned)
+        self.updated = now
+
+    def record_call(self):
+        """Deposit the share of a call."""
+        self.refill(self.ratio)
+
+    def try_spend(self) -> bool:
+        """Take a token for a retry; return False if the budget is exhausted."""
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """
+    HTTP transport adding timeouts, retries and a circuit breaker to the
+    transport it wraps.
+
+    Errors from the service (connection errors, timeouts and 5xx responses)
+    count against the breaker; other responses, including 4xx, count as
+    successes. Refused calls get a 503 response whose detail names the
+    service, which the callers turn into a 503 for the client.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        transport: httpx.AsyncBaseTransport,
+        breaker: CircuitBreaker = None,
+        budget: RetryBudget = None,
+    ):
+        self.service = service
+        self.transport = transport
+        self.breaker = breaker or CircuitBreaker(service)
+        self.budget = budget or RetryBudget()
+
+    def unavailable(self, request: httpx.Request) -> httpx.Response:
+        """Build the fail-fast response for a call refused by the breaker."""
+        return httpx.Response(
+            503,
+            json={"detail": f"{self.service} service unavailable (circuit open)"},
+            headers={"Retry-After": str(int(self.breaker.retry_after()) + 1)},
+            request=request,
+        )
+
+    async def attempt(self, request: httpx.Request, timeout: float):
+        """Send the request once within the timeout and record the outcome."""
+        try:
+            async with asyncio.timeout(timeout):
+                response = await self.transport.handle_async_request(request)
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        except (httpx.TransportError, TimeoutError) as e:
+            self.breaker.record_failure()
+            if isinstance(e, TimeoutError):
+                raise httpx.ReadTimeout(
+                    f"{self.service} service did not answer in {timeout}s",
+                    request=request,
+                ) from e
+            raise
+        if response.status_code in FAILURE_STATUSES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        timeout, retry = endpoint_policy(request)
+        self.budget.record_call()
+        attempt = 1
+        while True:
+            if not self.breaker.allow():
+                return self.unavailable(request)
+            response, error = None, None
+            try:
+                response = await self.attempt(request, timeout)
+            except httpx.TransportError as e:
+                error = e
+            failed = error is not None or response.status_code in FAILURE_STATUSES
+            if failed and retry and attempt < RETRY_MAX_ATTEMPTS:
+                if self.budget.try_spend():
+                    if response is not None:
+                        await response.aclose()
+                    DOWNSTREAM_RETRIES.inc(self.service, "retried")
+                    await asyncio.sleep(
+                        random.uniform(0, RETRY_BACKOFF_BASE * 2**attempt)
+                    )
+                    attempt += 1
+                    continue
+                DOWNSTREAM_RETRIES.inc(self.service, "budget_exhausted")
+            if error is not None:
+                raise error
+            return response
+
+    async def aclose(self):
+        await self.transport.aclose()
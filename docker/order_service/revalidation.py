@@ -0,0 +1,112 @@
+# revalidation.py
+"""
+This module contains the conditional-request layer for reads from downstream
+services, used by the user client for the user check of orders (ORDER_USER_CHECK).
+RevalidatingTransport wraps the transport of a downstream client and keeps the
+last response with an ETag for each read. The next identical read is sent
+with If-None-Match, and when the service answers 304 Not Modified the kept
+response is returned instead, so an unchanged user is checked with a version
+lookup and not sent again.
+"""
+
+import os
+from collections import OrderedDict
+import httpx
+from metrics import Counter
+
+# Most responses kept per downstream service; 0 turns revalidation off
+HTTP_ETAG_CACHE_ENTRIES = int(os.getenv("HTTP_ETAG_CACHE_ENTRIES", "1024"))
+
+REVALIDATIONS = Counter(
+    "http_revalidations_total",
+    "Conditional reads per downstream service, by whether the kept copy was current.",
+    ("service", "outcome"),
+)
+
+
+def read_key(request: httpx.Request):
+    """
+    Return the cache key of a read, or None for calls that are not reads.
+
+    GET calls are reads, and so are POST calls to a getlist endpoint, which
+    send the IDs in the body.
+
+    Args:
+        request (httpx.Request): The outgoing request.
+
+    Returns:
+        tuple: The method, URL and body of the request, or None.
+    """
+    if request.method == "GET" or (
+        request.method == "POST" and request.url.path.endswith("/getlist")
+    ):
+        try:
+            return request.method, str(request.url), request.content
+        except httpx.RequestNotRead:
+            return None
+    return None
+
+
+class RevalidatingTransport(httpx.AsyncBaseTransport):
+    """
+    HTTP transport revalidating reads with If-None-Match against the
+    responses it kept.
+
+    Only 200 responses with an ETag are kept, least recently used first out.
+    A 304 is turned back into the kept 200; any other answer drops it.
+
+    Attributes:
+        service (str): The downstream service name, for the metrics.
+        transport (httpx.AsyncBaseTransport): The transport sending the calls.
+        max_entries (int): Most responses kept.
+    """
+
+    def __init__(
+        self,
+        service: str,
+        transport: httpx.AsyncBaseTransport,
+        max_entries: int = HTTP_ETAG_CACHE_ENTRIES,
+    ):
+        self.service = service
+        self.transport = transport
+        self.max_entries = max_entries
+        self.kept = OrderedDict()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = read_key(request) if self.max_entries else None
+        if key is None:
+            return await self.transport.handle_async_request(request)
+        kept = self.kept.get(key)
+        if kept and "if-none-match" not in request.headers:
+            request.headers["If-None-Match"] = kept[0]
+
+        response = await self.transport.handle_async_request(request)
+        if kept and response.status_code == 304:
+            await response.aclose()
+            self.kept.move_to_end(key)
+            REVALIDATIONS.inc(self.service, "not_modified")
+            _, headers, content = kept
+            return httpx.Response(
+                200, headers=headers, content=content, request=request
+            )
+        if kept:
+            REVALIDATIONS.inc(self.service, "modified")
+            self.kept.pop(key, None)
+
+        etag = response.headers.get("etag")
+        if response.status_code != 200 or not etag:
+            return response
+        # The body is kept decoded, so the headers describing its encoding go.
+        await response.aread()
+        headers = [
+            (name, value)
+            for name, value in response.headers.multi_items()
+            if name not in ("content-encoding", "content-length")
+        ]
+        self.kept[key] = (etag, headers, response.content)
+        if len(self.kept) > self.max_entries:
+            self.kept.popitem(last=False)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
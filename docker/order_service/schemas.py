@@ -5,7 +5,8 @@ serializing the request and response data.
 It defines two schemas: orderCreateSchema for creating orders and --
 orderSchema for representing order data.
 """
-from pydantic import BaseModel
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, TypeAdapter
 
 
 class OrderItemRequestSchema(BaseModel):
@@ -49,14 +50,8 @@ class OrderSchema(BaseModel):
     user_id: int
     order_total: float
 
-    class Config:
-        """
-        Configuration for the OrderSchema.
-
-        orm_mode = True tells Pydantic to treat the data as ORM models,
-        allowing automatic conversion from SQLAlchemy model instances to Pydantic models.
-        """
-        orm_mode = True
+    # Lets the schema be built from SQLAlchemy model instances
+    model_config = ConfigDict(from_attributes=True)
 
 
 class OrderItemSchema(BaseModel):
@@ -79,11 +74,36 @@ class OrderItemSchema(BaseModel):
     price: float
     item_total: float
 
-    class Config:
-        """
-        Configuration for the OrderItemSchema.
+    # Lets the schema be built from SQLAlchemy model instances
+    model_config = ConfigDict(from_attributes=True)
+
+
+class OrderWithItemsSchema(OrderSchema):
+    """
+    Schema for an order in a listing, optionally with its items.
+
+    Attributes:
+        items (Optional[list[OrderItemSchema]]): The order's items,
+        only present when requested with include=items.
+    """
+
+    items: Optional[list[OrderItemSchema]] = None
+
+
+class OrderPageSchema(BaseModel):
+    """
+    Schema for one page of an order listing.
+
+    Attributes:
+        orders (list[OrderWithItemsSchema]): Orders in ascending ID order.
+        next_after (Optional[int]): Pass as `after` to read the next page,
+        or None if this is the last page.
+    """
+
+    orders: list[OrderWithItemsSchema]
+    next_after: Optional[int] = None
+
 
-        orm_mode = True tells Pydantic to treat the data as ORM models,
-        allowing automatic conversion from SQLAlchemy model instances to Pydantic models.
-        """
-        orm_mode = True
+# Built once at import and used by the list routes, see serialization.py
+ORDER_ITEM_LIST_ADAPTER = TypeAdapter(list[OrderItemSchema])
+ORDER_PAGE_ADAPTER = TypeAdapter(OrderPageSchema)
@@ -4,16 +4,914 @@ This module contains tests for the FastAPI user service,
 including testing the main endpoint, creating a user, and reading user details.
 """
 
+import asyncio
+import csv
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+import httpx
+import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from main import app
+from sqlalchemy import inspect
+import main
+import migrate
+import models
+import order_export
+import outbox
+import resilience
+from database import Async_Order_Session, Order_Session, get_engine
+from idempotency import complete_key, purge_expired_keys, request_fingerprint
+from main import app, get_product_client, get_user_client, outbox_handlers
+from metrics import render_metrics
+from resilience import CircuitBreaker, ResilientTransport, RetryBudget
+from revalidation import RevalidatingTransport
+from schemas import OrderRequestSchema
+from utils import fan_out, validate_user
 
-client = TestClient(app)
+# The tests deliver outbox events themselves with dispatch_batch
+main.OUTBOX_DISPATCHER = False
 
 
-def test_get_index():
+@pytest.fixture(name="client", scope="module")
+def fixture_client():
+    """
+    Provide a test client that runs the app's lifespan once for the module,
+    so every request shares one event loop and one async connection pool.
+    The schema is migrated first, as the app no longer creates it.
+    """
+    migrate.migrate(get_engine())
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def new_user_id() -> int:
+    """
+    Return a random user ID, so a test only sees the orders and outbox events
+    it creates, and not those left in the database by earlier runs.
+    """
+    return uuid.uuid4().int % 2**31
+
+
+def test_get_index(client):
     """
     Test the root endpoint ("/").
     Ensures the endpoint returns a 200 status code and the expected JSON response.
     """
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_healthz_readyz(client, monkeypatch):
+    """
+    Test the health endpoints ("/healthz", "/readyz").
+    Ensures readiness reports the schema version and fails while the
+    database is behind the migrations the code needs.
+    """
+    assert client.get("/healthz").json() == {"status": "ok"}
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "schema_version": migrate.HEAD}
+
+    monkeypatch.setattr(main, "HEAD", migrate.HEAD + 1)
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unmigrated"
+
+
+def test_migrations_match_models():
+    """
+    Test that the migrations create the tables, columns and indexes the models
+    describe, and that running them again applies nothing.
+    """
+    engine = get_engine()
+    migrate.migrate(engine)
+    assert not migrate.migrate(engine)
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        assert columns == {column.name for column in table.columns}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= indexes
+
+
+def test_lifespan_shared_clients():
+    """
+    Test that the app creates one pooled HTTP client per downstream service
+    on startup and closes them on shutdown.
+    """
+    with TestClient(app):
+        product_client = app.state.product_client
+        user_client = app.state.user_client
+        assert product_client is not user_client
+        assert not product_client.is_closed
+    assert product_client.is_closed
+    assert user_client.is_closed
+
+
+def test_db_pool_status(client):
+    """
+    Test the connection pool status endpoint ("/db/pool").
+    Ensures pool occupancy and checkout wait statistics are reported.
+    """
+    response = client.get("/db/pool")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["pool_size"] >= 1
+    assert status["checkout_wait_seconds_max"] >= 0
+
+
+def test_user_service_errors_name_the_user_service():
+    """
+    Test that a user service error without a JSON detail is reported as a
+    user service error, not a product service one.
+    """
+
+    async def run():
+        transport = httpx.MockTransport(
+            lambda _: httpx.Response(502, text="Bad gateway")
+        )
+        async with httpx.AsyncClient(transport=transport) as user_client:
+            with pytest.raises(HTTPException) as error:
+                await validate_user(1, "http://stub/user", client=user_client)
+        return error.value
+
+    error = asyncio.run(run())
+    assert error.status_code == 502
+    assert error.detail == "User service error: Bad gateway"
+
+
+def test_fan_out_collects_errors():
+    """
+    Test that fan_out runs every call and returns each result or error,
+    including errors other than HTTPException, without cancelling the others.
+    """
+
+    async def succeed():
+        await asyncio.sleep(0.01)
+        return "ok"
+
+    async def fail():
+        raise HTTPException(status_code=404, detail="User not found")
+
+    async def crash():
+        raise ValueError("Invalid JSON")
+
+    outcomes = asyncio.run(fan_out([succeed, fail, crash, succeed], limit=2))
+    assert [result for result, _ in outcomes] == ["ok", None, None, "ok"]
+    assert outcomes[1][1].status_code == 404
+    assert isinstance(outcomes[2][1], ValueError)
+
+
+def test_post_order_releases_stock_when_user_missing(client, monkeypatch):
+    """
+    Test the order endpoint ("/order") with ORDER_USER_CHECK when the user
+    does not exist.
+    Ensures the stock reserved concurrently with the user check is given back.
+    """
+    monkeypatch.setattr(main, "ORDER_USER_CHECK", True)
+    product_calls = []
+
+    def product_handler(request: httpx.Request):
+        product_calls.append((request.url.path, request.content))
+        if request.url.path.endswith("/reserve"):
+            return httpx.Response(
+                200,
+                json=[{"id": 7, "name": "Stub Product", "price": 5, "stock_left": 3}],
+            )
+        return httpx.Response(200, json=[])
+
+    def user_handler(_request: httpx.Request):
+        return httpx.Response(404, json={"detail": "User not found"})
+
+    product_client = httpx.AsyncClient(transport=httpx.MockTransport(product_handler))
+    user_client = httpx.AsyncClient(transport=httpx.MockTransport(user_handler))
+    app.dependency_overrides[get_product_client] = lambda: product_client
+    app.dependency_overrides[get_user_client] = lambda: user_client
+    try:
+        response = client.post(
+            "/order", json={"user_id": 1, "items": [{"product_id": 7, "number": 2}]}
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 404
+    reservation_id = json.loads(product_calls[0][1])["reservation_id"]
+    assert [path for path, _ in product_calls] == [
+        "/product/reserve",
+        f"/product/reserve/{reservation_id}/release",
+    ]
+
+
+def test_post_order_releases_reservation_after_reserve_timeout(client):
+    """
+    Test the order endpoint ("/order") when the reservation times out.
+    Ensures the reservation, which may have been made anyway, is released by
+    its ID, and that a release the product service cannot take is queued in
+    the outbox and delivered later.
+    """
+    drain_outbox(client, {"user_order": ignore, "stock_release": ignore})
+    user_id = new_user_id()
+    product_calls = []
+
+    def product_handler(request: httpx.Request):
+        product_calls.append(request.url.path)
+        raise httpx.ReadTimeout("Product service did not answer", request=request)
+
+    def user_handler(_request: httpx.Request):
+        return httpx.Response(
+            200, json={"id": user_id, "name": "Stub User", "orders": []}
+        )
+
+    product_client = httpx.AsyncClient(transport=httpx.MockTransport(product_handler))
+    user_client = httpx.AsyncClient(transport=httpx.MockTransport(user_handler))
+    app.dependency_overrides[get_product_client] = lambda: product_client
+    app.dependency_overrides[get_user_client] = lambda: user_client
+    try:
+        response = client.post(
+            "/order",
+            json={"user_id": user_id, "items": [{"product_id": 7, "number": 1}]},
+        )
+    finally:
+        app.dependency_overrides.clear()
+
+    assert response.status_code == 500
+    (event,) = pending_events(user_id)
+    assert event.topic == "stock_release"
+    reservation_id = event.payload["reservation_id"]
+    assert product_calls == [
+        "/product/reserve",
+        f"/product/reserve/{reservation_id}/release",
+    ]
+
+    released = []
+
+    def release_handler(request: httpx.Request):
+        released.append(request.url.path)
+        return httpx.Response(200, json=[])
+
+    product_client = httpx.AsyncClient(transport=httpx.MockTransport(release_handler))
+    drain_outbox(client, outbox_handlers(user_client, product_client))
+    assert released == [f"/product/reserve/{reservation_id}/release"]
+    assert not pending_events(user_id)
+
+
+def test_list_orders_paginated(client):
+    """
+    Test the order listing endpoint ("/orders").
+    Ensures following next_after walks a user's orders exactly once and
+    include=items attaches each order's items.
+    """
+    user_id, other_user_id = new_user_id(), new_user_id()
+    db = Order_Session()
+    try:
+        orders = [
+            models.Order(user_id=user_id, order_total=10.0 * i) for i in range(1, 4)
+        ]
+        db.add_all(orders + [models.Order(user_id=other_user_id, order_total=1.0)])
+        db.flush()
+        db.add_all(
+            models.OrderItem(
+                order_id=order.id, product_id=1, product_num=1, price=5, item_total=5
+            )
+            for order in orders
+            for _ in range(2)
+        )
+        db.commit()
+        order_ids = [order.id for order in orders]
+    finally:
+        db.close()
+
+    pages, after = [], None
+    while True:
+        params = {"user_id": user_id, "limit": 2}
+        if after is not None:
+            params["after"] = after
+        page = client.get("/orders", params=params).json()
+        assert all("items" not in order for order in page["orders"])
+        pages.append([order["id"] for order in page["orders"]])
+        after = page["next_after"]
+        if after is None:
+            break
+    assert pages == [order_ids[:2], order_ids[2:]]
+
+    response = client.get("/orders", params={"user_id": user_id, "include": "items"})
+    assert response.status_code == 200
+    listed = response.json()["orders"]
+    assert [len(order["items"]) for order in listed] == [2, 2, 2]
+    assert all(
+        item["order_id"] == order["id"] for order in listed for item in order["items"]
+    )
+    assert client.get("/orders", params={"include": "other"}).status_code == 422
+
+
+def test_metrics_endpoint(client):
+    """
+    Test the metrics endpoint ("/metrics").
+    Ensures requests are labelled by route template and that database time,
+    downstream calls and pool occupancy are reported.
+    """
+    client.get("/order/items/999999")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert (
+        'http_requests_total{method="GET",route="/order/items/{order_id}",'
+        'status="404"}' in body
+    )
+    assert 'http_request_db_seconds_count{method="GET",route="/orders"}' in body
+    assert "db_query_duration_seconds_count" in body
+    assert 'downstream_request_duration_seconds_count{call="reserve_products",' in body
+    assert 'downstream_request_duration_seconds_count{call="validate_user",' in body
+    assert "http_requests_in_flight 1.0" in body
+    assert "db_pool_checked_out" in body
+
+
+def mock_clients(reserve_delay: float = 0):
+    """
+    Build HTTP clients answering for the product and user services, and the
+    list of paths they were called with.
+    """
+    calls = []
+
+    async def product_handler(request: httpx.Request):
+        calls.append(request.url.path)
+        if request.url.path.endswith("/reserve"):
+            await asyncio.sleep(reserve_delay)
+            return httpx.Response(
+                200,
+                json=[{"id": 7, "name": "Stub Product", "price": 5, "stock_left": 3}],
+            )
+        return httpx.Response(200, json=[])
+
+    async def user_handler(request: httpx.Request):
+        calls.append(request.url.path)
+        return httpx.Response(200, json={"id": 1, "name": "Stub User", "orders": []})
+
+    product_client = httpx.AsyncClient(transport=httpx.MockTransport(product_handler))
+    user_client = httpx.AsyncClient(transport=httpx.MockTransport(user_handler))
+    app.dependency_overrides[get_product_client] = lambda: product_client
+    app.dependency_overrides[get_user_client] = lambda: user_client
+    return calls
+
+
+def test_post_order_idempotent_retry(client):
+    """
+    Test retrying the order endpoint ("/order") with an Idempotency-Key.
+    Ensures the retry gets the stored order without downstream calls and that
+    reusing the key for a different order is rejected.
+    """
+    calls = mock_clients()
+    body = {"user_id": 1, "items": [{"product_id": 7, "number": 2}]}
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+    try:
+        first = client.post("/order", json=body, headers=headers)
+        downstream_calls = len(calls)
+        retry = client.post("/order", json=body, headers=headers)
+        body["items"][0]["number"] = 3
+        reused = client.post("/order", json=body, headers=headers)
+    finally:
+        app.dependency_overrides.clear()
+
+    assert first.status_code == 200
+    assert retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert len(calls) == downstream_calls
+    assert reused.status_code == 422
+
+
+def test_post_order_concurrent_duplicates_wait(client):
+    """
+    Test sending the same order twice at once with one Idempotency-Key.
+    Ensures the second request waits for the first instead of reserving again.
+    """
+    calls = mock_clients(reserve_delay=0.3)
+    body = {"user_id": 1, "items": [{"product_id": 7, "number": 1}]}
+    headers = {"Idempotency-Key": uuid.uuid4().hex}
+
+    async def post_twice():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as async_client:
+            return await asyncio.gather(
+                *(
+                    async_client.post("/order", json=body, headers=headers)
+                    for _ in range(2)
+                )
+            )
+
+    try:
+        first, second = client.portal.call(post_twice)
+    finally:
+        app.dependency_overrides.clear()
+
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert calls.count("/product/reserve") == 1
+
+
+def test_post_order_takes_over_lapsed_key(client):
+    """
+    Test retrying an order whose first request died holding its Idempotency-Key.
+    Ensures the retry takes the key over once the lease has run out, stores
+    the response with the order, and the earlier holder can no longer write it.
+    """
+    body = {"user_id": 1, "items": [{"product_id": 7, "number": 1}]}
+    key = uuid.uuid4().hex
+    lapsed = datetime.now(timezone.utc) - timedelta(minutes=5)
+    db = Order_Session()
+    try:
+        db.add(
+            models.IdempotencyKey(
+                key=key,
+                request_hash=request_fingerprint(OrderRequestSchema(**body)),
+                claimed_at=lapsed,
+            )
+        )
+        db.commit()
+
+        mock_clients()
+        try:
+            response = client.post(
+                "/order", json=body, headers={"Idempotency-Key": key}
+            )
+        finally:
+            app.dependency_overrides.clear()
+
+        async def complete_lapsed():
+            async with Async_Order_Session() as session:
+                await complete_key(session, key, lapsed, 500, {})
+
+        client.portal.call(complete_lapsed)
+        row = db.get(models.IdempotencyKey, key)
+    finally:
+        db.close()
+
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert row.status_code == 200
+    assert row.response_body == response.json()
+    assert row.claimed_at > lapsed
+
+
+def test_purge_expired_idempotency_keys(client):
+    """
+    Test the idempotency key cleanup.
+    Ensures expired keys are deleted in batches and fresh keys are kept.
+    """
+    expired_keys = [uuid.uuid4().hex for _ in range(5)]
+    fresh_key = uuid.uuid4().hex
+    db = Order_Session()
+    try:
+        expired = datetime.now(timezone.utc) - timedelta(days=2)
+        db.add_all(
+            models.IdempotencyKey(key=key, request_hash="-", created_at=expired)
+            for key in expired_keys
+        )
+        db.add(models.IdempotencyKey(key=fresh_key, request_hash="-"))
+        db.commit()
+
+        deleted = client.portal.call(purge_expired_keys, Async_Order_Session, 2)
+        keys = {key for (key,) in db.query(models.IdempotencyKey.key)}
+    finally:
+        db.close()
+
+    # Keys created by earlier runs may have expired since and go too
+    assert deleted >= 5
+    assert fresh_key in keys
+    assert not keys & set(expired_keys)
+
+
+def test_export_orders(client, monkeypatch):
+    """
+    Test the order export endpoint ("/orders/export").
+    Ensures every order in the ID range is streamed once across chunks with
+    its items, in NDJSON and CSV, and that the time filter applies.
+    """
+    monkeypatch.setattr(order_export, "EXPORT_CHUNK_SIZE", 2)
+    db = Order_Session()
+    try:
+        orders = [models.Order(user_id=77, order_total=float(i)) for i in range(3)]
+        db.add_all(orders)
+        db.flush()
+        db.add_all(
+            models.OrderItem(
+                order_id=orders[0].id,
+                product_id=product_id,
+                product_num=1,
+                price=2,
+                item_total=2,
+            )
+            for product_id in (8, 9)
+        )
+        db.commit()
+        order_ids = [order.id for order in orders]
+    finally:
+        db.close()
+    id_range = {"min_id": order_ids[0], "max_id": order_ids[-1]}
+
+    response = client.get("/orders/export", params=id_range)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    assert [order["id"] for order in exported] == order_ids
+    assert [item["product_id"] for item in exported[0]["items"]] == [8, 9]
+    assert exported[1]["items"] == []
+
+    response = client.get("/orders/export", params={**id_range, "format": "csv"})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.DictReader(response.text.splitlines()))
+    assert [int(row["order_id"]) for row in rows] == order_ids[:1] * 2 + order_ids[1:]
+    assert rows[2]["item_id"] == ""
+
+    future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    response = client.get("/orders/export", params={**id_range, "since": future})
+    assert response.text == ""
+
+
+def pending_events(partition_key: int) -> list:
+    """Return the outbox events of a partition in ID order."""
+    db = Order_Session()
+    try:
+        return (
+            db.query(models.OutboxEvent)
+            .filter(models.OutboxEvent.partition_key == partition_key)
+            .order_by(models.OutboxEvent.id)
+            .all()
+        )
+    finally:
+        db.close()
+
+
+def drain_outbox(client, handlers) -> None:
+    """Dispatch outbox events until none are due."""
+    while client.portal.call(outbox.dispatch_batch, Async_Order_Session, handlers):
+        pass
+
+
+async def ignore(_payload):
+    """Outbox handler dropping events left by earlier tests."""
+
+
+def test_post_order_writes_outbox_event(client):
+    """
+    Test that the order endpoint ("/order") leaves the user update to the outbox.
+    Ensures the order returns without calling the user service, which is not
+    checked by default, and that dispatching the outbox then adds the order to
+    the user and deletes the event.
+    """
+    drain_outbox(client, {"user_order": ignore})
+    user_id = new_user_id()
+    calls = mock_clients()
+    try:
+        response = client.post(
+            "/order",
+            json={"user_id": user_id, "items": [{"product_id": 7, "number": 1}]},
+        )
+    finally:
+        app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert f"/user/{user_id}" not in calls
+    events = pending_events(user_id)
+    assert [(event.topic, event.payload) for event in events] == [
+        ("user_order", response.json())
+    ]
+
+    delivered = []
+
+    def user_handler(request: httpx.Request):
+        delivered.append((request.url.path, request.content))
+        return httpx.Response(200, json={})
+
+    user_client = httpx.AsyncClient(transport=httpx.MockTransport(user_handler))
+    drain_outbox(client, outbox_handlers(user_client, httpx.AsyncClient()))
+    order_id = response.json()["id"]
+    assert delivered == [(f"/user/{user_id}", f'{{"order_id":{order_id}}}'.encode())]
+    assert not pending_events(user_id)
+
+
+def test_outbox_retries_in_order_per_user(client, monkeypatch):
+    """
+    Test outbox delivery against a flaky stand-in user service.
+    Ensures a failed event is retried after a backoff while later events of
+    the same user wait for it, other users are not held up, and a rejected
+    event is marked dead.
+    """
+    monkeypatch.setattr(outbox, "OUTBOX_BACKOFF_BASE", 0.05)
+    drain_outbox(client, {"user_order": ignore})
+    flaky, steady, missing = new_user_id(), new_user_id(), new_user_id()
+    db = Order_Session()
+    try:
+        db.add_all(
+            outbox.outbox_event("user_order", user_id, {"id": order_id})
+            for user_id, order_id in ((flaky, 1), (flaky, 2), (steady, 3), (missing, 4))
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    delivered, failures = [], {1: 1}
+
+    async def deliver_order(payload):
+        if payload["id"] == 4:
+            raise HTTPException(status_code=404, detail="User not found")
+        if failures.get(payload["id"]):
+            failures[payload["id"]] -= 1
+            raise HTTPException(status_code=503, detail="Unavailable")
+        delivered.append(payload["id"])
+
+    handlers = {"user_order": deliver_order}
+    client.portal.call(outbox.dispatch_batch, Async_Order_Session, handlers)
+    assert delivered == [3]
+    assert [event.attempts for event in pending_events(flaky)] == [1, 0]
+
+    deadline = time.monotonic() + 5
+    while pending_events(flaky) and time.monotonic() < deadline:
+        client.portal.call(outbox.dispatch_batch, Async_Order_Session, handlers)
+        time.sleep(0.05)
+    assert delivered == [3, 1, 2]
+    assert not pending_events(steady)
+    (dead,) = pending_events(missing)
+    assert dead.dead_at is not None
+    assert "User not found" in dead.last_error
+
+
+def test_purge_dead_outbox_events(client):
+    """
+    Test the outbox cleanup.
+    Ensures events dead for longer than the retention are deleted in batches,
+    while recently dead and pending events are kept.
+    """
+    user_id = new_user_id()
+    db = Order_Session()
+    try:
+        old = datetime.now(timezone.utc) - timedelta(days=30)
+        events = [
+            outbox.outbox_event("user_order", user_id, {"id": i}) for i in range(5)
+        ]
+        for event in events:
+            event.dead_at = old
+        recent = outbox.outbox_event("user_order", user_id, {"id": 5})
+        recent.dead_at = datetime.now(timezone.utc)
+        pending = outbox.outbox_event("user_order", user_id, {"id": 6})
+        db.add_all(events + [recent, pending])
+        db.commit()
+
+        deleted = client.portal.call(outbox.purge_dead_events, Async_Order_Session, 2)
+    finally:
+        db.close()
+
+    # Events left dead by earlier runs may have aged past the retention too
+    assert deleted >= 5
+    assert [event.payload["id"] for event in pending_events(user_id)] == [5, 6]
+
+
+def test_outbox_dispatch_throughput(client):
+    """
+    Test draining a backlog of outbox events through a stand-in user service
+    that takes 10 ms per call.
+    Ensures deliveries overlap across users, so the backlog drains in a
+    fraction of the time sequential calls would take, and that each user's
+    events still arrive in order.
+    """
+    drain_outbox(client, {"user_order": ignore})
+    events = [(700 + i % 50, i) for i in range(500)]
+    db = Order_Session()
+    try:
+        db.add_all(
+            outbox.outbox_event("user_order", user_id, {"id": order_id})
+            for user_id, order_id in events
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    delivered = []
+
+    async def deliver_order(payload):
+        await asyncio.sleep(0.01)
+        delivered.append(payload["id"])
+
+    handlers = {"user_order": deliver_order}
+    start = time.perf_counter()
+    drain_outbox(client, handlers)
+    elapsed = time.perf_counter() - start
+
+    assert sorted(delivered) == list(range(500))
+    for user_id in range(700, 750):
+        sent = [order_id for order_id in delivered if events[order_id][0] == user_id]
+        assert sent == sorted(sent)
+    assert elapsed < len(events) * 0.01 / 4
+
+
+class FaultInjector:
+    """
+    Stand-in downstream service answering with queued faults: a status code,
+    "error" for a connection error or "hang" for no answer. Calls without a
+    queued fault succeed.
+    """
+
+    def __init__(self, *faults):
+        self.faults = list(faults)
+        self.calls = 0
+
+    async def handler(self, request: httpx.Request):
+        """Answer a request with the next fault, or a user on success."""
+        self.calls += 1
+        fault = self.faults.pop(0) if self.faults else None
+        if fault == "hang":
+            await asyncio.sleep(10)
+        if fault == "error":
+            raise httpx.ConnectError("Connection refused", request=request)
+        if fault is not None:
+            return httpx.Response(fault, json={"detail": "Injected fault"})
+        return httpx.Response(200, json={"id": 1, "name": "Stub User", "orders": []})
+
+    def client(self, service: str = "stub", **kwargs) -> httpx.AsyncClient:
+        """Build a resilient client for the stand-in."""
+        transport = ResilientTransport(
+            service, httpx.MockTransport(self.handler), **kwargs
+        )
+        return httpx.AsyncClient(transport=transport, base_url="http://stub")
+
+
+def test_resilient_transport_retries_safe_calls(monkeypatch):
+    """
+    Test that reads and user updates are retried after errors and timeouts,
+    while stock reservations, which are not idempotent, are not.
+    """
+    monkeypatch.setattr(resilience, "RETRY_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(
+        resilience,
+        "ENDPOINT_PATTERNS",
+        [
+            (method, pattern, 0.05 if timeout else None, retry)
+            for method, pattern, timeout, retry in resilience.ENDPOINT_PATTERNS
+        ],
+    )
+
+    async def run():
+        injector = FaultInjector(503, "error")
+        async with injector.client() as client:
+            reads = await client.get("/user/1")
+            injector.faults.append(503)
+            reserve = await client.post("/product/reserve", json={"items": []})
+        timed_out = FaultInjector("hang")
+        async with timed_out.client() as client:
+            start = time.perf_counter()
+            after_timeout = await client.put("/user/1", json={"order_id": 1})
+            elapsed = time.perf_counter() - start
+        return injector, reads, reserve, timed_out, after_timeout, elapsed
+
+    injector, reads, reserve, timed_out, after_timeout, elapsed = asyncio.run(run())
+    assert reads.status_code == 200
+    assert reserve.status_code == 503
+    assert injector.calls == 4
+    assert after_timeout.status_code == 200
+    assert timed_out.calls == 2
+    assert elapsed < 1
+
+
+def test_revalidating_transport():
+    """
+    Test that repeated reads are sent with If-None-Match and a 304 answer is
+    turned back into the kept response, while writes and responses without
+    an ETag pass through untouched.
+    """
+    versions = {"/user/1": 1, "/user/2": 1}
+    sent = []
+
+    def handler(request: httpx.Request):
+        sent.append(request.headers.get("if-none-match"))
+        if request.method == "PUT":
+            versions[request.url.path] += 1
+            return httpx.Response(200, json={"id": 1})
+        if request.url.path == "/product/getlist":
+            return httpx.Response(200, json=[])
+        etag = f'"{versions[request.url.path]}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        body = {"id": 1, "version": versions[request.url.path]}
+        return httpx.Response(200, json=body, headers={"ETag": etag})
+
+    async def run():
+        transport = RevalidatingTransport(
+            "user", httpx.MockTransport(handler), max_entries=1
+        )
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://stub"
+        ) as client:
+            first = await client.get("/user/1")
+            second = await client.get("/user/1")
+            await client.put("/user/1", json={"order_id": 1})
+            third = await client.get("/user/1")
+            await client.post("/product/getlist", json={"ids": [1]})
+            await client.post("/product/getlist", json={"ids": [1]})
+            await client.get("/user/2")
+            fourth = await client.get("/user/1")
+        return first, second, third, fourth
+
+    first, second, third, fourth = asyncio.run(run())
+    assert second.status_code == 200
+    assert second.json() == first.json() == {"id": 1, "version": 1}
+    assert second.headers["etag"] == '"1"'
+    assert third.json() == {"id": 1, "version": 2}
+    assert fourth.json() == third.json()
+    # The PUT, the getlist calls without an ETag and the evicted read go plain
+    assert sent == [None, '"1"', None, '"1"', None, None, None, None]
+    assert 'http_revalidations_total{service="user",outcome="not_modified"} 1' in (
+        render_metrics()
+    )
+
+
+def test_retry_budget_limits_retries(monkeypatch):
+    """
+    Test that retries stop once the retry budget is spent, so a failing
+    service gets at most one call per request plus the budgeted retries.
+    """
+    monkeypatch.setattr(resilience, "RETRY_BACKOFF_BASE", 0.001)
+
+    async def run():
+        injector = FaultInjector(*[500] * 10)
+        budget = RetryBudget(ratio=0, min_per_second=0, burst=2)
+        breaker = CircuitBreaker("budget-stub", failure_threshold=100)
+        async with injector.client(breaker=breaker, budget=budget) as client:
+            statuses = [(await client.get("/user/1")).status_code for _ in range(3)]
+        return injector, statuses
+
+    injector, statuses = asyncio.run(run())
+    assert statuses == [500, 500, 500]
+    assert injector.calls == 3 + 2
+
+
+def test_circuit_breaker_opens_and_probes():
+    """
+    Test that the circuit breaker opens after repeated failures and then
+    fails fast with a 503, lets a single probe through once the cool-down
+    has passed, and closes when a probe succeeds. The state and trip count
+    are reported on /metrics.
+    """
+
+    async def run():
+        injector = FaultInjector(500, 500, 500)
+        breaker = CircuitBreaker("probe-stub", failure_threshold=2, reset_timeout=0.05)
+        statuses = []
+        async with injector.client("probe-stub", breaker=breaker) as client:
+
+            async def reserve():
+                response = await client.post("/product/reserve", json={"items": []})
+                statuses.append(response.status_code)
+                return response
+
+            await reserve()
+            await reserve()
+            refused = await reserve()
+            calls_while_open = injector.calls
+            await asyncio.sleep(0.06)
+            await reserve()  # The probe fails and the breaker opens again
+            reopened = breaker.state
+            await asyncio.sleep(0.06)
+            await reserve()
+        return injector, statuses, refused, calls_while_open, reopened, breaker
+
+    injector, statuses, refused, calls_while_open, reopened, breaker = asyncio.run(
+        run()
+    )
+    assert statuses == [500, 500, 503, 500, 200]
+    assert calls_while_open == 2
+    assert "circuit open" in refused.json()["detail"]
+    assert "Retry-After" in refused.headers
+    assert reopened == "open"
+    assert breaker.state == "closed"
+    assert injector.calls == 4
+    body = render_metrics()
+    assert 'circuit_breaker_state{service="probe-stub"} 0.0' in body
+    assert 'circuit_breaker_trips_total{service="probe-stub"} 2.0' in body
+
+
+def test_post_order_fails_fast_when_circuit_open(client):
+    """
+    Test that the order endpoint ("/order") answers 503 without calling the
+    product service while the product circuit breaker is open.
+    """
+    injector = FaultInjector(503)
+    breaker = CircuitBreaker("product-stub", failure_threshold=1)
+    product_client = injector.client("product-stub", breaker=breaker)
+    user_client = FaultInjector().client("user-stub")
+    app.dependency_overrides[get_product_client] = lambda: product_client
+    app.dependency_overrides[get_user_client] = lambda: user_client
+    body = {"user_id": 1, "items": [{"product_id": 7, "number": 1}]}
+    try:
+        first = client.post("/order", json=body)
+        second = client.post("/order", json=body)
+    finally:
+        app.dependency_overrides.clear()
+
+    assert first.status_code == 503
+    assert second.status_code == 503
+    assert "circuit open" in second.json()["detail"]
+    assert injector.calls == 1
@@ -2,17 +2,121 @@
 # pylint: disable=W0707
 """
 This module contains utility functions to interact with external services such 
-as validating users and product stock, creating orders, and updating users 
-and products. Functions are asynchronous and use the HTTP client to communicate 
+as validating users, reserving and releasing stock, creating orders, and
+updating users. Functions are asynchronous and use the HTTP client to communicate 
 with external APIs.
 """
+import os
+import asyncio
 import httpx
 from fastapi import HTTPException
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from schemas import OrderRequestSchema, OrderSchema
 from models import OrderItem, Order
+from metrics import timed_call
+from idempotency import store_response
+from outbox import outbox_event
+from resilience import ResilientTransport
+from revalidation import RevalidatingTransport
+
+# Connection pool and timeout settings for the downstream HTTP clients
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "2"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "5"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+# Maximum number of downstream calls in flight at once for one request
+FAN_OUT_LIMIT = int(os.getenv("FAN_OUT_LIMIT", "8"))
+
+
+def http2_available() -> bool:
+    """Return True if the optional h2 package needed for HTTP/2 is installed."""
+    try:
+        import h2  # pylint: disable=C0415,W0611
+    except ImportError:
+        return False
+    return True
+
+
+def create_client(service: str, revalidate: bool = False) -> httpx.AsyncClient:
+    """
+    Creates a pooled HTTP client for one downstream service.
+
+    The client is meant to live as long as the application, so connections
+    are kept alive and reused across orders. HTTP/2 is negotiated when the
+    h2 package is installed and the server supports it. Calls go through a
+    ResilientTransport, which adds per-endpoint timeouts, retries and a
+    circuit breaker for the service. With revalidate, reads also go through a
+    RevalidatingTransport in front of it, which sends If-None-Match for
+    responses it has kept.
+
+    Args:
+        service (str): The downstream service name, e.g. "product".
+        revalidate (bool): Revalidate reads with ETags; only worth it for
+            clients that make reads, such as the user client's GET /user/{id}.
+
+    Returns:
+        httpx.AsyncClient: The configured HTTP client.
+    """
+    transport = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=HTTP2_ENABLED and http2_available(),
+    )
+    transport = ResilientTransport(service, transport)
+    if revalidate:
+        transport = RevalidatingTransport(service, transport)
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    )
+
+
+async def fan_out(calls, limit: int = FAN_OUT_LIMIT):
+    """
+    Runs independent downstream calls concurrently, at most `limit` at a time.
+
+    Every call runs to completion even if another one fails, whatever it
+    raises, so the caller knows which calls succeeded and can compensate for
+    them.
 
+    Args:
+        calls (list): Zero-argument functions returning coroutines.
+        limit (int): Maximum number of calls in flight at once.
 
-async def validate_user(user_id: int, user_service_url: str, client: httpx.AsyncClient):
+    Returns:
+        list: One (result, error) tuple per call, in the order of `calls`.
+        error is the exception raised by the call, or None.
+    """
+    semaphore = asyncio.Semaphore(limit)
+    outcomes = [(None, None)] * len(calls)
+
+    async def run(index, call):
+        async with semaphore:
+            try:
+                outcomes[index] = (await call(), None)
+            except Exception as exc:  # pylint: disable=W0718
+                outcomes[index] = (None, exc)
+
+    async with asyncio.TaskGroup() as group:
+        for index, call in enumerate(calls):
+            group.create_task(run(index, call))
+    return outcomes
+
+
+@timed_call
+async def validate_user(
+    user_id: int,
+    user_service_url: str,
+    client: httpx.AsyncClient,
+    timeout: float = HTTP_TIMEOUT,
+):
     """
     Validates whether a user exists by sending a GET request to the user service.
 
@@ -20,6 +124,7 @@ async def validate_user(user_id: int, user_service_url: str, client: httpx.Async
         user_id (int): The ID of the user to be validated.
         user_service_url (str): The URL of the user service.
         client (httpx.AsyncClient): The HTTP client used to make the request.
+        timeout (float): Timeout in seconds for this call.
 
     Returns:
         dict: The user data if found.
@@ -28,86 +133,99 @@ async def validate_user(user_id: int, user_service_url: str, client: httpx.Async
         HTTPException: If the user is not found or if there is a communication error.
     """
     try:
-        response = await client.get(f"{user_service_url}/{user_id}")
+        response = await client.get(f"{user_service_url}/{user_id}", timeout=timeout)
         response.raise_for_status()
         return response.json()
-    except httpx.HTTPStatusError:
-        raise HTTPException(status_code=404, detail="User not found")
+    except httpx.HTTPStatusError as exc:
+        if exc.response.status_code == 404:
+            raise HTTPException(status_code=404, detail="User not found")
+        raise HTTPException(
+            status_code=exc.response.status_code,
+            detail=error_detail(exc.response, "User"),
+        ) from exc
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=500, detail=f"User service communication error: {str(e)}"
         ) from e  # Re-raise with original exception
 
 
-async def validate_product_stock(
-    request: OrderRequestSchema, product_service_url: str, client: httpx.AsyncClient
+@timed_call
+async def reserve_products(
+    request: OrderRequestSchema,
+    product_service_url: str,
+    client: httpx.AsyncClient,
+    timeout: float = HTTP_TIMEOUT,
+    reservation_id: str = None,
 ):
     """
-    Validates product stock based on the order request.
+    Reserves stock for the order and fetches product prices in one call.
+
+    The product service checks and decrements the stock in a single
+    transaction, so there is no gap between validation and the stock update.
+    A reservation that fails with anything but a 4xx, such as a timeout, may
+    still have been made; release_stock undoes it by its reservation_id.
 
     Args:
         request (OrderRequestSchema): The order request data.
         product_service_url (str): The URL of the product service.
         client (httpx.AsyncClient): The HTTP client used to make the request.
+        timeout (float): Timeout in seconds for this call.
+        reservation_id (str): The ID to reserve under, to release it by.
 
     Returns:
-        list: A list of products with updated stock information.
+        list: The reserved products with order_number and item_total set.
 
     Raises:
-        HTTPException: If there are insufficient stock or communication errors.
+        HTTPException: If the reservation is rejected or there is a communication error.
     """
-    ids = []
     id_num_map = {}
     for item in request.items:
-        if item.product_id in id_num_map:
-            id_num_map[item.product_id] += item.number
-        else:
-            id_num_map[item.product_id] = item.number
-            ids.append(item.product_id)
+        id_num_map[item.product_id] = id_num_map.get(item.product_id, 0) + item.number
 
+    items = [
+        {"product_id": product_id, "number": number}
+        for product_id, number in id_num_map.items()
+    ]
+    body = {"items": items, "reservation_id": reservation_id}
     try:
-        response = await client.post(product_service_url, json={"ids": ids})
-        products = response.json()
-        stock_less_than_order = []
-        for product in products:
-            if product["stock_left"] < id_num_map[product["id"]]:
-                stock_less_than_order.append(
-                    {
-                        "product_name": product["name"],
-                        "ordered_quantity": id_num_map[product["id"]],
-                        "stock_left": product["stock_left"],
-                    }
-                )
-            else:
-                product["order_number"] = id_num_map[product["id"]]
-                product["item_total"] = product["order_number"] * product["price"]
-
-        if stock_less_than_order:
-            error_details = "\n".join(
-                [
-                    f"Product {item['product_name']} - Ordered: {item['ordered_quantity']}"
-                    for item in stock_less_than_order
-                ]
-            )
-            raise HTTPException(
-                status_code=400,
-                detail=f"Some products have insufficient stock:\n{error_details}",
-            )
-
-        return products
-
-    except httpx.HTTPStatusError as e:
-        error_message = await e.response.text()
+        response = await client.post(
+            f"{product_service_url}/reserve", json=body, timeout=timeout
+        )
+        response.raise_for_status()
+    except httpx.HTTPStatusError as exc:
         raise HTTPException(
-            status_code=e.response.status_code,
-            detail=f"Product service error: {error_message}",
-        ) from e  # Re-raise with original exception
-
+            status_code=exc.response.status_code,
+            detail=error_detail(exc.response, "Product"),
+        ) from exc
     except httpx.RequestError as e:
         raise HTTPException(
-            status_code=500, detail=f"User service communication error: {str(e)}"
+            status_code=500, detail=f"Product service communication error: {str(e)}"
         ) from e  # Re-raise with original exception
 
+    products = response.json()
+    for product in products:
+        product["order_number"] = id_num_map[product["id"]]
+        product["item_total"] = product["order_number"] * product["price"]
+    return products
+
+
+def error_detail(response: httpx.Response, service: str) -> str:
+    """
+    Extracts the error detail from a downstream error response.
+
+    Args:
+        response (httpx.Response): The error response.
+        service (str): The name of the service that answered, e.g. "User".
+
+    Returns:
+        str: The FastAPI "detail" field if present, otherwise the response body
+        prefixed with the service name.
+    """
+    try:
+        return response.json()["detail"]
+    except (ValueError, KeyError, TypeError):
+        return f"{service} service error: {response.text}"
+
 
 def generate_order(products, request: OrderRequestSchema):
     """
@@ -135,67 +253,192 @@ def generate_order_items(products, order: OrderSchema):
         order (OrderSchema): The order to which the items belong.
 
     Returns:
-        list: A list of OrderItem objects.
+        list: A list of order item rows, as OrderItem column dicts.
     """
     items = []
     for product in products:
-        item = OrderItem(
-            order_id=order.id,
-            product_id=product["id"],
-            product_num=product["order_number"],
-            price=product["price"],
-            item_total=product["item_total"],
-        )
+        item = {
+            "order_id": order.id,
+            "product_id": product["id"],
+            "product_num": product["order_number"],
+            "price": product["price"],
+            "item_total": product["item_total"],
+        }
         items.append(item)
 
     return items
 
 
-async def product_update(products, product_service_url: str, client: httpx.AsyncClient):
+async def save_order(
+    db: AsyncSession, products, request: OrderRequestSchema, claim: tuple = None
+) -> OrderSchema:
     """
-    Updates the product stock by reducing the stock based on the order quantity.
+    Saves an order, all of its items and its outbox events in one transaction.
+
+    The order is flushed once to get its ID, then every item is written with
+    a single multi-row INSERT ... RETURNING before the one commit, so the
+    number of round trips does not grow with the number of items. The
+    "user_order" outbox event, which adds the order to the user, commits or
+    rolls back together with the order, and so does the response stored for
+    the Idempotency-Key, so a retry never finds the order placed but the key
+    still in progress.
 
     Args:
-        products (list): A list of products to update.
+        db (AsyncSession): The database session.
+        products (list): A list of products with stock details.
+        request (OrderRequestSchema): The order request data.
+        claim (tuple): The (key, claimed_at) of the Idempotency-Key held by
+            the request, if any.
+
+    Returns:
+        OrderSchema: The saved order.
+
+    Raises:
+        HTTPException: 409 if the key was taken over after its lease ran out,
+        in which case nothing is saved.
+    """
+    order = generate_order(products, request)
+    db.add(order)
+    await db.flush()
+
+    items = generate_order_items(products, order)
+    if items:
+        result = await db.execute(
+            insert(OrderItem).values(items).returning(OrderItem.id)
+        )
+        result.all()
+
+    saved = OrderSchema.model_validate(order, from_attributes=True)
+    db.add(outbox_event("user_order", saved.user_id, saved.model_dump()))
+    if claim and not await store_response(db, *claim, 200, saved.model_dump()):
+        await db.rollback()
+        raise HTTPException(
+            status_code=409,
+            detail="The Idempotency-Key was taken over after its lease ran out",
+        )
+    await db.commit()
+    return saved
+
+
+async def list_orders(
+    db: AsyncSession,
+    user_id: int = None,
+    after: int = None,
+    limit: int = 50,
+    include_items: bool = False,
+):
+    """
+    Reads one page of orders in ascending ID order, using keyset pagination.
+
+    Orders come from the (user_id, id) covering index, and with include_items
+    the items of the whole page are loaded with a single query.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): Only list this user's orders.
+        after (int): Only list orders with an ID greater than this one.
+        limit (int): Maximum number of orders in the page.
+        include_items (bool): Attach each order's items.
+
+    Returns:
+        dict: The orders and the next_after cursor, None on the last page.
+    """
+    query = (
+        select(Order.id, Order.user_id, Order.order_total)
+        .order_by(Order.id)
+        .limit(limit + 1)
+    )
+    if user_id is not None:
+        query = query.where(Order.user_id == user_id)
+    if after is not None:
+        query = query.where(Order.id > after)
+    rows = (await db.execute(query)).mappings().all()
+    orders = [dict(row) for row in rows[:limit]]
+    next_after = orders[-1]["id"] if len(rows) > limit else None
+
+    if include_items and orders:
+        items = {order["id"]: [] for order in orders}
+        result = await db.execute(
+            select(OrderItem)
+            .where(OrderItem.order_id.in_(list(items)))
+            .order_by(OrderItem.order_id, OrderItem.id)
+        )
+        for item in result.scalars():
+            items[item.order_id].append(item)
+        for order in orders:
+            order["items"] = items[order["id"]]
+    return {"orders": orders, "next_after": next_after}
+
+
+@timed_call
+async def release_stock(
+    reservation_id: str,
+    product_service_url: str,
+    client: httpx.AsyncClient,
+    timeout: float = HTTP_TIMEOUT,
+):
+    """
+    Gives back the stock of a reservation when an order cannot be completed.
+
+    The product service gives the stock back once however often this is
+    called, and refuses the reservation if it has not arrived yet.
+
+    Args:
+        reservation_id (str): The ID the stock was reserved under.
         product_service_url (str): The URL of the product service.
         client (httpx.AsyncClient): The HTTP client used to make the request.
+        timeout (float): Timeout in seconds for this call.
 
     Raises:
-        HTTPException: If there is a communication error.
+        HTTPException: If the release is rejected or there is a communication error.
     """
-    for product in products:
-        try:
-            response = await client.put(
-                f"{product_service_url}/{product['id']}",
-                json={"add_amount": -product["order_number"]},
-            )
-            response.raise_for_status()
-        except httpx.HTTPStatusError as exc:
-            raise HTTPException(status_code=404, detail="Product not found") from exc
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=500, detail=f"Product service communication error: {str(e)}"
-            ) from e  # Re-raise with original exception
-
-
-async def user_update(order: Order, user_service_url: str, client: httpx.AsyncClient):
+    try:
+        response = await client.post(
+            f"{product_service_url}/reserve/{reservation_id}/release", timeout=timeout
+        )
+        response.raise_for_status()
+    except httpx.HTTPStatusError as exc:
+        raise HTTPException(
+            status_code=exc.response.status_code,
+            detail=error_detail(exc.response, "Product"),
+        ) from exc
+    except httpx.RequestError as e:
+        raise HTTPException(
+            status_code=500, detail=f"Product service communication error: {str(e)}"
+        ) from e  # Re-raise with original exception
+
+
+@timed_call
+async def user_update(
+    order: OrderSchema,
+    user_service_url: str,
+    client: httpx.AsyncClient,
+    timeout: float = HTTP_TIMEOUT,
+):
     """
     Updates the user with the new order ID.
 
     Args:
-        order (Order): The order to update the user with.
+        order (OrderSchema): The order to update the user with.
         user_service_url (str): The URL of the user service.
         client (httpx.AsyncClient): The HTTP client used to make the request.
+        timeout (float): Timeout in seconds for this call.
 
     Raises:
-        HTTPException: If there is a communication error.
+        HTTPException: If the update is rejected or there is a communication error.
     """
     try:
-        await client.put(
-            f"{user_service_url}/{order.user_id}", json={"order_id": order.id}
+        response = await client.put(
+            f"{user_service_url}/{order.user_id}",
+            json={"order_id": order.id},
+            timeout=timeout,
         )
+        response.raise_for_status()
     except httpx.HTTPStatusError as exc:
-        raise HTTPException(status_code=404, detail="User not found") from exc
+        raise HTTPException(
+            status_code=exc.response.status_code,
+            detail=error_detail(exc.response, "User"),
+        ) from exc
     except httpx.RequestError as e:
         raise HTTPException(
             status_code=500, detail=f"User service communication error: {str(e)}"
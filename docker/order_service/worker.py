@@ -0,0 +1,41 @@
+"""
+Outbox worker for the order service.
+
+Delivers outbox events outside the API process, for deployments that run the
+dispatcher as its own pod and set OUTBOX_DISPATCHER=false on the API pods.
+Any number of workers and API replicas can dispatch at once; events are
+leased, so each one is delivered by one of them at a time.
+
+Usage:
+    ENV=local python worker.py
+"""
+
+import asyncio
+import logging
+
+from database import Async_Order_Session, dispose_engines, init_engines
+from main import outbox_handlers
+from outbox import dispatch_forever
+from utils import create_client
+
+
+async def run():
+    """Dispatch outbox events until interrupted."""
+    init_engines()
+    user_client = create_client("user")
+    product_client = create_client("product")
+    try:
+        await dispatch_forever(
+            Async_Order_Session,
+            outbox_handlers(user_client, product_client),
+            asyncio.Event(),
+        )
+    finally:
+        await user_client.aclose()
+        await product_client.aclose()
+        await dispose_engines()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
@@ -0,0 +1,125 @@
+"""
+Benchmark for POST /product/import against creating products one at a time.
+
+It sends requests to the product service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network. The
+import body is a generated CSV streamed in 64 KiB chunks, and the import runs
+for two file sizes to show that peak memory does not grow with the file. The
+"single" mode creates a sample of products with POST /product for comparison.
+Products written by the benchmark are deleted afterwards.
+
+Usage:
+    ENV=local python bench_product_import.py --rows 100000 1000000 --single 2000
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+
+import httpx
+from sqlalchemy import delete
+
+import models
+from database import Async_Product_Session, dispose_engines
+from main import app, lifespan
+
+BENCH_NAME = "bench-import"
+BODY_CHUNK = 64 * 1024
+
+
+async def csv_body(rows: int):
+    """Yield a CSV file of rows products in BODY_CHUNK sized pieces."""
+    buffer = ["name,price,stock_left\n"]
+    size = 0
+    for i in range(rows):
+        line = f"{BENCH_NAME} {i},{i % 1000 + 1},{i % 50}\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= BODY_CHUNK:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    yield "".join(buffer).encode()
+
+
+def max_rss_mb() -> float:
+    """Return the peak resident set size of this process in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_import(client, rows: int) -> dict:
+    """Import rows products in one request."""
+    start = time.perf_counter()
+    response = await client.post(
+        "/product/import",
+        content=csv_body(rows),
+        headers={"content-type": "text/csv"},
+    )
+    response.raise_for_status()
+    seconds = time.perf_counter() - start
+    return {
+        "mode": "import",
+        "rows": rows,
+        "inserted": response.json()["inserted"],
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 1),
+        "max_rss_mb": round(max_rss_mb(), 1),
+    }
+
+
+async def run_single(client, rows: int) -> dict:
+    """Create rows products with one POST /product request each."""
+    start = time.perf_counter()
+    for i in range(rows):
+        response = await client.post(
+            "/product", json={"name": f"{BENCH_NAME} {i}", "price": 1, "stock_left": 1}
+        )
+        response.raise_for_status()
+    seconds = time.perf_counter() - start
+    return {
+        "mode": "single",
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds, 1),
+    }
+
+
+async def cleanup():
+    """Delete the products written by the benchmark."""
+    async with Async_Product_Session() as db:
+        await db.execute(
+            delete(models.Product)
+            .where(models.Product.name.like(f"{BENCH_NAME} %"))
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+async def run_all(sizes, single: int) -> list:
+    """Run the single mode and an import of every size, cleaning up after each."""
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with lifespan(app), httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as client:
+        results.append(await run_single(client, single))
+        await cleanup()
+        for rows in sizes:
+            results.append(await run_import(client, rows))
+            await cleanup()
+    await dispose_engines()
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--single", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_all(args.rows, args.single)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Benchmark for GET /products on a seeded catalog.
+
+It seeds the products table with a generated catalog, one million rows by
+default, in a single INSERT ... SELECT, vacuums and analyzes it, and sends a mix of
+typical searches to the product service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network.
+Product names look like "brand42 compact red lamp sku123": brands follow a
+long tail, so a few are common and most are rare, like a real catalog. Every
+request picks new random words, prices and cursors. The p50 and p95 latency
+of each kind of search are reported, and the run fails if a p95 is above the
+budget, 10 ms by default. Seeded products are deleted afterwards.
+
+Usage:
+    ENV=local python bench_product_search.py --rows 1000000 --requests 300
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+
+import httpx
+from sqlalchemy import delete, func, select, text
+
+import models
+from database import Async_Product_Session, dispose_engines, get_engine
+from main import app, lifespan
+from migrate import migrate
+
+BRANDS = 5000
+ADJECTIVES = (
+    "classic modern rustic compact deluxe vintage sleek sturdy portable premium "
+    "eco smart mini ultra pro lite heavy soft bright quiet"
+).split()
+COLORS = (
+    "red blue green black white grey orange yellow purple pink brown navy teal "
+    "olive silver"
+).split()
+NOUNS = (
+    "chair table lamp desk sofa shelf mirror rug clock vase bed stool bench "
+    "cabinet dresser kettle toaster blender speaker headphones backpack wallet "
+    "jacket shoes watch camera phone tablet monitor keyboard"
+).split()
+
+
+def words_sql(words: list) -> str:
+    """Return a SQL expression picking one of words at random."""
+    quoted = ",".join(f"'{word}'" for word in words)
+    return f"(ARRAY[{quoted}])[1 + floor(random() * {len(words)})::int]"
+
+
+SEED = text(
+    "INSERT INTO products (name, price, stock_left) "
+    f"SELECT 'brand' || floor(exp(random() * ln({BRANDS})))::int "
+    f"|| ' ' || {words_sql(ADJECTIVES)} || ' ' || {words_sql(COLORS)} "
+    f"|| ' ' || {words_sql(NOUNS)} || ' sku' || g, "
+    "1 + floor(random() * 1000)::int, "
+    "CASE WHEN random() < 0.1 THEN 0 ELSE floor(random() * 500)::int END "
+    "FROM generate_series(1, :rows) AS g"
+)
+
+
+def brand() -> str:
+    """Return a brand, common ones more often, as in the seeded catalog."""
+    return f"brand{int(BRANDS ** random.random())}"
+
+
+def price_range(width: int) -> dict:
+    """Return a random price range of the given width."""
+    low = random.randint(1, 1000 - width)
+    return {"min_price": low, "max_price": low + width}
+
+
+def searches(first_id: int, rows: int) -> dict:
+    """Return the kinds of search to time, each making random parameters."""
+    return {
+        "word": lambda: {"q": random.choice(NOUNS)},
+        "two_words": lambda: {"q": f"{random.choice(COLORS)} {random.choice(NOUNS)}"},
+        "brand": lambda: {"q": brand()},
+        "brand_word_price_in_stock": lambda: {
+            "q": f"{brand()} {random.choice(NOUNS)}",
+            "in_stock": True,
+            **price_range(400),
+        },
+        "price_range_in_stock": lambda: {"in_stock": True, **price_range(10)},
+        "next_page": lambda: {
+            "q": random.choice(ADJECTIVES),
+            "after": first_id + random.randrange(rows),
+        },
+        "sku": lambda: {"q": f"sku{random.randint(1, rows)}"},
+        "no_match": lambda: {"q": "nosuchword"},
+    }
+
+
+def vacuum_analyze():
+    """Vacuum and analyze the products table, outside of a transaction."""
+    with get_engine().connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text("VACUUM ANALYZE products")
+        )
+
+
+async def seed(rows: int) -> int:
+    """Insert rows generated products and return the ID before the first."""
+    async with Async_Product_Session() as db:
+        first_id = await db.scalar(
+            select(func.coalesce(func.max(models.Product.id), 0))
+        )
+        await db.execute(text("SELECT setseed(0.42)"))
+        await db.execute(SEED, {"rows": rows})
+        await db.commit()
+    # As autovacuum would: merge the new rows into the GIN index rather than
+    # leaving them in its pending list, and gather the word statistics the
+    # planner needs
+    await asyncio.to_thread(vacuum_analyze)
+    return first_id
+
+
+async def cleanup(first_id: int):
+    """Delete the seeded products."""
+    async with Async_Product_Session() as db:
+        await db.execute(
+            delete(models.Product)
+            .where(models.Product.id > first_id)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+async def time_search(
+    client, name: str, params, requests: int, budget_ms: float
+) -> dict:
+    """Send requests searches of one kind and return their latency."""
+    latencies, found = [], 0
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = await client.get("/products", params=params())
+        latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+        found += len(response.json()["products"])
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    return {
+        "search": name,
+        "requests": requests,
+        "avg_products": round(found / requests, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(p95, 2),
+        "within_budget": p95 <= budget_ms,
+    }
+
+
+async def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--budget-ms", type=float, default=10.0)
+    args = parser.parse_args()
+    random.seed(42)
+
+    async with lifespan(app):
+        await asyncio.to_thread(migrate, get_engine())
+        start = time.perf_counter()
+        first_id = await seed(args.rows)
+        seed_seconds = time.perf_counter() - start
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench"
+            ) as client:
+                results = [
+                    await time_search(
+                        client, name, params, args.requests, args.budget_ms
+                    )
+                    for name, params in searches(first_id, args.rows).items()
+                ]
+        finally:
+            await cleanup(first_id)
+    await dispose_engines()
+
+    print(
+        json.dumps(
+            {
+                "rows": args.rows,
+                "seed_seconds": round(seed_seconds, 1),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+    if not all(result["within_budget"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
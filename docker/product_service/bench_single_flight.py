@@ -0,0 +1,125 @@
+"""
+Benchmark for a burst of identical product reads, with and without single-flight.
+
+It sends requests to the product service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network. Each
+round empties the cache for a few hot products, 10 by default, and sends 1000
+concurrent requests for them at once, GET /product/{id} and POST
+/product/getlist for pairs of them, like the burst that follows a cache flush
+or a deploy. The database queries are counted with the
+db_query_duration_seconds metric. The queries, the coalesced requests and
+the latency are reported per mode. The benchmark products are deleted
+afterwards.
+
+Usage:
+    ENV=local python bench_single_flight.py --requests 1000 --keys 10
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from bench_stock_shards import cleanup
+from database import dispose_engines, get_engine
+from main import app, lifespan
+from metrics import DB_QUERY_SECONDS
+from migrate import migrate
+
+BENCH_NAME = "bench-single-flight"
+
+
+def queries() -> int:
+    """Return the number of database queries run so far."""
+    return sum(sum(state[0]) for state in DB_QUERY_SECONDS.values.values())
+
+
+async def timed(request, latencies: list):
+    """Await the request, recording its latency."""
+    start = time.perf_counter()
+    response = await request
+    response.raise_for_status()
+    latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_round(client, product_ids: list, requests: int, latencies: list):
+    """Empty the cache for the products and read them with a burst of requests."""
+    await app.state.cache.delete_many(product_ids)
+    keys = len(product_ids)
+    bursts = []
+    for number in range(requests):
+        if number % 2:
+            pair = [product_ids[number % keys], product_ids[(number + 1) % keys]]
+            request = client.post("/product/getlist", json={"ids": pair})
+        else:
+            request = client.get(f"/product/{product_ids[number % keys]}")
+        bursts.append(timed(request, latencies))
+    await asyncio.gather(*bursts)
+
+
+async def run_mode(client, enabled: bool, product_ids: list, args) -> dict:
+    """Run the rounds with single-flight on or off."""
+    reads = app.state.reads
+    reads.enabled = enabled
+    coalesced, start_queries = reads.coalesced, queries()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        await run_round(client, product_ids, args.requests, latencies)
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "single_flight": enabled,
+        "requests": len(latencies),
+        "db_queries": queries() - start_queries,
+        "coalesced": reads.coalesced - coalesced,
+        "seconds": round(seconds, 2),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+    }
+
+
+async def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=1000, help="per round")
+    parser.add_argument("--keys", type=int, default=10, help="hot products")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    async with lifespan(app):
+        await asyncio.to_thread(migrate, get_engine())
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://bench", timeout=None
+            ) as client:
+                product_ids = [
+                    (
+                        await client.post(
+                            "/product",
+                            json={"name": BENCH_NAME, "price": 1, "stock_left": 1},
+                        )
+                    ).json()["id"]
+                    for _ in range(args.keys)
+                ]
+                results = [
+                    await run_mode(client, enabled, product_ids, args)
+                    for enabled in (False, True)
+                ]
+        finally:
+            await cleanup(BENCH_NAME)
+    await dispose_engines()
+
+    print(
+        json.dumps(
+            {"keys": args.keys, "rounds": args.rounds, "results": results}, indent=2
+        )
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
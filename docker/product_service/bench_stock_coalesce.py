@@ -0,0 +1,143 @@
+"""
+Benchmark for concurrent PUT /product/{id} stock updates, with and without
+the coalescer.
+
+It sends requests to the product service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network. A
+crowd of clients, 200 by default, each take one item of a few hot products
+several times, one update after the other, first with every update in its
+own transaction and then with the coalescer batching them over each window.
+The throughput, the latency, the number of transactions and the items taken
+are reported per mode, and the stock left is checked against the updates
+made. The benchmark products are deleted afterwards.
+
+Every commit waits for its WAL flush and every statement for a round trip,
+so the app reaches Postgres through the latency proxy of bench_stock_shards,
+delaying each packet by half of --rtt-ms each way; --rtt-ms 0 connects
+directly.
+
+Usage:
+    DB_POOL_SIZE=50 ENV=local python bench_stock_coalesce.py --clients 200 --rtt-ms 1
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import httpx
+
+from bench_stock_shards import cleanup, database_rtt
+from coalesce import StockCoalescer
+from database import DB_MAX_OVERFLOW, DB_POOL_SIZE, dispose_engines, get_engine
+from main import app, lifespan
+from migrate import migrate
+
+BENCH_NAME = "bench-stock-coalesce"
+
+
+async def client_updates(client, product_id: int, updates: int, latencies: list):
+    """Take one item of the product updates times, one after the other."""
+    for _ in range(updates):
+        start = time.perf_counter()
+        response = await client.put(f"/product/{product_id}", json={"add_amount": -1})
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_mode(client, window_ms: float, args) -> dict:
+    """Make clients * updates stock updates with the given coalescing window."""
+    stock = args.clients * args.updates
+    product_ids = []
+    for _ in range(args.products):
+        response = await client.post(
+            "/product", json={"name": BENCH_NAME, "price": 1, "stock_left": stock}
+        )
+        product_ids.append(response.json()["id"])
+    coalescer = None
+    if window_ms:
+        coalescer = StockCoalescer(app.state.cache, window_ms=window_ms)
+    app.state.stock_coalescer = coalescer
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            client_updates(
+                client, product_ids[number % args.products], args.updates, latencies
+            )
+            for number in range(args.clients)
+        )
+    )
+    seconds = time.perf_counter() - start
+    if coalescer:
+        await coalescer.close()
+
+    response = await client.post("/product/getlist", json={"ids": product_ids})
+    taken = sum(stock - product["stock_left"] for product in response.json())
+    assert taken == len(latencies), (taken, len(latencies))
+    latencies.sort()
+    transactions = coalescer.batches if coalescer else len(latencies)
+    return {
+        "window_ms": window_ms,
+        "updates": len(latencies),
+        "transactions": transactions,
+        "avg_batch": round(len(latencies) / transactions, 1),
+        "seconds": round(seconds, 2),
+        "updates_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+    }
+
+
+async def run_all(args) -> list:
+    """Run every mode, cleaning up after each."""
+    results = []
+    async with database_rtt(args.rtt_ms):
+        async with lifespan(app):
+            await asyncio.to_thread(migrate, get_engine())
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://bench"
+            ) as client:
+                for window_ms in args.windows:
+                    try:
+                        results.append(await run_mode(client, window_ms, args))
+                    finally:
+                        await cleanup(BENCH_NAME)
+        await dispose_engines()
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=10, help="updates per client")
+    parser.add_argument("--products", type=int, default=4, help="hot products")
+    parser.add_argument(
+        "--windows",
+        type=float,
+        nargs="+",
+        default=[0, 1, 2, 5],
+        help="coalescing windows in ms, 0 for one transaction per update",
+    )
+    parser.add_argument("--rtt-ms", type=float, default=1.0)
+    args = parser.parse_args()
+    results = asyncio.run(run_all(args))
+    print(
+        json.dumps(
+            {
+                "pool": DB_POOL_SIZE + DB_MAX_OVERFLOW,
+                "rtt_ms": args.rtt_ms,
+                "clients": args.clients,
+                "products": args.products,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
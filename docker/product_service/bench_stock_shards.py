@@ -0,0 +1,200 @@
+"""
+Benchmark for concurrent orders of one product, with and without sharded stock.
+
+It sends requests to the product service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network. A
+crowd of buyers, 500 by default, all reserve one item of the same product at
+once with POST /product/reserve, several times each, first with the stock on
+the product row and then with it split over each number of shards. The
+throughput, the latency and the number of items sold are reported per mode,
+and the stock left is checked against the items sold. The benchmark product
+is deleted afterwards.
+
+A transaction holds its row locks across its round trips to the database, so
+the cost of one hot row depends on the network. The app reaches Postgres
+through a local TCP proxy that delays every packet by half of --rtt-ms each
+way, like the network between a pod and RDS; --rtt-ms 0 connects directly.
+Transactions only overlap up to the size of the connection pool, so raise it
+to let the buyers contend as they would across several pods.
+
+Usage:
+    DB_POOL_SIZE=50 ENV=local python bench_stock_shards.py --buyers 500 --rtt-ms 1
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from sqlalchemy import delete
+from sqlalchemy.engine import make_url
+
+import database
+import models
+from database import DB_MAX_OVERFLOW, DB_POOL_SIZE, Async_Product_Session
+from database import database_url, dispose_engines, get_engine
+from main import app, lifespan
+from migrate import migrate
+
+BENCH_NAME = "bench-stock-shards"
+
+
+async def forward(reader, writer, delay: float):
+    """Copy bytes from reader to writer, each chunk delay seconds late."""
+    queue = asyncio.Queue()
+
+    async def deliver():
+        while (item := await queue.get()) is not None:
+            due, data = item
+            await asyncio.sleep(due - time.perf_counter())
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    delivery = asyncio.create_task(deliver())
+    while data := await reader.read(65536):
+        queue.put_nowait((time.perf_counter() + delay, data))
+    queue.put_nowait(None)
+    await delivery
+
+
+async def start_proxy(host: str, port: int, rtt_ms: float):
+    """Start a TCP proxy to host:port adding rtt_ms of round-trip latency."""
+    delay = rtt_ms / 2000
+
+    async def connect(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(host, port)
+        await asyncio.gather(
+            forward(client_reader, server_writer, delay),
+            forward(server_reader, client_writer, delay),
+            return_exceptions=True,
+        )
+
+    return await asyncio.start_server(connect, "127.0.0.1", 0)
+
+
+@asynccontextmanager
+async def database_rtt(rtt_ms: float):
+    """
+    Route the engines created inside the block through a proxy adding rtt_ms
+    of round-trip latency; with 0, connect directly.
+    """
+    if not rtt_ms:
+        yield
+        return
+    url = make_url(database_url())
+    proxy = await start_proxy(url.host, url.port or 5432, rtt_ms)
+    proxied = url.set(host="127.0.0.1", port=proxy.sockets[0].getsockname()[1])
+    # The engines are created by the lifespan, from this URL
+    database.DATABASE_URLS[database.ENV] = proxied.render_as_string(hide_password=False)
+    try:
+        yield
+    finally:
+        proxy.close()
+        await proxy.wait_closed()
+
+
+async def buyer(client, product_id: int, orders: int, latencies: list):
+    """Reserve one item orders times, one order after the other."""
+    for _ in range(orders):
+        start = time.perf_counter()
+        response = await client.post(
+            "/product/reserve",
+            json={"items": [{"product_id": product_id, "number": 1}]},
+        )
+        response.raise_for_status()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def run_mode(client, shards: int, buyers: int, orders: int) -> dict:
+    """Sell buyers * orders items of a new product with the given shards."""
+    stock = buyers * orders * 2
+    response = await client.post(
+        "/product", json={"name": BENCH_NAME, "price": 1, "stock_left": stock}
+    )
+    product_id = response.json()["id"]
+    if shards:
+        response = await client.put(
+            f"/product/{product_id}/shards", json={"shards": shards}
+        )
+        response.raise_for_status()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(buyer(client, product_id, orders, latencies) for _ in range(buyers))
+    )
+    seconds = time.perf_counter() - start
+
+    # Back to one row, which also checks that the shards add up
+    response = await client.put(f"/product/{product_id}/shards", json={"shards": 0})
+    stock_left = response.json()["stock_left"]
+    assert stock_left == stock - len(latencies), (stock_left, len(latencies))
+    latencies.sort()
+    return {
+        "shards": shards,
+        "buyers": buyers,
+        "orders": len(latencies),
+        "seconds": round(seconds, 2),
+        "orders_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1),
+    }
+
+
+async def cleanup(name: str = BENCH_NAME):
+    """Delete the benchmark products, and their shards with them."""
+    async with Async_Product_Session() as db:
+        await db.execute(
+            delete(models.Product)
+            .where(models.Product.name == name)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+
+
+async def run_all(shard_counts, buyers: int, orders: int, rtt_ms: float) -> list:
+    """Run every mode, cleaning up after each."""
+    results = []
+    async with database_rtt(rtt_ms):
+        async with lifespan(app), httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://bench",
+            timeout=None,
+        ) as client:
+            await asyncio.to_thread(migrate, get_engine())
+            for shards in shard_counts:
+                try:
+                    results.append(await run_mode(client, shards, buyers, orders))
+                finally:
+                    await cleanup()
+        await dispose_engines()
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--buyers", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=4, help="orders per buyer")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 4, 16])
+    parser.add_argument("--rtt-ms", type=float, default=1.0)
+    args = parser.parse_args()
+    results = asyncio.run(run_all(args.shards, args.buyers, args.orders, args.rtt_ms))
+    print(
+        json.dumps(
+            {
+                "pool": DB_POOL_SIZE + DB_MAX_OVERFLOW,
+                "rtt_ms": args.rtt_ms,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# cache.py
+"""
+This module contains the read-through cache for product reads.
+It provides an in-process LRU cache with a TTL and an optional backend for any
+server speaking the Redis protocol. Entries are product dicts keyed by product ID,
+and writes update the cached entry, so a product read from one pod is at most
+CACHE_TTL seconds older than a write made through another pod.
+"""
+
+import os
+import json
+import time
+from collections import OrderedDict
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "5"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+class LRUCache:
+    """
+    In-process LRU cache whose entries expire after a TTL.
+
+    Attributes:
+        hits (int): Number of keys found in the cache.
+        misses (int): Number of keys missing or expired.
+        evictions (int): Number of entries dropped to stay under max_entries.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get_many(self, keys) -> dict:
+        """Return the cached values for the keys that are present and fresh."""
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                continue
+            self.entries.move_to_end(key)
+            found[key] = entry[1]
+            self.hits += 1
+        return found
+
+    async def set_many(self, values: dict):
+        """Store the values, evicting the least recently used entries if full."""
+        expires = time.monotonic() + self.ttl
+        for key, value in values.items():
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete_many(self, keys):
+        """Drop the entries for the keys."""
+        for key in keys:
+            self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counters."""
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+        }
+
+    async def close(self):
+        """Nothing to release for the in-process cache."""
+
+
+class RedisCache:
+    """
+    Cache stored in a server speaking the Redis protocol.
+
+    The client only needs async mget and delete, and a pipeline queueing set
+    (with px) calls, so tests can pass a local stand-in instead of a real
+    redis.asyncio client. Evictions are done by the server and are not counted
+    here.
+    """
+
+    backend = "redis"
+
+    def __init__(self, client, ttl: float = CACHE_TTL, prefix: str = "product:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get_many(self, keys) -> dict:
+        """Return the cached values for the keys that are present."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        raw_values = await self.client.mget([f"{self.prefix}{key}" for key in keys])
+        found = {}
+        for key, raw in zip(keys, raw_values):
+            if raw is None:
+                self.misses += 1
+                continue
+            found[key] = json.loads(raw)
+            self.hits += 1
+        return found
+
+    async def set_many(self, values: dict):
+        """Store the values with the TTL, in one round trip."""
+        if not values:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(f"{self.prefix}{key}", json.dumps(value), px=int(self.ttl * 1000))
+        await pipe.execute()
+
+    async def delete_many(self, keys):
+        """Drop the entries for the keys."""
+        keys = [f"{self.prefix}{key}" for key in keys]
+        if keys:
+            await self.client.delete(*keys)
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counters."""
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    async def close(self):
+        """Close the client connection if it supports it."""
+        if hasattr(self.client, "aclose"):
+            await self.client.aclose()
+
+
+def create_cache():
+    """
+    Creates the product cache selected by the CACHE_BACKEND environment variable.
+
+    Returns:
+        LRUCache | RedisCache: The cache backend.
+
+    Raises:
+        ValueError: If the backend is unknown.
+        RuntimeError: If the redis backend is selected but redis is not installed.
+    """
+    if CACHE_BACKEND == "memory":
+        return LRUCache()
+    if CACHE_BACKEND == "redis":
+        try:
+            from redis import asyncio as redis  # pylint: disable=C0415
+        except ImportError as e:
+            raise RuntimeError(
+                "CACHE_BACKEND=redis requires the redis package to be installed"
+            ) from e
+        return RedisCache(redis.from_url(REDIS_URL))
+    raise ValueError(f"Invalid cache backend '{CACHE_BACKEND}'.")
@@ -0,0 +1,161 @@
+# coalesce.py
+"""
+This module contains the group commit stage for single product stock updates.
+Concurrent PUT /product/{id} requests are queued for a short window, at most
+STOCK_COALESCE_WINDOW_MS, or until STOCK_COALESCE_MAX_BATCH are waiting, and
+then applied together in one transaction with one commit. Each caller still
+gets its own result, as if the updates had run one after the other in the
+order they arrived. A window of 0 turns coalescing off.
+"""
+
+import os
+import asyncio
+import contextvars
+from fastapi import HTTPException
+from database import Async_Product_Session
+from metrics import Histogram
+from utils import apply_stock_changes_in_order
+
+STOCK_COALESCE_WINDOW_MS = float(os.getenv("STOCK_COALESCE_WINDOW_MS", "2"))
+STOCK_COALESCE_MAX_BATCH = int(os.getenv("STOCK_COALESCE_MAX_BATCH", "128"))
+
+BATCH_SIZE = Histogram(
+    "product_stock_coalesce_batch_size",
+    "Stock updates applied per coalesced transaction.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+
+class StockCoalescer:  # pylint: disable=R0902
+    """
+    Batches concurrent stock updates into one transaction per window.
+
+    The window starts with the first update queued, so no update waits more
+    than the window before its batch is started. Batches run as separate
+    tasks and may overlap; batches touching the same products queue on
+    their row locks. An update whose caller has gone away before its batch
+    starts is dropped; once the batch has started it is applied regardless.
+
+    Attributes:
+        batches (int): Number of transactions run.
+        updates (int): Number of stock updates applied in them.
+    """
+
+    def __init__(
+        self,
+        cache,
+        window_ms: float = STOCK_COALESCE_WINDOW_MS,
+        max_batch: int = STOCK_COALESCE_MAX_BATCH,
+    ):
+        self.cache = cache
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+        self.running = set()
+        self.batches = 0
+        self.updates = 0
+
+    async def update_stock(self, product_id: int, delta: int) -> dict:
+        """
+        Queues a stock change and waits for the batch it is applied in.
+
+        Args:
+            product_id (int): The product ID.
+            delta (int): The stock change.
+
+        Returns:
+            dict: The product, with the stock left after this change.
+
+        Raises:
+            HTTPException: 404 if the product does not exist, 400 if stock is
+                not enough.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((product_id, delta, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """Start a batch with the queued updates."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = [update for update in self.pending if not update[2].done()]
+        self.pending = []
+        if not batch:
+            return
+        # In a context of its own, so the batch's database time is not added
+        # to the request that happened to start the window
+        task = asyncio.create_task(self.run_batch(batch), context=contextvars.Context())
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def run_batch(self, batch: list):
+        """Apply a batch in one transaction and hand each caller its result."""
+        try:
+            async with Async_Product_Session() as db:
+                outcomes = await apply_stock_changes_in_order(
+                    db, [(product_id, delta) for product_id, delta, _ in batch]
+                )
+                await db.commit()
+        except Exception as e:  # pylint: disable=W0718
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.updates += len(batch)
+        BATCH_SIZE.observe(len(batch))
+        # The last outcome of each product is its stock after the batch
+        products = {
+            outcome["id"]: outcome
+            for outcome in outcomes
+            if not isinstance(outcome, HTTPException)
+        }
+        try:
+            await self.cache.set_many(products)
+        finally:
+            for (_, _, future), outcome in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if isinstance(outcome, HTTPException):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+
+    def stats(self) -> dict:
+        """Return the batch counters."""
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "updates": self.updates,
+            "pending": len(self.pending),
+        }
+
+    async def close(self):
+        """Apply the queued updates and wait for the running batches."""
+        self.flush()
+        if self.running:
+            await asyncio.gather(*self.running, return_exceptions=True)
+
+
+def create_coalescer(cache):
+    """
+    Creates the stock update coalescer, unless STOCK_COALESCE_WINDOW_MS is 0.
+
+    Args:
+        cache (LRUCache | RedisCache): The product cache, updated after each batch.
+
+    Returns:
+        StockCoalescer | None: The coalescer, or None if coalescing is off.
+    """
+    if STOCK_COALESCE_WINDOW_MS <= 0:
+        return None
+    return StockCoalescer(cache)
@@ -2,24 +2,152 @@
 """This module provides product related APIs for product creation and retrieval."""
 
 
+import asyncio
 import logging
-from sqlalchemy.orm import Session
-from fastapi import FastAPI, Depends, HTTPException
+from contextlib import asynccontextmanager
+from typing import Annotated, Literal
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 import models
-from database import engine, get_db
+from cache import create_cache
+from coalesce import create_coalescer
+from database import Async_Product_Session, dispose_engines, get_db, get_engine
+from database import init_engines, pool_status
+from metrics import MetricsMiddleware, render_metrics
+from migrate import HEAD, MIGRATE_ON_STARTUP, current_version, migrate
+from product_import import import_products
+from reservations import check_recorded, record_reservation, release_reservation
+from reservations import purge_expired_reservations_forever
 from schemas import (
+    PRODUCT_LIST_ADAPTER,
+    PRODUCT_PAGE_ADAPTER,
     ProductCreateSchema,
+    ProductPageSchema,
     ProductSchema,
     ProductStockUpdateSchema,
+    ProductBulkStockUpdateSchema,
     ProductRequireSchema,
+    ProductReserveSchema,
+    ProductImportResultSchema,
+    ProductSearchSchema,
+    ProductShardsSchema,
+)
+from serialization import adapter_response, default_response_class
+from serialization import etag_matches, not_modified
+from singleflight import SingleFlight
+from utils import (
+    apply_stock_deltas,
+    merge_stock_deltas,
+    reserve_stock,
+    cache_entries,
+    list_etag,
+    read_etags,
+    read_products,
+    search_products,
+    set_stock_shards,
 )
 
+logging.basicConfig(level=logging.INFO)
 
-models.Base.metadata.create_all(engine)
 
-logging.basicConfig(level=logging.INFO)
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI):
+    """
+    Create the database engines, the product cache, the single-flight layer
+    for reads and the stock update coalescer for the app lifetime, and delete
+    expired stock reservations in the background.
+    """
+    init_engines()
+    if MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrate, get_engine())
+    fastapi_app.state.cache = create_cache()
+    fastapi_app.state.reads = SingleFlight()
+    fastapi_app.state.stock_coalescer = create_coalescer(fastapi_app.state.cache)
+    cleanup = asyncio.create_task(
+        purge_expired_reservations_forever(Async_Product_Session)
+    )
+    try:
+        yield
+    finally:
+        cleanup.cancel()
+        if fastapi_app.state.stock_coalescer:
+            await fastapi_app.state.stock_coalescer.close()
+        await fastapi_app.state.cache.close()
+        await dispose_engines()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=default_response_class())
+app.add_middleware(MetricsMiddleware)
+
+
+def get_cache(http_request: Request):
+    """Dependency returning the product cache."""
+    return http_request.app.state.cache
+
+
+def get_reads(http_request: Request):
+    """Dependency returning the single-flight layer for reads."""
+    return http_request.app.state.reads
+
+
+async def load_products(cache, ids) -> dict:
+    """
+    Reads products from the database, in a session of their own, and caches them.
+
+    Args:
+        cache (LRUCache | RedisCache): The product cache.
+        ids (list): The product IDs.
+
+    Returns:
+        dict: The product dict for each product ID found.
+    """
+    async with Async_Product_Session() as db:
+        loaded = cache_entries(await read_products(db, ids))
+    await cache.set_many(loaded)
+    return loaded
+
+
+async def current_etags(ids) -> dict:
+    """
+    Reads the current ETags of products, in a session of their own.
+
+    Args:
+        ids (list): The product IDs.
+
+    Returns:
+        dict: The ETag of each product ID found.
+    """
+    async with Async_Product_Session() as db:
+        return await read_etags(db, ids)
+
+
+async def cached_products(cache, ids, etags=None) -> dict:
+    """
+    Reads products from the cache, leaving out entries that are not current.
+
+    Args:
+        cache (LRUCache | RedisCache): The product cache.
+        ids (list): The product IDs.
+        etags (dict): The current ETag of each product, if known; entries
+            with another ETag are older than the database and left out.
+
+    Returns:
+        dict: The cached product dict for each product ID found.
+    """
+    cached = await cache.get_many(ids)
+    return {
+        product_id: product
+        for product_id, product in cached.items()
+        if "etag" in product
+        and (etags is None or product["etag"] == etags.get(product_id))
+    }
+
+
+def get_stock_coalescer(http_request: Request):
+    """Dependency returning the stock update coalescer, None if it is off."""
+    return http_request.app.state.stock_coalescer
 
 
 @app.get("/")
@@ -28,8 +156,70 @@ def get_index():
     return {"msg": "Product service"}
 
 
+@app.get("/metrics")
+def get_metrics(
+    cache=Depends(get_cache),
+    reads=Depends(get_reads),
+    coalescer=Depends(get_stock_coalescer),
+):
+    """Serve request, database and cache metrics in Prometheus text format."""
+    stats = {
+        "db_pool": pool_status(),
+        "product_cache": cache.stats(),
+        "single_flight": reads.stats(),
+    }
+    if coalescer:
+        stats["stock_coalescer"] = coalescer.stats()
+    return Response(render_metrics(stats), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/db/pool")
+def get_pool_status():
+    """Report database connection pool occupancy and checkout wait time."""
+    return pool_status()
+
+
+@app.get("/healthz")
+def get_healthz():
+    """Report that the process is up, without touching the database."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def get_readyz(db: AsyncSession = Depends(get_db)):
+    """
+    Report whether the service can take traffic.
+
+    Returns:
+        dict: The schema version, if the database answers and is migrated.
+        A 503 response otherwise.
+    """
+    try:
+        version = await db.run_sync(current_version)
+    except (SQLAlchemyError, OSError) as e:
+        return JSONResponse(
+            {"status": "unavailable", "detail": str(e)}, status_code=503
+        )
+    if version < HEAD:
+        return JSONResponse(
+            {"status": "unmigrated", "schema_version": version, "required": HEAD},
+            status_code=503,
+        )
+    return {"status": "ready", "schema_version": version}
+
+
+@app.get("/cache/stats")
+def get_cache_stats(cache=Depends(get_cache)):
+    """Report product cache hits, misses and evictions."""
+    return cache.stats()
+
+
 @app.post("/product")
-def post_product(request: ProductCreateSchema, db: Session = Depends(get_db)):
+async def post_product(
+    request: ProductCreateSchema,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
     """
     Handle POST request to create a new product.
     """
@@ -37,64 +227,275 @@ def post_product(request: ProductCreateSchema, db: Session = Depends(get_db)):
         name=request.name, price=request.price, stock_left=request.stock_left
     )
     db.add(product)
-    db.commit()
-    db.refresh(product)
+    await db.commit()
+    await cache.set_many(cache_entries([product]))
     return {"id": product.id}
 
 
+@app.get("/products", response_model=ProductPageSchema)
+async def get_products(
+    search: Annotated[ProductSearchSchema, Query()],
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Handle GET request to search products by name words, price and stock.
+
+    Results are in ascending ID order; pass next_after as after to read the
+    next page. Searches are not cached, as their results change with stock.
+    """
+    page = await search_products(db, search)
+    return adapter_response(PRODUCT_PAGE_ADAPTER, page)
+
+
 @app.get("/product/{product_id}", response_model=ProductSchema)
-def get_product_by_id(product_id: int, db: Session = Depends(get_db)):
+async def get_product_by_id(
+    product_id: int,
+    response: Response,
+    if_none_match: str = Header(None),
+    cache=Depends(get_cache),
+    reads=Depends(get_reads),
+):
     """
     Handle GET request to retrieve a product by their ID.
+
+    The response carries the product's ETag. With If-None-Match, only the
+    product's version is read, and a 304 is returned if the client's copy is
+    current. On a cache miss, concurrent requests for the product share one
+    query.
     """
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    etags = None
+    if if_none_match:
+        etags = await current_etags([product_id])
+        if etag_matches(if_none_match, etags.get(product_id)):
+            return not_modified(etags[product_id])
+
+    product = (await cached_products(cache, [product_id], etags)).get(product_id)
+    if product is None:
+        loaded = await reads.do(
+            "products", (product_id,), lambda: load_products(cache, [product_id])
+        )
+        if not loaded:
+            raise HTTPException(status_code=404, detail="Product not found")
+        product = loaded[product_id]
+    response.headers["ETag"] = product["etag"]
     return product
 
 
+@app.post("/product/import", response_model=ProductImportResultSchema)
+async def post_product_import(
+    http_request: Request,
+    import_format: Literal["csv", "ndjson"] = Query(None, alias="format"),
+    upsert: Literal["id", "name"] = None,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
+    """
+    Handle POST request to import products from a CSV or NDJSON body.
+
+    The body is streamed and written in chunks, so files of any size can be
+    imported. The format defaults to CSV for a text/csv content type and NDJSON
+    otherwise. With upsert=id, rows with an id update that product; with
+    upsert=name, rows update the products with the same name. Other rows are
+    inserted as new products.
+
+    Returns:
+        ProductImportResultSchema: Row counts and the first rejected rows.
+    """
+    if import_format is None:
+        content_type = http_request.headers.get("content-type", "")
+        import_format = "csv" if "csv" in content_type else "ndjson"
+    return await import_products(
+        db, cache, http_request.stream(), import_format, upsert=upsert
+    )
+
+
 @app.post("/product/getlist", response_model=list[ProductSchema])
-def get_product_by_ids(request: ProductRequireSchema, db: Session = Depends(get_db)):
+async def get_product_by_ids(
+    request: ProductRequireSchema,
+    if_none_match: str = Header(None),
+    cache=Depends(get_cache),
+    reads=Depends(get_reads),
+):
     """
     Handle POST request to retrieve a list of products by their IDs.
+
+    Products found in the cache are not queried; the rest are read in one
+    query and added to the cache. Concurrent requests missing the same
+    products share that query. The response carries an ETag for the list,
+    and since this is a read, If-None-Match is answered as for a GET: with
+    a 304 after reading only the versions, if the client's copy is current.
     """
+    ids = list(dict.fromkeys(request.ids))
+    etags = None
+    if if_none_match:
+        etags = await current_etags(ids)
+        if len(etags) == len(ids):
+            etag = list_etag((product_id, etags[product_id]) for product_id in ids)
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
 
-    products = db.query(models.Product).filter(models.Product.id.in_(request.ids)).all()
+    cached = await cached_products(cache, ids, etags)
+    uncached_ids = sorted(product_id for product_id in ids if product_id not in cached)
+
+    if uncached_ids:
+        loaded = await reads.do(
+            "products",
+            tuple(uncached_ids),
+            lambda: load_products(cache, uncached_ids),
+        )
+        cached.update(loaded)
+    products = [cached[product_id] for product_id in ids if product_id in cached]
 
     if not products:
         raise HTTPException(
             status_code=404, detail="No products found for the given IDs"
         )
 
-    found_ids = {product.id for product in products}
+    found_ids = {product["id"] for product in products}
     missing_ids = set(request.ids) - found_ids
     if missing_ids:
         raise HTTPException(
             status_code=404,
             detail=f"Products not found for the following IDs: {missing_ids}",
         )
-    return products
+    response = adapter_response(PRODUCT_LIST_ADAPTER, products)
+    response.headers["ETag"] = list_etag(
+        (product["id"], product["etag"]) for product in products
+    )
+    return response
+
+
+@app.post("/product/reserve", response_model=list[ProductSchema])
+async def reserve_products(
+    request: ProductReserveSchema,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
+    """
+    Reserve stock for an order and return the products with their prices.
+
+    The stock check and the decrement happen in one transaction with the
+    product rows locked, so two orders can never both take the last items.
+    With a reservation_id, the reservation is recorded in that transaction:
+    a retry with the same ID gets the products back without taking the stock
+    again, and the stock can be given back by ID.
+    """
+    quantities = {}
+    for item in request.items:
+        quantities[item.product_id] = quantities.get(item.product_id, 0) + item.number
+    if not quantities:
+        return []
+
+    reservation_id = request.reservation_id
+    if reservation_id and not await record_reservation(db, reservation_id, quantities):
+        await check_recorded(db, reservation_id, quantities)
+        products = await read_products(db, list(quantities))
+        return adapter_response(PRODUCT_LIST_ADAPTER, products)
+
+    products = await reserve_stock(db, quantities)
+    await db.commit()
+    await cache.set_many(cache_entries(products))
+
+    return adapter_response(PRODUCT_LIST_ADAPTER, products)
+
+
+@app.post(
+    "/product/reserve/{reservation_id}/release", response_model=list[ProductSchema]
+)
+async def release_reserved_stock(
+    reservation_id: str,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
+    """
+    Give back the stock taken by a reservation made with this ID.
+
+    Releasing is safe to retry: the stock is given back once. Releasing an
+    ID that was never reserved refuses a reservation arriving with it later,
+    so a caller that gave up waiting on a reservation can always undo it.
+    """
+    quantities = await release_reservation(db, reservation_id)
+    products = await apply_stock_deltas(db, quantities) if quantities else []
+    await db.commit()
+    await cache.set_many(cache_entries(products))
+
+    return adapter_response(PRODUCT_LIST_ADAPTER, products)
+
+
+@app.put("/product/stock", response_model=list[ProductSchema])
+async def update_products_stock(
+    request: ProductBulkStockUpdateSchema,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
+    """
+    Update the stock of several products in one transaction.
+
+    Either every stock change is applied or, if any product is missing
+    or would go below zero, none of them is.
+    """
+    deltas = merge_stock_deltas(request.items)
+    if not deltas:
+        return []
+
+    products = await apply_stock_deltas(db, deltas)
+    await db.commit()
+    await cache.set_many(cache_entries(products))
+
+    return adapter_response(PRODUCT_LIST_ADAPTER, products)
 
 
 @app.put("/product/{product_id}", response_model=ProductSchema)
-def update_product_stock(
-    product_id: int, request: ProductStockUpdateSchema, db: Session = Depends(get_db)
+async def update_product_stock(
+    product_id: int,
+    request: ProductStockUpdateSchema,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+    coalescer=Depends(get_stock_coalescer),
 ):
     """
     Update the stock of a product by adding or subtracting from the existing stock.
+
+    The change is one conditional UPDATE, or a change to one shard for a
+    product in sharded mode, so concurrent updates are never lost. With the
+    coalescer on, concurrent updates are applied in batches, one transaction
+    each, and every caller gets the stock left after its own change.
     """
+    if coalescer:
+        return await coalescer.update_stock(product_id, request.add_amount)
+    try:
+        products = await apply_stock_deltas(db, {product_id: request.add_amount})
+    except HTTPException as e:
+        detail = (
+            "Product not found"
+            if e.status_code == 404
+            else "stock is not enough for this order"
+        )
+        raise HTTPException(status_code=e.status_code, detail=detail) from e
+    await db.commit()
+    entries = cache_entries(products)
+    await cache.set_many(entries)
 
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    if not product:
-        raise HTTPException(status_code=404, detail="Product not found")
+    return entries[product_id]
 
-    if product.stock_left + request.add_amount < 0:
-        raise HTTPException(
-            status_code=400, detail="stock is not enough for this order"
-        )
 
-    product.stock_left += request.add_amount
-    db.commit()
-    db.refresh(product)
+@app.put("/product/{product_id}/shards", response_model=ProductSchema)
+async def update_product_shards(
+    product_id: int,
+    request: ProductShardsSchema,
+    db: AsyncSession = Depends(get_db),
+    cache=Depends(get_cache),
+):
+    """
+    Switch a product into sharded stock mode for a sale, or back with 0 shards.
+
+    In sharded mode the stock is split over several rows, so concurrent
+    orders for the product do not all wait on one row lock. Clients see the
+    same stock_left, summed over the shards.
+    """
+    product = await set_stock_shards(db, product_id, request.shards)
+    await db.commit()
+    entries = cache_entries([product])
+    await cache.set_many(entries)
 
-    return product
+    return entries[product_id]
@@ -0,0 +1,294 @@
+# metrics.py
+# pylint: disable=R0903
+"""
+This module contains the request instrumentation for the service.
+It keeps counters, gauges and histograms in process and renders them in the
+Prometheus text format for GET /metrics. MetricsMiddleware times every request
+by route template, instrument_engine times every database query and adds it to
+the current request's DB time, and timed_call times outbound HTTP calls.
+"""
+
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from sqlalchemy import event
+
+# Upper bounds in seconds, from 1 ms up to the default HTTP timeout and beyond
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+REGISTRY = []
+
+# Database time of the request being handled, as a one-element list
+REQUEST_DB_TIME = ContextVar("request_db_time", default=None)
+
+
+def escape(value) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """
+    Base class for a metric with a fixed set of label names.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The HELP text.
+        labelnames (tuple): Label names, matched positionally by label values.
+        values (dict): State per tuple of label values.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def label_text(self, labels, extra: str = "") -> str:
+        """Format label values as {name="value",...}."""
+        pairs = [
+            f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, labels)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        """Yield (suffix, label text, value) for every sample."""
+        for labels, value in self.values.items():
+            yield "", self.label_text(labels), value
+
+    def render(self) -> list:
+        """Return the metric's lines in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {float(value)!r}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        """Add amount to the counter for the label values."""
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    kind = "gauge"
+
+    def inc(self, *labels, amount: float = 1.0):
+        """Add amount to the gauge for the label values."""
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def dec(self, *labels, amount: float = 1.0):
+        """Subtract amount from the gauge for the label values."""
+        self.values[labels] = self.values.get(labels, 0.0) - amount
+
+    def set(self, value: float, *labels):
+        """Set the gauge for the label values."""
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Observations counted into fixed buckets, with their sum and count.
+
+    Each label tuple keeps non-cumulative bucket counts plus the sum, so an
+    observation is one bisect and two additions; counts are made cumulative
+    only when rendered.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        """Record one observation for the label values."""
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        """Yield the cumulative buckets, the sum and the count per label tuple."""
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield "_bucket", self.label_text(labels, f'le="{le}"'), cumulative
+            yield "_sum", self.label_text(labels), total
+            yield "_count", self.label_text(labels), cumulative
+
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests handled, by route template and status code.",
+    ("method", "route", "status"),
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request, by route template.",
+    ("method", "route"),
+)
+REQUEST_DB_SECONDS = Histogram(
+    "http_request_db_seconds",
+    "Time spent in database queries while handling a request, by route template.",
+    ("method", "route"),
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled.")
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Time to execute one database statement."
+)
+DOWNSTREAM_SECONDS = Histogram(
+    "downstream_request_duration_seconds",
+    "Time of an outbound call to another service, by call and outcome.",
+    ("call", "outcome"),
+)
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware recording request count, latency, database time and
+    the number of requests in flight.
+
+    Requests are labelled with the route template, e.g. /order/{order_id},
+    so the number of series stays bounded; unmatched paths share one label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        db_time = [0.0]
+        token = REQUEST_DB_TIME.set(db_time)
+        IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            IN_FLIGHT.dec()
+            REQUEST_DB_TIME.reset(token)
+            route = scope.get("route")
+            template = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUESTS.inc(method, template, str(status))
+            REQUEST_SECONDS.observe(elapsed, method, template)
+            REQUEST_DB_SECONDS.observe(db_time[0], method, template)
+
+
+def instrument_engine(engine):
+    """
+    Times every statement run on the engine.
+
+    Pass the sync_engine of an AsyncEngine. Each statement is recorded in
+    db_query_duration_seconds and added to the DB time of the current request.
+
+    Args:
+        engine (Engine): The engine to instrument.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        _conn, _cursor, _statement, _parameters, context, _executemany
+    ):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(
+        _conn, _cursor, _statement, _parameters, context, _executemany
+    ):
+        elapsed = time.perf_counter() - context.metrics_start
+        DB_QUERY_SECONDS.observe(elapsed)
+        db_time = REQUEST_DB_TIME.get()
+        if db_time is not None:
+            db_time[0] += elapsed
+
+
+def timed_call(func):
+    """
+    Decorator recording the duration of an async outbound call.
+
+    The call is labelled with the function name and an outcome of ok or error.
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            DOWNSTREAM_SECONDS.observe(
+                time.perf_counter() - start, func.__name__, outcome
+            )
+
+    return wrapper
+
+
+def render_metrics(stats=None) -> str:
+    """
+    Renders every registered metric in the Prometheus text format.
+
+    Args:
+        stats (dict): Extra gauges, as a name prefix mapped to a stats dict such
+            as pool_status(); non-numeric values are skipped.
+
+    Returns:
+        str: The metrics page.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for prefix, values in (stats or {}).items():
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {float(value)!r}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,78 @@
+# migrations.py
+"""
+This module lists the schema migrations of the product service, applied in
+order by migrate.py. Add new changes as a new version at the end; never edit
+a migration that has been released, as databases that already have it will
+not run it again.
+"""
+
+SERVICE = "product"
+
+# (version, description, SQL statements run in one transaction)
+MIGRATIONS = (
+    (
+        1,
+        "create products",
+        (
+            "CREATE TABLE IF NOT EXISTS products ("
+            "id SERIAL PRIMARY KEY, "
+            "name VARCHAR NOT NULL, "
+            "price INTEGER NOT NULL, "
+            "stock_left INTEGER NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS ix_products_id ON products (id)",
+        ),
+    ),
+    (
+        2,
+        "index products by name",
+        ("CREATE INDEX IF NOT EXISTS ix_products_name ON products (name)",),
+    ),
+    (
+        3,
+        "index products for search by name words and price",
+        (
+            # Rewrites the table, as the column is computed for existing rows
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS name_search tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', name)) STORED",
+            "CREATE INDEX IF NOT EXISTS ix_products_name_search "
+            "ON products USING gin (name_search)",
+            "CREATE INDEX IF NOT EXISTS ix_products_price ON products (price)",
+        ),
+    ),
+    (
+        4,
+        "split the stock of hot products into shards",
+        (
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS "
+            "stock_shards INTEGER NOT NULL DEFAULT 0",
+            "CREATE TABLE IF NOT EXISTS product_stock_shards ("
+            "product_id INTEGER NOT NULL REFERENCES products (id) ON DELETE CASCADE, "
+            "shard INTEGER NOT NULL, "
+            "stock_left INTEGER NOT NULL CHECK (stock_left >= 0), "
+            "PRIMARY KEY (product_id, shard))",
+        ),
+    ),
+    (
+        5,
+        "version products and stock shards for conditional reads",
+        (
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS "
+            "version INTEGER NOT NULL DEFAULT 1",
+            "ALTER TABLE product_stock_shards ADD COLUMN IF NOT EXISTS "
+            "version INTEGER NOT NULL DEFAULT 1",
+        ),
+    ),
+    (
+        6,
+        "create stock_reservations",
+        (
+            "CREATE TABLE IF NOT EXISTS stock_reservations ("
+            "id VARCHAR PRIMARY KEY, "
+            "items JSONB NOT NULL, "
+            "released_at TIMESTAMP WITH TIME ZONE, "
+            "created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now())",
+            "CREATE INDEX IF NOT EXISTS ix_stock_reservations_created_at "
+            "ON stock_reservations (created_at)",
+        ),
+    ),
+)
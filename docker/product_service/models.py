@@ -2,10 +2,24 @@
 # pylint: disable=R0903
 """
 This module contains the SQLAlchemy models for the application. 
-It defines the 'Product' model with basic attributes like 'id', 'name', 'price' and 'stock_left'.
+It defines the 'Product' model with basic attributes like 'id', 'name', 'price' and 'stock_left',
+the 'ProductStockShard' model holding the stock of products in sharded mode,
+and the 'StockReservation' model recording the stock taken for each order.
 """
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import (
+    CheckConstraint,
+    Column,
+    Computed,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    func,
+)
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import deferred
 
 Base = declarative_base()
 
@@ -17,15 +31,95 @@ class Product(Base):
         id (int): Primary key for the product.
         name (str): Name of the product.
         price: The price of the product.
-        stock_left: The quality of the item left in the stock.
+        stock_left: The quality of the item left in the stock. Always 0 while
+        the stock is sharded; the shards hold it then.
+        stock_shards: The number of stock shards, 0 if the stock is not sharded.
+        version: Bumped on every write to the product, for its ETag.
+        name_search: The words of the name, kept up to date by the database.
     """
 
     __tablename__ = "products"
+    # Finds products by the words of their name
+    __table_args__ = (
+        Index("ix_products_name_search", "name_search", postgresql_using="gin"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    price = Column(Integer, nullable=False)
+    # Indexed for imports that match products by name
+    name = Column(String, nullable=False, index=True)
+    # Indexed for searches by price range
+    price = Column(Integer, nullable=False, index=True)
     stock_left = Column(Integer, nullable=False)
+    stock_shards = Column(Integer, nullable=False, server_default="0")
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Only used in WHERE clauses, so it is not loaded with the product
+    name_search = deferred(
+        Column(TSVECTOR, Computed("to_tsvector('simple', name)", persisted=True))
+    )
 
     def __repr__(self):
         # A string representation of the Product object
         return f"<Product(name={self.name}, price={self.price}, stock_left={self.stock_left})>"
+
+
+class ProductStockShard(Base):
+    """
+    ProductStockShard model holding part of the stock of a product.
+
+    During a sale, concurrent orders for one product all update its row and
+    queue on the row lock. With the stock split over several shards, each
+    order takes its items from one shard, so orders that land on different
+    shards commit in parallel. The stock of the product is the sum of its shards.
+
+    Attributes:
+        product_id (int): ID of the product.
+        shard (int): Number of the shard, from 0.
+        stock_left (int): The part of the stock held by this shard.
+        version (int): Bumped on every write to the shard, so the product's
+            ETag changes without writing to the product row.
+    """
+
+    __tablename__ = "product_stock_shards"
+    __table_args__ = (CheckConstraint("stock_left >= 0"),)
+    product_id = Column(
+        Integer, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True
+    )
+    shard = Column(Integer, primary_key=True)
+    stock_left = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+    def __repr__(self):
+        # A string representation of the ProductStockShard object
+        return (
+            f"<ProductStockShard(product_id={self.product_id}, shard={self.shard}, "
+            f"stock_left={self.stock_left})>"
+        )
+
+
+class StockReservation(Base):
+    """
+    StockReservation model recording the stock taken by POST /product/reserve
+    under a reservation ID chosen by the caller.
+
+    A retry with the same ID does not take the stock again, and the stock can
+    be given back by ID, also when the caller never saw the reservation's
+    answer. Releasing an ID that was never reserved records it as released,
+    so a reservation arriving late is refused instead of leaking stock.
+
+    Attributes:
+        id (str): The reservation ID.
+        items (dict): The quantity taken per product ID, as a string.
+        released_at (datetime): When the stock was given back, None until then.
+        created_at (datetime): When the reservation was made, used for expiry.
+    """
+
+    __tablename__ = "stock_reservations"
+    id = Column(String, primary_key=True)
+    items = Column(JSONB, nullable=False)
+    released_at = Column(DateTime(timezone=True))
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now(), index=True
+    )
+
+    def __repr__(self):
+        # A string representation of the StockReservation object
+        return f"<StockReservation(id={self.id}, released_at={self.released_at})>"
@@ -0,0 +1,255 @@
+# product_import.py
+"""
+This module contains the streaming product import behind POST /product/import.
+The request body is read chunk by chunk and passed through a pipeline of async
+generators: bytes to lines, lines to rows, rows to fixed-size chunks. Each chunk
+is validated with ProductImportRowSchema, copied into a temporary table with
+Postgres COPY and merged into products in its own short transaction, so memory
+use depends on the chunk size and not on the size of the file.
+"""
+
+import os
+import csv
+import json
+import codecs
+from pydantic import ValidationError
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas import ProductImportRowSchema
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "100"))
+
+IMPORT_COLUMNS = ("row_number", "id", "name", "price", "stock_left")
+
+CREATE_IMPORT_TABLE = text(
+    "CREATE TEMP TABLE IF NOT EXISTS product_import ("
+    "row_number integer, id integer, name varchar, price integer, stock_left integer"
+    ") ON COMMIT DELETE ROWS"
+)
+
+# Rows without an id, or all rows when not upserting by id, become new products
+INSERT_NEW = text(
+    "INSERT INTO products (name, price, stock_left) "
+    "SELECT name, price, stock_left FROM product_import "
+    "WHERE :by_id = false OR id IS NULL ORDER BY row_number"
+)
+
+# The last row wins when a chunk has several rows for the same id or name.
+# Products in sharded mode keep their stock, which lives in their shards.
+# Every updated product gets a new version, and so a new ETag.
+SET_STOCK_AND_VERSION = (
+    "stock_left = CASE WHEN products.stock_shards = 0 "
+    "THEN source.stock_left ELSE products.stock_left END, "
+    "version = products.version + 1 "
+)
+UPDATE_BY_ID = text(
+    "WITH source AS ("
+    "SELECT DISTINCT ON (id) * FROM product_import WHERE id IS NOT NULL "
+    "ORDER BY id, row_number DESC) "
+    "UPDATE products SET name = source.name, price = source.price, "
+    + SET_STOCK_AND_VERSION
+    + "FROM source WHERE products.id = source.id "
+    "RETURNING products.id"
+)
+UNKNOWN_IDS = text(
+    "SELECT row_number, id FROM product_import WHERE id IS NOT NULL "
+    "AND NOT EXISTS (SELECT 1 FROM products WHERE products.id = product_import.id) "
+    "ORDER BY row_number"
+)
+UPDATE_BY_NAME = text(
+    "WITH source AS ("
+    "SELECT DISTINCT ON (name) * FROM product_import "
+    "ORDER BY name, row_number DESC) "
+    "UPDATE products SET price = source.price, "
+    + SET_STOCK_AND_VERSION
+    + "FROM source WHERE products.name = source.name "
+    "RETURNING products.id"
+)
+INSERT_NEW_NAMES = text(
+    "INSERT INTO products (name, price, stock_left) "
+    "SELECT name, price, stock_left FROM ("
+    "SELECT DISTINCT ON (name) * FROM product_import "
+    "ORDER BY name, row_number DESC) AS source "
+    "WHERE NOT EXISTS (SELECT 1 FROM products WHERE products.name = source.name) "
+    "ORDER BY row_number"
+)
+
+
+async def read_lines(body):
+    """Yield the lines of a UTF-8 body given as an async iterator of bytes."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    async for chunk in body:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+
+def parse_csv_line(line: str, header) -> dict:
+    """Parse one CSV line into a dict keyed by the header, leaving out empty cells."""
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"Expected {len(header)} columns, got {len(values)}")
+    return {name: value for name, value in zip(header, values) if value != ""}
+
+
+def parse_json_line(line: str) -> dict:
+    """Parse one NDJSON line into a dict."""
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError("Expected a JSON object")
+    return row
+
+
+async def parse_rows(lines, import_format: str):
+    """
+    Yield (row number, row) for every non-blank data line.
+
+    A line that cannot be parsed is yielded with its error message instead of
+    a dict. CSV input starts with a header line naming the columns.
+    """
+    header = None
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        if import_format == "csv" and header is None:
+            header = [name.strip() for name in next(csv.reader([line]), [])]
+            continue
+        row_number += 1
+        try:
+            if import_format == "csv":
+                yield row_number, parse_csv_line(line, header)
+            else:
+                yield row_number, parse_json_line(line)
+        except (ValueError, csv.Error) as e:
+            yield row_number, str(e)
+
+
+async def chunked(rows, size: int):
+    """Yield lists of at most size items from an async iterator."""
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_chunk(chunk):
+    """
+    Validates a chunk of parsed rows with ProductImportRowSchema.
+
+    Args:
+        chunk (list): (row number, row dict or parse error) tuples.
+
+    Returns:
+        tuple: The valid rows as COPY records and the rejected rows as error dicts.
+    """
+    records, errors = [], []
+    for row_number, row in chunk:
+        if isinstance(row, str):
+            errors.append({"row": row_number, "error": row})
+            continue
+        try:
+            product = ProductImportRowSchema.model_validate(row)
+        except ValidationError as e:
+            message = "; ".join(
+                f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+                for error in e.errors()
+            )
+            errors.append({"row": row_number, "error": message})
+            continue
+        records.append(
+            (row_number, product.id, product.name, product.price, product.stock_left)
+        )
+    return records, errors
+
+
+async def write_chunk(db: AsyncSession, records, upsert: str = None):
+    """
+    Copies a chunk of rows into the import table and merges it into products.
+
+    Args:
+        db (AsyncSession): The database session.
+        records (list): COPY records in IMPORT_COLUMNS order.
+        upsert (str): None to insert every row, "id" to update products by id
+            or "name" to update products by name, inserting the rest.
+
+    Returns:
+        tuple: The number of inserted products, the updated product IDs and
+        errors for rows naming an unknown id.
+    """
+    connection = await db.connection()
+    await connection.execute(CREATE_IMPORT_TABLE)
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        "product_import", records=records, columns=IMPORT_COLUMNS
+    )
+
+    updated_ids, errors = [], []
+    if upsert == "id":
+        updated_ids = (await connection.execute(UPDATE_BY_ID)).scalars().all()
+        errors = [
+            {"row": row_number, "error": f"Product {product_id} not found"}
+            for row_number, product_id in await connection.execute(UNKNOWN_IDS)
+        ]
+    if upsert == "name":
+        updated_ids = (await connection.execute(UPDATE_BY_NAME)).scalars().all()
+        inserted = (await connection.execute(INSERT_NEW_NAMES)).rowcount
+    else:
+        inserted = (
+            await connection.execute(INSERT_NEW, {"by_id": upsert == "id"})
+        ).rowcount
+    await db.commit()
+    return inserted, updated_ids, errors
+
+
+async def import_products(
+    db: AsyncSession,
+    cache,
+    body,
+    import_format: str,
+    upsert: str = None,
+) -> dict:
+    """
+    Imports products from a streamed CSV or NDJSON body.
+
+    Every chunk of IMPORT_CHUNK_SIZE rows is committed on its own, so rows
+    before a failure stay imported.
+    Updated products are dropped from the cache after their chunk commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        cache: The product cache.
+        body: Async iterator of body bytes.
+        import_format (str): "csv" or "ndjson".
+        upsert (str): None, "id" or "name"; see write_chunk.
+
+    Returns:
+        dict: Counts of received, inserted, updated and failed rows, and the
+        first IMPORT_MAX_ERRORS errors.
+    """
+    result = {"received": 0, "inserted": 0, "updated": 0, "failed": 0, "errors": []}
+    rows = parse_rows(read_lines(body), import_format)
+    async for chunk in chunked(rows, IMPORT_CHUNK_SIZE):
+        result["received"] += len(chunk)
+        records, errors = validate_chunk(chunk)
+        if records:
+            inserted, updated_ids, unknown = await write_chunk(db, records, upsert)
+            result["inserted"] += inserted
+            result["updated"] += len(updated_ids)
+            errors.extend(unknown)
+            if updated_ids:
+                await cache.delete_many(updated_ids)
+        result["failed"] += len(errors)
+        room = IMPORT_MAX_ERRORS - len(result["errors"])
+        result["errors"].extend(sorted(errors, key=lambda e: e["row"])[:room])
+    return result
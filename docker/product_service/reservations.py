@@ -0,0 +1,147 @@
+# reservations.py
+"""
+This module contains the records of stock reservations made with an ID.
+POST /product/reserve records the reservation in the transaction that takes
+the stock, so a retry with the same ID gets the products back without taking
+the stock twice. POST /product/reserve/{id}/release gives the stock back once,
+whether or not the caller saw the reservation succeed, and releasing an ID
+that was never reserved refuses the reservation if it arrives later. Records
+expire after RESERVATION_TTL seconds and are deleted in batches.
+"""
+
+import os
+from datetime import timedelta
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import clean_up_forever, delete_in_batches
+from models import StockReservation
+
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "86400"))
+RESERVATION_CLEANUP_INTERVAL = float(os.getenv("RESERVATION_CLEANUP_INTERVAL", "300"))
+RESERVATION_CLEANUP_BATCH = int(os.getenv("RESERVATION_CLEANUP_BATCH", "1000"))
+
+
+def reserved_items(quantities: dict) -> dict:
+    """Return the quantities as stored in JSON, keyed by product ID as a string."""
+    return {str(product_id): number for product_id, number in quantities.items()}
+
+
+async def record_reservation(
+    db: AsyncSession, reservation_id: str, quantities: dict
+) -> bool:
+    """
+    Records a reservation, without committing, so it commits with the stock taken.
+
+    A concurrent request with the same ID waits for this transaction and then
+    finds the reservation recorded.
+
+    Args:
+        db (AsyncSession): The database session.
+        reservation_id (str): The reservation ID chosen by the caller.
+        quantities (dict): The quantity to reserve for each product ID.
+
+    Returns:
+        bool: True if the ID is new and the stock should be taken.
+    """
+    result = await db.execute(
+        insert(StockReservation)
+        .values(id=reservation_id, items=reserved_items(quantities))
+        .on_conflict_do_nothing()
+        .returning(StockReservation.id)
+    )
+    return result.first() is not None
+
+
+async def check_recorded(db: AsyncSession, reservation_id: str, quantities: dict):
+    """
+    Checks that a reservation already recorded can be answered as a retry.
+
+    Args:
+        db (AsyncSession): The database session.
+        reservation_id (str): The reservation ID chosen by the caller.
+        quantities (dict): The quantity to reserve for each product ID.
+
+    Raises:
+        HTTPException: 409 if the reservation was released, 422 if the ID
+        was used for different items.
+    """
+    reservation = await db.get(StockReservation, reservation_id)
+    if reservation.released_at is not None:
+        raise HTTPException(
+            status_code=409, detail=f"Reservation {reservation_id} was released"
+        )
+    if reservation.items != reserved_items(quantities):
+        raise HTTPException(
+            status_code=422,
+            detail="Reservation ID was already used for different items",
+        )
+
+
+async def release_reservation(db: AsyncSession, reservation_id: str) -> dict:
+    """
+    Marks a reservation released, without committing, and returns the stock
+    to give back in the same transaction.
+
+    An ID that was never reserved is recorded as released with no items, so
+    a reservation arriving with it later is refused.
+
+    Args:
+        db (AsyncSession): The database session.
+        reservation_id (str): The reservation ID chosen by the caller.
+
+    Returns:
+        dict: The quantity to give back for each product ID; empty if the
+        reservation was already released or never made.
+    """
+    result = await db.execute(
+        insert(StockReservation)
+        .values(id=reservation_id, items={}, released_at=func.now())
+        .on_conflict_do_update(
+            index_elements=[StockReservation.id],
+            set_={"released_at": func.now()},
+            where=StockReservation.released_at.is_(None),
+        )
+        .returning(StockReservation.items)
+    )
+    items = result.scalar() or {}
+    return {int(product_id): number for product_id, number in items.items()}
+
+
+async def purge_expired_reservations(
+    session_factory, batch: int = RESERVATION_CLEANUP_BATCH
+):
+    """
+    Deletes expired reservation records in batches, one short transaction per batch.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        batch (int): Maximum number of rows deleted per transaction.
+
+    Returns:
+        int: The number of records deleted.
+    """
+    expired = StockReservation.created_at < func.now() - timedelta(
+        seconds=RESERVATION_TTL
+    )
+    return await delete_in_batches(session_factory, StockReservation.id, expired, batch)
+
+
+async def purge_expired_reservations_forever(
+    session_factory, interval: float = RESERVATION_CLEANUP_INTERVAL
+):
+    """
+    Deletes expired reservation records every interval seconds, starting one
+    interval after startup, until cancelled.
+
+    Args:
+        session_factory: Callable returning a new AsyncSession.
+        interval (float): Seconds between cleanups.
+    """
+    await clean_up_forever(
+        purge_expired_reservations,
+        session_factory,
+        interval,
+        "expired stock reservations",
+    )
@@ -6,7 +6,8 @@ serializing the request and response data.
 It defines two schemas: productCreateSchema for creating products and --
 productSchema for representing product data.
 """
-from pydantic import BaseModel
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 
 
 class ProductCreateSchema(BaseModel):
@@ -40,16 +41,8 @@ class ProductSchema(BaseModel):
     price: int
     stock_left: int
 
-    class Config:
-        """
-        Configuration for the ProductSchema.
-
-        orm_mode = True tells Pydantic to treat the data as ORM models, --
-        allowing automatic conversion
-        from SQLAlchemy model instances to Pydantic models.
-        """
-
-        orm_mode = True
+    # Lets the schema be built from SQLAlchemy model instances
+    model_config = ConfigDict(from_attributes=True)
 
 
 class ProductStockUpdateSchema(BaseModel):
@@ -63,6 +56,70 @@ class ProductStockUpdateSchema(BaseModel):
     add_amount: int
 
 
+class ProductShardsSchema(BaseModel):
+    """
+    Schema for switching a product into or out of sharded stock mode.
+
+    Attributes:
+        shards (int): The number of shards to split the stock into; 0 keeps
+        the stock on the product row. More shards let more concurrent orders
+        for the product commit in parallel.
+    """
+
+    shards: int = Field(ge=0, le=64)
+
+
+class ProductStockItemSchema(BaseModel):
+    """
+    Schema for one stock change in a bulk stock update.
+
+    Attributes:
+        product_id (int): The ID of the product to update.
+        add_amount (int): The number of the product to add into stock.
+    """
+
+    product_id: int
+    add_amount: int
+
+
+class ProductBulkStockUpdateSchema(BaseModel):
+    """
+    Schema for updating the stock of several products at once.
+
+    Attributes:
+        items (List[ProductStockItemSchema]): The stock changes to apply.
+    """
+
+    items: list[ProductStockItemSchema]
+
+
+class ProductReserveItemSchema(BaseModel):
+    """
+    Schema for one product in a stock reservation.
+
+    Attributes:
+        product_id (int): The ID of the product to reserve.
+        number (int): The quantity to take out of stock.
+    """
+
+    product_id: int
+    number: int = Field(gt=0)
+
+
+class ProductReserveSchema(BaseModel):
+    """
+    Schema for reserving stock for an order.
+
+    Attributes:
+        items (List[ProductReserveItemSchema]): The products and quantities to reserve.
+        reservation_id (Optional[str]): ID chosen by the caller, which makes the
+            reservation safe to retry and lets it be released by ID.
+    """
+
+    items: list[ProductReserveItemSchema]
+    reservation_id: Optional[str] = Field(None, min_length=1, max_length=255)
+
+
 class ProductRequireSchema(BaseModel):
     """
     Schema for update the stock of a product.
@@ -72,3 +129,88 @@ class ProductRequireSchema(BaseModel):
     """
 
     ids: list[int]
+
+
+class ProductSearchSchema(BaseModel):
+    """
+    Schema for the query parameters of a product search.
+
+    Attributes:
+        q (Optional[str]): Words that must all be in the name. Supports
+        "quoted phrases", "or" between words and -word to exclude a word.
+        min_price (Optional[int]): Lowest price, inclusive.
+        max_price (Optional[int]): Highest price, inclusive.
+        in_stock (Optional[bool]): True for products in stock, False for
+        sold out ones.
+        after (Optional[int]): Only list products with an ID greater than this one.
+        limit (int): Maximum number of products in the page.
+    """
+
+    q: Optional[str] = Field(None, max_length=200)
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    in_stock: Optional[bool] = None
+    after: Optional[int] = None
+    limit: int = Field(50, gt=0, le=200)
+
+
+class ProductPageSchema(BaseModel):
+    """
+    Schema for one page of a product search.
+
+    Attributes:
+        products (list[ProductSchema]): Matching products in ascending ID order.
+        next_after (Optional[int]): Pass as `after` to read the next page,
+        or None if this is the last page.
+    """
+
+    products: list[ProductSchema]
+    next_after: Optional[int] = None
+
+
+class ProductImportRowSchema(ProductCreateSchema):
+    """
+    Schema for one row of a product import.
+
+    Attributes:
+        id (Optional[int]): The product to update when importing with upsert=id.
+    """
+
+    id: Optional[int] = None
+
+
+class ProductImportErrorSchema(BaseModel):
+    """
+    Schema for a row rejected by a product import.
+
+    Attributes:
+        row (int): The 1-based data row number, not counting a CSV header.
+        error (str): Why the row was rejected.
+    """
+
+    row: int
+    error: str
+
+
+class ProductImportResultSchema(BaseModel):
+    """
+    Schema for the outcome of a product import.
+
+    Attributes:
+        received (int): Data rows read from the body.
+        inserted (int): Products created.
+        updated (int): Existing products changed by an upsert.
+        failed (int): Rows rejected.
+        errors (list[ProductImportErrorSchema]): The first rejected rows.
+    """
+
+    received: int
+    inserted: int
+    updated: int
+    failed: int
+    errors: list[ProductImportErrorSchema]
+
+
+# Built once at import and used by the list routes, see serialization.py
+PRODUCT_LIST_ADAPTER = TypeAdapter(list[ProductSchema])
+PRODUCT_PAGE_ADAPTER = TypeAdapter(ProductPageSchema)
@@ -0,0 +1,77 @@
+# singleflight.py
+"""
+This module contains the single-flight layer for reads.
+Concurrent identical reads, with the same key, share one call: the first
+caller starts it and the others wait for its result instead of running the
+same query again. The call runs in a task of its own, so a caller that goes
+away does not cancel it for the others. A shared result is never newer than
+the moment the call started, as with any read already in flight.
+"""
+
+import os
+import asyncio
+from metrics import Counter
+
+READ_SINGLE_FLIGHT = os.getenv("READ_SINGLE_FLIGHT", "true").lower() == "true"
+
+COALESCED = Counter(
+    "single_flight_coalesced_total",
+    "Reads that shared the result of an identical read already in flight.",
+    ("read",),
+)
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call among concurrent callers with the same key.
+
+    Results are shared as they are, so callers must not modify them.
+
+    Attributes:
+        enabled (bool): Whether calls are shared; if not, every caller runs its own.
+        calls (int): Number of calls run.
+        coalesced (int): Number of callers that shared a call already in flight.
+    """
+
+    def __init__(self, enabled: bool = READ_SINGLE_FLIGHT):
+        self.enabled = enabled
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, read: str, key, func):
+        """
+        Returns the result of func(), shared with concurrent callers of the same key.
+
+        Args:
+            read (str): The kind of read, part of the key and the counter label.
+            key (Hashable): The normalized request, such as a tuple of sorted IDs.
+            func (Callable): A coroutine function running the read.
+
+        Returns:
+            Any: The result of the call.
+
+        Raises:
+            Exception: Whatever the call raised, to every caller sharing it.
+        """
+        if not self.enabled:
+            self.calls += 1
+            return await func()
+        task = self.in_flight.get((read, key))
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self.in_flight[(read, key)] = task
+            task.add_done_callback(lambda _: self.in_flight.pop((read, key), None))
+        else:
+            self.coalesced += 1
+            COALESCED.inc(read)
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        """Return the call counters."""
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+        }
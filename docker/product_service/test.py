@@ -4,13 +4,37 @@ This module contains tests for the FastAPI user service,
 including testing the main endpoint, creating a user, and reading user details.
 """
 
+import asyncio
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+import httpx
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import inspect, select
+import main
+import migrate
+import models
+import product_import
+import reservations
+from cache import LRUCache, RedisCache
+from database import Async_Product_Session, Product_Session, get_engine
 from main import app
 
-client = TestClient(app)
 
+@pytest.fixture(name="client", scope="module")
+def fixture_client():
+    """
+    Provide a test client that runs the app's lifespan once for the module,
+    so every request shares one event loop and one async connection pool.
+    The schema is migrated first, as the app no longer creates it.
+    """
+    migrate.migrate(get_engine())
+    with TestClient(app) as test_client:
+        yield test_client
 
-def test_get_index():
+
+def test_get_index(client):
     """
     Test the root endpoint ("/").
     Ensures the endpoint returns a 200 status code and the expected JSON response.
@@ -20,7 +44,40 @@ def test_get_index():
     assert response.json() == {"msg": "Product service"}
 
 
-def test_post_product():
+def test_healthz_readyz(client, monkeypatch):
+    """
+    Test the health endpoints ("/healthz", "/readyz").
+    Ensures readiness reports the schema version and fails while the
+    database is behind the migrations the code needs.
+    """
+    assert client.get("/healthz").json() == {"status": "ok"}
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "schema_version": migrate.HEAD}
+
+    monkeypatch.setattr(main, "HEAD", migrate.HEAD + 1)
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unmigrated"
+
+
+def test_migrations_match_models():
+    """
+    Test that the migrations create the tables, columns and indexes the models
+    describe, and that running them again applies nothing.
+    """
+    engine = get_engine()
+    migrate.migrate(engine)
+    assert not migrate.migrate(engine)
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        assert columns == {column.name for column in table.columns}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= indexes
+
+
+def test_post_product(client):
     """
     Test the product creation endpoint ("/product").
     Ensures a product can be created successfully.
@@ -36,7 +93,7 @@ def test_post_product():
     assert response.status_code == 200
 
 
-def test_get_product_by_id():
+def test_get_product_by_id(client):
     """
     Test retrieving a product by its ID ("/product/{product_id}").
     Ensures a product is returned when using a valid ID.
@@ -60,7 +117,7 @@ def test_get_product_by_id():
     assert response.json()["stock_left"] == 100
 
 
-def test_get_product_by_ids():
+def test_get_product_by_ids(client):
     """
     Test retrieving multiple products by their IDs ("/product/getlist").
     Ensures the endpoint returns all requested products.
@@ -94,7 +151,7 @@ def test_get_product_by_ids():
     assert response.json()[1]["name"] == "Test Product 2"
 
 
-def test_update_product_stock():
+def test_update_product_stock(client):
     """
     Test updating a product's stock ("/product/{product_id}").
     Ensures the stock is updated correctly.
@@ -116,3 +173,651 @@ def test_update_product_stock():
     )
     assert response.status_code == 200
     assert response.json()["stock_left"] == 90  # 100 - 10 = 90
+
+
+def test_update_products_stock_bulk(client):
+    """
+    Test updating the stock of several products at once ("/product/stock").
+    Ensures every stock change is applied in one request.
+    """
+    response = client.put(
+        "/product/stock",
+        json={
+            "items": [
+                {"product_id": 1, "add_amount": -5},
+                {"product_id": 2, "add_amount": -5},
+                {"product_id": 1, "add_amount": -5},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert [product["stock_left"] for product in response.json()] == [80, 45]
+
+
+def test_update_products_stock_bulk_is_atomic(client):
+    """
+    Test that a bulk stock update is rejected as a whole.
+    Ensures no stock changes when one product is short or missing.
+    """
+    response = client.put(
+        "/product/stock",
+        json={
+            "items": [
+                {"product_id": 1, "add_amount": -1},
+                {"product_id": 2, "add_amount": -1000},
+            ]
+        },
+    )
+    assert response.status_code == 400
+
+    response = client.put(
+        "/product/stock",
+        json={
+            "items": [
+                {"product_id": 1, "add_amount": -1},
+                {"product_id": 9999, "add_amount": -1},
+            ]
+        },
+    )
+    assert response.status_code == 404
+
+    response = client.get("/product/1")
+    assert response.json()["stock_left"] == 80
+
+
+def test_reserve_products(client):
+    """
+    Test reserving stock for an order ("/product/reserve").
+    Ensures the stock is taken out and the prices are returned.
+    """
+    response = client.post(
+        "/product/reserve",
+        json={
+            "items": [
+                {"product_id": 3, "number": 2},
+                {"product_id": 4, "number": 1},
+                {"product_id": 3, "number": 1},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    assert [(p["id"], p["price"], p["stock_left"]) for p in response.json()] == [
+        (3, 20, 27),
+        (4, 25, 39),
+    ]
+
+
+def test_reserve_products_insufficient_stock(client):
+    """
+    Test that a reservation is rejected as a whole when stock is short.
+    Ensures no stock is taken out of the other products.
+    """
+    response = client.post(
+        "/product/reserve",
+        json={
+            "items": [
+                {"product_id": 3, "number": 1},
+                {"product_id": 4, "number": 1000},
+            ]
+        },
+    )
+    assert response.status_code == 400
+
+    response = client.get("/product/3")
+    assert response.json()["stock_left"] == 27
+
+
+def test_reserve_with_reservation_id(client):
+    """
+    Test reservations made with an ID ("/product/reserve" and
+    "/product/reserve/{reservation_id}/release").
+    Ensures a retry does not take the stock twice, a release gives it back
+    once, and a release that arrives first refuses the late reservation.
+    """
+    product_id = client.post(
+        "/product", json={"name": "Reserved Teapot", "price": 15, "stock_left": 10}
+    ).json()["id"]
+    body = {
+        "items": [{"product_id": product_id, "number": 3}],
+        "reservation_id": "order-1",
+    }
+
+    first = client.post("/product/reserve", json=body)
+    retry = client.post("/product/reserve", json=body)
+    assert first.status_code == retry.status_code == 200
+    assert (
+        retry.json()
+        == first.json()
+        == [{"id": product_id, "name": "Reserved Teapot", "price": 15, "stock_left": 7}]
+    )
+    body["items"][0]["number"] = 4
+    assert client.post("/product/reserve", json=body).status_code == 422
+
+    for _ in range(2):
+        response = client.post("/product/reserve/order-1/release")
+        assert response.status_code == 200
+    assert response.json() == []
+    assert client.get(f"/product/{product_id}").json()["stock_left"] == 10
+    assert client.post("/product/reserve", json=body).status_code == 409
+
+    assert client.post("/product/reserve/order-2/release").json() == []
+    body["reservation_id"] = "order-2"
+    assert client.post("/product/reserve", json=body).status_code == 409
+    assert client.get(f"/product/{product_id}").json()["stock_left"] == 10
+
+
+def test_purge_expired_reservations(client):
+    """
+    Test the reservation cleanup.
+    Ensures records older than RESERVATION_TTL are deleted in batches, while
+    recent ones are kept.
+    """
+    old = datetime.now(timezone.utc) - timedelta(
+        seconds=reservations.RESERVATION_TTL + 60
+    )
+    expired = [uuid.uuid4().hex for _ in range(5)]
+    recent = uuid.uuid4().hex
+    db = Product_Session()
+    try:
+        db.add_all(
+            [
+                models.StockReservation(id=key, items={}, created_at=old)
+                for key in expired
+            ]
+            + [models.StockReservation(id=recent, items={})]
+        )
+        db.commit()
+
+        deleted = client.portal.call(
+            reservations.purge_expired_reservations, Async_Product_Session, 2
+        )
+        kept = {key for (key,) in db.query(models.StockReservation.id)}
+    finally:
+        db.close()
+
+    assert deleted >= 5
+    assert not kept & set(expired)
+    assert recent in kept
+
+
+def test_sharded_stock(client):
+    """
+    Test the sharded stock mode ("/product/{product_id}/shards").
+    Ensures clients see the same stock while it is split over shards, and
+    every way of changing stock takes from the shards.
+    """
+    product_id = client.post(
+        "/product", json={"name": "Flash Sale Kettle", "price": 40, "stock_left": 100}
+    ).json()["id"]
+
+    response = client.put(f"/product/{product_id}/shards", json={"shards": 4})
+    assert response.status_code == 200
+    assert response.json() == {
+        "id": product_id,
+        "name": "Flash Sale Kettle",
+        "price": 40,
+        "stock_left": 100,
+    }
+
+    def stock_left():
+        response = client.post("/product/getlist", json={"ids": [product_id]})
+        return response.json()[0]["stock_left"]
+
+    # More than one shard holds, so it is taken from several
+    response = client.post(
+        "/product/reserve", json={"items": [{"product_id": product_id, "number": 30}]}
+    )
+    assert response.status_code == 200
+    assert response.json()[0]["stock_left"] == 70
+    response = client.put(f"/product/{product_id}", json={"add_amount": -5})
+    assert response.json()["stock_left"] == 65
+    response = client.put(
+        "/product/stock",
+        json={
+            "items": [
+                {"product_id": product_id, "add_amount": 10},
+                {"product_id": 3, "add_amount": 1},
+            ]
+        },
+    )
+    assert [product["stock_left"] for product in response.json()] == [28, 75]
+    assert stock_left() == 75
+
+    response = client.post(
+        "/product/reserve",
+        json={
+            "items": [
+                {"product_id": 3, "number": 1},
+                {"product_id": product_id, "number": 76},
+            ]
+        },
+    )
+    assert response.status_code == 400
+    assert client.get("/product/3").json()["stock_left"] == 28
+    assert stock_left() == 75
+    assert client.put(f"/product/{product_id}", json={"add_amount": -76}).json() == {
+        "detail": "stock is not enough for this order"
+    }
+
+    with get_engine().connect() as connection:
+        shards = connection.execute(
+            select(models.ProductStockShard.stock_left).where(
+                models.ProductStockShard.product_id == product_id
+            )
+        ).scalars()
+        assert sum(shards) == 75
+
+    response = client.put(f"/product/{product_id}/shards", json={"shards": 0})
+    assert response.json()["stock_left"] == 75
+    assert stock_left() == 75
+    assert client.put("/product/9999/shards", json={"shards": 2}).status_code == 404
+
+
+def test_search_products(client):
+    """
+    Test searching products ("/products") by name words, price and stock,
+    and reading the results page by page.
+    """
+    ids = {}
+    for name, price, stock_left in (
+        ("Quokka Lamp Red", 20, 5),
+        ("Quokka Lamp Blue", 35, 0),
+        ("Quokka Desk", 120, 3),
+        ("Wombat Lamp", 25, 8),
+    ):
+        response = client.post(
+            "/product",
+            json={"name": name, "price": price, "stock_left": stock_left},
+        )
+        ids[name] = response.json()["id"]
+
+    def names(**params):
+        response = client.get("/products", params=params)
+        assert response.status_code == 200
+        return [product["name"] for product in response.json()["products"]]
+
+    assert names(q="quokka lamp") == ["Quokka Lamp Red", "Quokka Lamp Blue"]
+    assert names(q="quokka -lamp") == ["Quokka Desk"]
+    assert names(q="lamp", min_price=21, max_price=40) == [
+        "Quokka Lamp Blue",
+        "Wombat Lamp",
+    ]
+    assert names(q="lamp", in_stock=True) == ["Quokka Lamp Red", "Wombat Lamp"]
+    assert names(q="quokka", in_stock=False) == ["Quokka Lamp Blue"]
+    assert names(q="platypus") == []
+
+    # Keyset pages
+    page = client.get("/products", params={"q": "quokka", "limit": 2}).json()
+    assert [product["id"] for product in page["products"]] == [
+        ids["Quokka Lamp Red"],
+        ids["Quokka Lamp Blue"],
+    ]
+    assert page["next_after"] == ids["Quokka Lamp Blue"]
+    page = client.get(
+        "/products", params={"q": "quokka", "limit": 2, "after": page["next_after"]}
+    ).json()
+    assert page == {
+        "products": [
+            {
+                "id": ids["Quokka Desk"],
+                "name": "Quokka Desk",
+                "price": 120,
+                "stock_left": 3,
+            }
+        ],
+        "next_after": None,
+    }
+
+    assert client.get("/products", params={"limit": 0}).status_code == 422
+
+
+def test_search_sharded_products(client):
+    """
+    Test searching products ("/products") that are in sharded mode.
+    Ensures the stock is summed from the shards, and the in_stock filter
+    goes by that stock.
+    """
+    product_id = client.post(
+        "/product", json={"name": "Platypus Kettle", "price": 30, "stock_left": 100}
+    ).json()["id"]
+    client.put(f"/product/{product_id}/shards", json={"shards": 4})
+
+    def search(**params):
+        response = client.get("/products", params={"q": "platypus", **params})
+        assert response.status_code == 200
+        return response.json()["products"]
+
+    expected = [
+        {"id": product_id, "name": "Platypus Kettle", "price": 30, "stock_left": 100}
+    ]
+    assert search() == expected
+    assert search(in_stock=True) == expected
+    assert search(in_stock=False) == []
+
+
+def test_db_pool_status(client):
+    """
+    Test the connection pool status endpoint ("/db/pool").
+    Ensures pool occupancy and checkout wait statistics are reported.
+    """
+    response = client.get("/db/pool")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["pool_size"] >= 1
+    assert status["checkout_wait_seconds_max"] >= 0
+
+
+class FakeRedis:
+    """
+    Local stand-in for a redis.asyncio client, keeping values in a dict.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.round_trips = 0
+
+    async def mget(self, keys):
+        """Return the stored value or None for each key."""
+        self.round_trips += 1
+        return [self.values.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):  # pylint: disable=W0613
+        """Return a pipeline storing the queued values when executed."""
+        return FakePipeline(self)
+
+    async def delete(self, *names):
+        """Drop the given keys."""
+        self.round_trips += 1
+        for name in names:
+            self.values.pop(name, None)
+
+
+class FakePipeline:
+    """
+    Local stand-in for a redis.asyncio pipeline, queueing set calls.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.queued = []
+
+    def set(self, name, value, px=None):  # pylint: disable=W0613
+        """Queue the value, ignoring the expiry."""
+        self.queued.append((name, value))
+        return self
+
+    async def execute(self):
+        """Store the queued values in one round trip."""
+        self.redis.round_trips += 1
+        self.redis.values.update(self.queued)
+        return [True] * len(self.queued)
+
+
+def test_product_cache_hits(client):
+    """
+    Test that repeated product reads are served from the cache ("/cache/stats").
+    Ensures the hit counter goes up for cached reads.
+    """
+    client.get("/product/1")
+    before = client.get("/cache/stats").json()
+    client.get("/product/1")
+    client.post("/product/getlist", json={"ids": [1]})
+    after = client.get("/cache/stats").json()
+    assert after["hits"] == before["hits"] + 2
+
+
+def test_stock_update_refreshes_cache(client):
+    """
+    Test that a stock update replaces the cached product.
+    Ensures reads after a write never return the old stock.
+    """
+    assert client.get("/product/5").json()["stock_left"] == 50
+    client.put("/product/5", json={"add_amount": -1})
+    assert client.get("/product/5").json()["stock_left"] == 49
+    client.put("/product/stock", json={"items": [{"product_id": 5, "add_amount": 1}]})
+    assert client.get("/product/5").json()["stock_left"] == 50
+
+
+def test_coalesced_stock_updates(client):
+    """
+    Test that concurrent stock updates are applied in one batch.
+    Ensures each caller gets its own result, in arrival order, and that a
+    short or missing product does not fail the rest of the batch.
+    """
+    product_id = client.post(
+        "/product", json={"name": "Coalesced Lamp", "price": 12, "stock_left": 10}
+    ).json()["id"]
+    coalescer = app.state.stock_coalescer
+    batches = coalescer.batches
+
+    async def update_concurrently():
+        changes = [(product_id, delta) for delta in (-4, -4, -4, 3, -5)]
+        return await asyncio.gather(
+            *(coalescer.update_stock(*change) for change in changes + [(9999, -1)]),
+            return_exceptions=True,
+        )
+
+    results = client.portal.call(update_concurrently)
+    assert [result["stock_left"] for result in results[:2]] == [6, 2]
+    assert results[2].status_code == 400
+    assert [result["stock_left"] for result in results[3:5]] == [5, 0]
+    assert results[5].status_code == 404
+    assert coalescer.batches == batches + 1
+    assert client.get(f"/product/{product_id}").json()["stock_left"] == 0
+
+    response = client.put(f"/product/{product_id}", json={"add_amount": -1})
+    assert response.status_code == 400
+    assert response.json() == {"detail": "stock is not enough for this order"}
+    assert client.put("/product/9999", json={"add_amount": 1}).status_code == 404
+
+
+def test_single_flight_reads(client):
+    """
+    Test that concurrent reads missing the cache share one query.
+    Ensures every caller gets the product, and getlist requests for the same
+    IDs in another order count as identical.
+    """
+    reads = app.state.reads
+    calls, coalesced = reads.calls, reads.coalesced
+
+    async def read_concurrently():
+        await app.state.cache.delete_many([1, 2, 3])
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as http:
+            return await asyncio.gather(
+                *(http.get("/product/1") for _ in range(5)),
+                http.post("/product/getlist", json={"ids": [2, 3]}),
+                http.post("/product/getlist", json={"ids": [3, 2, 3]}),
+            )
+
+    responses = client.portal.call(read_concurrently)
+    assert [response.json()["id"] for response in responses[:5]] == [1] * 5
+    assert [product["id"] for product in responses[6].json()] == [3, 2]
+    assert reads.calls == calls + 2
+    assert reads.coalesced == coalesced + 5
+    assert "single_flight_coalesced_total" in client.get("/metrics").text
+
+
+def test_conditional_product_reads(client):
+    """
+    Test ETags and If-None-Match on "/product/{product_id}" and "/product/getlist".
+    Ensures an unchanged product is answered with 304, and every stock
+    change, sharded or not, gives the product a new ETag.
+    """
+    product_id = client.post(
+        "/product", json={"name": "Versioned Mug", "price": 9, "stock_left": 20}
+    ).json()["id"]
+    etag = client.get(f"/product/{product_id}").headers["ETag"]
+
+    response = client.get(f"/product/{product_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert not response.content
+    weak = {"If-None-Match": f'"0.0", W/{etag}'}
+    assert client.get(f"/product/{product_id}", headers=weak).status_code == 304
+
+    listed = client.post("/product/getlist", json={"ids": [product_id, 1]})
+    list_etag = listed.headers["ETag"]
+    response = client.post(
+        "/product/getlist",
+        json={"ids": [product_id, 1]},
+        headers={"If-None-Match": list_etag},
+    )
+    assert response.status_code == 304
+
+    etags = {etag}
+    for change in (
+        lambda: client.put(f"/product/{product_id}", json={"add_amount": -1}),
+        lambda: client.put(f"/product/{product_id}/shards", json={"shards": 2}),
+        lambda: client.post(
+            "/product/reserve",
+            json={"items": [{"product_id": product_id, "number": 1}]},
+        ),
+    ):
+        assert change().status_code == 200
+        response = client.get(f"/product/{product_id}", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+        assert etag not in etags
+        etags.add(etag)
+    assert response.json()["stock_left"] == 18
+
+    response = client.post(
+        "/product/getlist",
+        json={"ids": [product_id, 1]},
+        headers={"If-None-Match": list_etag},
+    )
+    assert response.status_code == 200
+    assert response.headers["ETag"] != list_etag
+    response = client.get("/product/9999", headers={"If-None-Match": "*"})
+    assert response.status_code == 404
+
+
+def test_lru_cache_eviction():
+    """
+    Test that the LRU cache drops the least recently used entry when full.
+    """
+    cache = LRUCache(max_entries=2, ttl=60)
+
+    async def scenario():
+        await cache.set_many({1: "a", 2: "b"})
+        await cache.get_many([1])
+        await cache.set_many({3: "c"})
+        return await cache.get_many([1, 2, 3])
+
+    assert asyncio.run(scenario()) == {1: "a", 3: "c"}
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_redis_cache_with_stand_in():
+    """
+    Test the Redis-protocol cache backend against a local stand-in.
+    """
+    redis = FakeRedis()
+    cache = RedisCache(redis)
+
+    async def scenario():
+        await cache.set_many({1: {"id": 1, "name": "a"}, 3: {"id": 3, "name": "c"}})
+        assert redis.round_trips == 1
+        found = await cache.get_many([1, 2])
+        await cache.delete_many([1])
+        return found, await cache.get_many([1])
+
+    assert asyncio.run(scenario()) == ({1: {"id": 1, "name": "a"}}, {})
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_metrics_endpoint(client):
+    """
+    Test the metrics endpoint ("/metrics").
+    Ensures requests are labelled by route template and that database time,
+    pool occupancy and cache counters are reported.
+    """
+    client.get("/product/1")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert (
+        'http_requests_total{method="GET",route="/product/{product_id}",status="200"}'
+        in body
+    )
+    assert "db_query_duration_seconds_count" in body
+    assert "db_pool_checked_out" in body
+    assert "product_cache_hits" in body
+
+
+def test_import_products_csv(client):
+    """
+    Test the product import endpoint ("/product/import") with a CSV body.
+    Ensures valid rows are inserted and invalid rows are reported by row number.
+    """
+    body = "name,price,stock_left\nImport A,10,5\nImport B,x,5\nImport C,3\n"
+    response = client.post(
+        "/product/import", content=body, headers={"content-type": "text/csv"}
+    )
+    assert response.status_code == 200
+    result = response.json()
+    assert {key: result[key] for key in ("received", "inserted", "failed")} == {
+        "received": 3,
+        "inserted": 1,
+        "failed": 2,
+    }
+    assert [error["row"] for error in result["errors"]] == [2, 3]
+    assert result["errors"][0]["error"].startswith("price:")
+
+
+def test_import_products_upsert(client, monkeypatch):
+    """
+    Test upserting products by name and by ID with an NDJSON body.
+    Ensures rows update matching products across chunks, unknown IDs are
+    rejected and cached products are refreshed.
+    """
+    monkeypatch.setattr(product_import, "IMPORT_CHUNK_SIZE", 2)
+    rows = [
+        {"name": "Import A", "price": 11, "stock_left": 6},
+        {"name": "Import D", "price": 4, "stock_left": 1},
+        {"name": "Import D", "price": 5, "stock_left": 2},
+    ]
+    body = "\n".join(json.dumps(row) for row in rows) + "\n[1]\n"
+    result = client.post("/product/import?upsert=name", content=body).json()
+    assert result["inserted"] == 1
+    assert result["updated"] == 2
+    assert result["errors"] == [{"row": 4, "error": "Expected a JSON object"}]
+
+    assert client.get("/product/5").json()["stock_left"] == 50
+    body = (
+        json.dumps({"id": 5, "name": "Imported", "price": 1, "stock_left": 7})
+        + "\n"
+        + json.dumps({"id": 999999, "name": "Nope", "price": 1, "stock_left": 1})
+    )
+    result = client.post("/product/import?upsert=id", content=body).json()
+    assert result["updated"] == 1
+    assert result["inserted"] == 0
+    assert result["errors"] == [{"row": 2, "error": "Product 999999 not found"}]
+    assert client.get("/product/5").json() == {
+        "id": 5,
+        "name": "Imported",
+        "price": 1,
+        "stock_left": 7,
+    }
+
+
+def test_import_read_lines_split_chunks():
+    """
+    Test that the import splits a body into lines across chunk boundaries,
+    including multi-byte characters cut in half.
+    """
+
+    async def body():
+        data = "name\r\ncafé\nlast".encode()
+        for i in range(0, len(data), 3):
+            yield data[i : i + 3]
+
+    async def collect():
+        return [line async for line in product_import.read_lines(body())]
+
+    assert asyncio.run(collect()) == ["name", "café", "last"]
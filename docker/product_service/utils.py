@@ -0,0 +1,612 @@
+# utils.py
+"""
+This module contains helper functions shared by the product APIs,
+such as applying stock changes to several products in one statement,
+applying a batch of coalesced stock changes, reserving stock for an order,
+searching the catalog, splitting the stock of hot products into shards and
+building the ETags of products.
+"""
+import hashlib
+from fastapi import HTTPException
+from sqlalchemy import (
+    Integer,
+    bindparam,
+    case,
+    column,
+    delete,
+    func,
+    literal_column,
+    select,
+    text,
+    update,
+    values,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+import models
+from schemas import ProductSchema, ProductSearchSchema
+
+# Must match the configuration of products.name_search; inlined, as a bound
+# parameter would be sent as VARCHAR rather than regconfig
+SEARCH_CONFIG = literal_column("'simple'")
+FORCE_CUSTOM_PLAN = text("SET LOCAL plan_cache_mode = force_custom_plan")
+
+
+def summed_over_shards(shard_column, plain_value):
+    """
+    Builds the value of a product that is summed from its shards while it is
+    sharded. The shards are only read for sharded products.
+
+    Args:
+        shard_column (Column): The ProductStockShard column to sum.
+        plain_value: The value for products that are not sharded.
+
+    Returns:
+        Case: The expression.
+    """
+    return case(
+        (
+            models.Product.stock_shards > 0,
+            select(func.coalesce(func.sum(shard_column), 0))
+            .where(models.ProductStockShard.product_id == models.Product.id)
+            .scalar_subquery(),
+        ),
+        else_=plain_value,
+    )
+
+
+STOCK_LEFT = summed_over_shards(
+    models.ProductStockShard.stock_left, models.Product.stock_left
+)
+# Every write to a shard bumps its version, and resharding bumps the product's,
+# so the pair changes whenever the stock of a sharded product does
+SHARD_VERSION = summed_over_shards(models.ProductStockShard.version, 0)
+PRODUCT_COLUMNS = (
+    models.Product.id,
+    models.Product.name,
+    models.Product.price,
+    STOCK_LEFT.label("stock_left"),
+    models.Product.version,
+    SHARD_VERSION.label("shard_version"),
+)
+
+
+def product_etag(version: int, shard_version: int = 0) -> str:
+    """
+    Builds the strong ETag of a product from its versions.
+
+    Args:
+        version (int): The version of the product row.
+        shard_version (int): The sum of the versions of its stock shards.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    return f'"{version}.{shard_version}"'
+
+
+def list_etag(etags) -> str:
+    """
+    Builds the strong ETag of a list of products from theirs.
+
+    Args:
+        etags (list): (product ID, ETag) pairs, in the order of the list.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    digest = hashlib.sha256(
+        ",".join(f"{product_id}:{etag}" for product_id, etag in etags).encode()
+    )
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def cache_entries(products) -> dict:
+    """
+    Builds product cache entries from ORM objects or result rows.
+
+    Entries are the ProductSchema fields plus the product's ETag, which the
+    response models leave out of the body.
+
+    Args:
+        products (list): Objects with the ProductSchema attributes and
+            version, and shard_version for products read with PRODUCT_COLUMNS.
+
+    Returns:
+        dict: The product dict for each product ID.
+    """
+    return {
+        product.id: {
+            **ProductSchema.model_validate(product, from_attributes=True).model_dump(),
+            "etag": product_etag(product.version, getattr(product, "shard_version", 0)),
+        }
+        for product in products
+    }
+
+
+async def read_etags(db: AsyncSession, ids) -> dict:
+    """
+    Reads the ETags of products, without reading or serializing the products.
+
+    Args:
+        db (AsyncSession): The database session.
+        ids (list): The product IDs.
+
+    Returns:
+        dict: The ETag of each product ID found.
+    """
+    result = await db.execute(
+        select(models.Product.id, models.Product.version, SHARD_VERSION).where(
+            models.Product.id.in_(ids)
+        )
+    )
+    return {
+        product_id: product_etag(version, shard_version)
+        for product_id, version, shard_version in result
+    }
+
+
+async def read_products(db: AsyncSession, ids) -> list:
+    """
+    Reads products with their stock, summing the shards of sharded products.
+
+    Args:
+        db (AsyncSession): The database session.
+        ids (list): The product IDs.
+
+    Returns:
+        list: The product rows found, ordered by ID.
+    """
+    result = await db.execute(
+        select(*PRODUCT_COLUMNS)
+        .where(models.Product.id.in_(ids))
+        .order_by(models.Product.id)
+    )
+    return result.all()
+
+
+def merge_stock_deltas(items) -> dict:
+    """
+    Merges stock changes per product.
+
+    Args:
+        items (list): Objects with product_id and add_amount attributes.
+
+    Returns:
+        dict: The summed stock change for each product ID.
+    """
+    deltas = {}
+    for item in items:
+        deltas[item.product_id] = deltas.get(item.product_id, 0) + item.add_amount
+    return deltas
+
+
+async def apply_stock_deltas(db: AsyncSession, deltas: dict, sharded_ids=()):
+    """
+    Applies stock changes to several products with one conditional UPDATE.
+
+    Only rows whose stock stays non-negative are updated. If any product is
+    missing or short of stock, nothing is changed and an HTTPException is raised,
+    so the whole batch succeeds or fails together. The caller commits.
+
+    The UPDATE locks rows in the order of its VALUES list, so the list is
+    sorted by product ID, like the locks of reserve_stock; concurrent batches
+    with the same products in another order then queue up instead of
+    deadlocking.
+
+    Products in sharded mode are skipped by the UPDATE and changed one shard
+    at a time by apply_shard_delta, after the other products and in ID order.
+
+    Args:
+        db (AsyncSession): The database session.
+        deltas (dict): The stock change for each product ID.
+        sharded_ids (set): IDs the caller knows are not plain products, which
+            the UPDATE can leave out.
+
+    Returns:
+        list: The updated product rows, ordered by ID.
+
+    Raises:
+        HTTPException: 404 if a product does not exist, 400 if stock is not enough.
+    """
+    product = models.Product
+    rows = []
+    plain = sorted(item for item in deltas.items() if item[0] not in sharded_ids)
+    if plain:
+        stock = values(
+            column("product_id", Integer), column("delta", Integer), name="stock"
+        ).data(plain)
+        result = await db.execute(
+            update(product)
+            .where(product.id == stock.c.product_id)
+            .where(product.stock_shards == 0)
+            .where(product.stock_left + stock.c.delta >= 0)
+            .values(
+                stock_left=product.stock_left + stock.c.delta,
+                version=product.version + 1,
+            )
+            .returning(
+                product.id,
+                product.name,
+                product.price,
+                product.stock_left,
+                product.version,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        rows = result.all()
+
+    # The rest are sharded, or missing or short, which finds no shard to change
+    remaining_ids = sorted(set(deltas) - {row.id for row in rows})
+    applied_ids = [
+        product_id
+        for product_id in remaining_ids
+        if await apply_shard_delta(db, product_id, deltas[product_id])
+    ]
+    if applied_ids:
+        rows.extend(await read_products(db, applied_ids))
+
+    if len(rows) != len(deltas):
+        await db.rollback()
+        found = await db.execute(
+            select(product.id).where(product.id.in_(deltas.keys()))
+        )
+        found_ids = set(found.scalars().all())
+        missing_ids = set(deltas) - found_ids
+        if missing_ids:
+            raise HTTPException(
+                status_code=404,
+                detail=f"Products not found for the following IDs: {missing_ids}",
+            )
+        short_ids = found_ids - {row.id for row in rows}
+        raise HTTPException(
+            status_code=400,
+            detail=f"stock is not enough for the following IDs: {short_ids}",
+        )
+
+    return sorted(rows, key=lambda row: row.id)
+
+
+async def set_stock_left(db: AsyncSession, stock: dict):
+    """
+    Sets the stock and version of several products with one UPDATE. The
+    caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        stock (dict): The new (stock, version) for each product ID.
+    """
+    product = models.Product
+    new_stock = values(
+        column("product_id", Integer),
+        column("stock_left", Integer),
+        column("version", Integer),
+        name="stock",
+    ).data([(product_id, *row) for product_id, row in stock.items()])
+    await db.execute(
+        update(product)
+        .where(product.id == new_stock.c.product_id)
+        .values(stock_left=new_stock.c.stock_left, version=new_stock.c.version)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def apply_stock_changes_in_order(db: AsyncSession, changes: list) -> list:
+    """
+    Applies stock changes from several callers as if one after the other.
+
+    Unlike apply_stock_deltas, each change succeeds or fails on its own: the
+    plain products are locked in ID order, the changes are checked against
+    the running stock in the order given, and the accepted ones are written
+    with one UPDATE. Each accepted change bumps the version, so every caller
+    gets the ETag of its own result. Changes to products in sharded mode go
+    to one shard each, as in apply_stock_deltas. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        changes (list): (product ID, stock change) pairs, in arrival order.
+
+    Returns:
+        list: For each change, the product cache entry after it was applied,
+        or an HTTPException, 404 if the product does not exist and 400 if stock is
+        not enough.
+    """
+    product = models.Product
+    locked = (
+        select(
+            product.id, product.name, product.price, product.stock_left, product.version
+        )
+        .where(product.id.in_({product_id for product_id, _ in changes}))
+        .where(product.stock_shards == 0)
+        .order_by(product.id)
+        .with_for_update()
+    )
+    plain = {row.id: row._asdict() for row in await db.execute(locked)}
+
+    # Each outcome is a product dict, or (applied, product ID) to resolve
+    # below; plain keeps the running stock and version of the locked products
+    outcomes, changed_ids = [None] * len(changes), set()
+    for index, (product_id, delta) in enumerate(changes):
+        if product_id not in plain:
+            continue
+        if plain[product_id]["stock_left"] + delta < 0:
+            outcomes[index] = (False, product_id)
+        else:
+            plain[product_id]["stock_left"] += delta
+            plain[product_id]["version"] += 1
+            changed_ids.add(product_id)
+            outcomes[index] = dict(plain[product_id])
+            outcomes[index]["etag"] = product_etag(outcomes[index].pop("version"))
+
+    # The rest are sharded, or missing; their shards are locked in ID order,
+    # as in apply_stock_deltas, so overlapping batches cannot deadlock
+    unlocked = sorted(
+        (index for index, outcome in enumerate(outcomes) if outcome is None),
+        key=lambda index: changes[index][0],
+    )
+    for index in unlocked:
+        product_id, delta = changes[index]
+        outcomes[index] = (await apply_shard_delta(db, product_id, delta), product_id)
+
+    if changed_ids:
+        await set_stock_left(
+            db,
+            {
+                product_id: (
+                    plain[product_id]["stock_left"],
+                    plain[product_id]["version"],
+                )
+                for product_id in changed_ids
+            },
+        )
+
+    # Sharded products report their stock after the whole batch; products
+    # that were not locked and are not found either do not exist
+    found = {}
+    if unlocked:
+        unlocked_ids = {changes[index][0] for index in unlocked}
+        found = cache_entries(await read_products(db, unlocked_ids))
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, dict):
+            continue
+        applied, product_id = outcome
+        if applied:
+            outcomes[index] = found[product_id]
+        elif product_id in plain or product_id in found:
+            outcomes[index] = HTTPException(
+                status_code=400, detail="stock is not enough for this order"
+            )
+        else:
+            outcomes[index] = HTTPException(status_code=404, detail="Product not found")
+    return outcomes
+
+
+def shard_delta_statement(skip_locked: bool):
+    """
+    Builds the UPDATE adding :stock_delta to the stock of one random shard of
+    :stock_product_id that stays non-negative, returning the shard changed.
+
+    Args:
+        skip_locked (bool): Whether to pass over shards locked by other
+            transactions instead of waiting for them.
+
+    Returns:
+        Update: The statement.
+    """
+    shard = models.ProductStockShard
+    candidate = aliased(shard)
+    # Named apart from the columns, which UPDATE reserves for SET values
+    product_id, delta = bindparam("stock_product_id"), bindparam("stock_delta")
+    some_shard = (
+        select(candidate.shard)
+        .where(candidate.product_id == product_id)
+        .where(candidate.stock_left + delta >= 0)
+        .order_by(func.random())
+        .limit(1)
+        .with_for_update(skip_locked=skip_locked)
+        .scalar_subquery()
+    )
+    return (
+        update(shard)
+        .where(shard.product_id == product_id)
+        .where(shard.shard == some_shard)
+        .values(stock_left=shard.stock_left + delta, version=shard.version + 1)
+        .returning(shard.shard)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Built once, as they are run for every order of a product in sharded mode
+SHARD_DELTA = {
+    skip_locked: shard_delta_statement(skip_locked) for skip_locked in (True, False)
+}
+
+
+async def apply_shard_delta(db: AsyncSession, product_id: int, delta: int) -> bool:
+    """
+    Applies a stock change to a product in sharded mode.
+
+    The change goes to a random shard that can take it and is not locked by
+    another transaction, so concurrent orders for the product rarely wait
+    for each other. If every such shard is locked, it waits for one of them
+    at random, which keeps the queues even. Only if no single shard has
+    enough stock are all shards locked in order and the change spread over
+    them. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        product_id (int): The product ID.
+        delta (int): The stock change.
+
+    Returns:
+        bool: Whether the change was applied; False if stock is not enough.
+    """
+    for skip_locked in (True, False):
+        result = await db.execute(
+            SHARD_DELTA[skip_locked],
+            {"stock_product_id": product_id, "stock_delta": delta},
+        )
+        if result.first():
+            return True
+
+    shard = models.ProductStockShard
+    result = await db.execute(
+        select(shard)
+        .where(shard.product_id == product_id)
+        .order_by(shard.shard)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+    shards = result.scalars().all()
+    if not shards or sum(s.stock_left for s in shards) + delta < 0:
+        return False
+    if delta >= 0:
+        shards[0].stock_left += delta
+    else:
+        needed = -delta
+        for s in shards:
+            taken = min(s.stock_left, needed)
+            s.stock_left -= taken
+            needed -= taken
+    # The product's ETag sums the shard versions, so one bump changes it
+    shards[0].version += 1
+    await db.flush()
+    return True
+
+
+async def reserve_stock(db: AsyncSession, quantities: dict):
+    """
+    Locks the requested products, checks their stock and takes the quantities out.
+
+    The rows are locked in ID order with SELECT ... FOR UPDATE so concurrent
+    reservations of the same products queue up instead of both passing the
+    stock check. Products in sharded mode are not locked or checked here;
+    apply_stock_deltas takes their quantities from one shard each, and raises
+    if they are missing or short. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        quantities (dict): The quantity to reserve for each product ID.
+
+    Returns:
+        list: The updated product rows with their prices, ordered by ID.
+
+    Raises:
+        HTTPException: 404 if a product does not exist, 400 if stock is not enough.
+    """
+    result = await db.execute(
+        select(models.Product)
+        .where(models.Product.id.in_(quantities.keys()))
+        .where(models.Product.stock_shards == 0)
+        .order_by(models.Product.id)
+        .with_for_update()
+    )
+    products = result.scalars().all()
+
+    stock_less_than_order = [
+        product for product in products if product.stock_left < quantities[product.id]
+    ]
+    if stock_less_than_order:
+        error_details = "\n".join(
+            f"Product {product.name} - Ordered: {quantities[product.id]}"
+            for product in stock_less_than_order
+        )
+        await db.rollback()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Some products have insufficient stock:\n{error_details}",
+        )
+
+    return await apply_stock_deltas(
+        db,
+        {product_id: -number for product_id, number in quantities.items()},
+        sharded_ids=set(quantities) - {product.id for product in products},
+    )
+
+
+async def search_products(db: AsyncSession, search: ProductSearchSchema) -> dict:
+    """
+    Reads one page of matching products in ascending ID order, using keyset
+    pagination.
+
+    Words are matched with the GIN index on name_search and price ranges with
+    the price index. The planner picks between them and walking the primary
+    key until the page is full, depending on how many products match. The
+    stock of sharded products is summed from their shards, as everywhere else.
+
+    Args:
+        db (AsyncSession): The database session.
+        search (ProductSearchSchema): The filters, cursor and page size.
+
+    Returns:
+        dict: The products and the next_after cursor, None on the last page.
+    """
+    product = models.Product
+    query = (
+        select(product.id, product.name, product.price, STOCK_LEFT.label("stock_left"))
+        .order_by(product.id)
+        .limit(search.limit + 1)
+    )
+    if search.q:
+        words = func.websearch_to_tsquery(SEARCH_CONFIG, search.q)
+        query = query.where(product.name_search.bool_op("@@")(words))
+        # asyncpg prepares the statement, and after a few runs Postgres may
+        # switch to a generic plan that ignores the words; that plan walks the
+        # primary key and takes seconds for rare words
+        await db.execute(FORCE_CUSTOM_PLAN)
+    if search.min_price is not None:
+        query = query.where(product.price >= search.min_price)
+    if search.max_price is not None:
+        query = query.where(product.price <= search.max_price)
+    if search.in_stock is not None:
+        query = query.where(STOCK_LEFT > 0 if search.in_stock else STOCK_LEFT <= 0)
+    if search.after is not None:
+        query = query.where(product.id > search.after)
+    rows = (await db.execute(query)).mappings().all()
+    products = [dict(row) for row in rows[: search.limit]]
+    next_after = products[-1]["id"] if len(rows) > search.limit else None
+    return {"products": products, "next_after": next_after}
+
+
+async def set_stock_shards(db: AsyncSession, product_id: int, shards: int):
+    """
+    Switches a product into or out of sharded mode.
+
+    The product and its shards are locked, and the stock is spread evenly
+    over the new number of shards, or moved back to the product for 0
+    shards. The stock itself does not change. The caller commits.
+
+    Args:
+        db (AsyncSession): The database session.
+        product_id (int): The product ID.
+        shards (int): The number of stock shards, 0 to stop sharding.
+
+    Returns:
+        Row: The product with its stock.
+
+    Raises:
+        HTTPException: 404 if the product does not exist.
+    """
+    product = await db.get(models.Product, product_id, with_for_update=True)
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    shard = models.ProductStockShard
+    result = await db.execute(
+        select(shard.stock_left).where(shard.product_id == product_id).with_for_update()
+    )
+    total = product.stock_left + sum(result.scalars().all())
+    await db.execute(delete(shard).where(shard.product_id == product_id))
+    db.add_all(
+        shard(
+            product_id=product_id,
+            shard=number,
+            stock_left=total // shards + (number < total % shards),
+        )
+        for number in range(shards)
+    )
+    product.stock_left = 0 if shards else total
+    product.stock_shards = shards
+    product.version += 1
+    await db.flush()
+    return (await read_products(db, [product_id]))[0]
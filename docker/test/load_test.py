@@ -0,0 +1,260 @@
+"""
+Load test and benchmark for the three-service order flow.
+
+It seeds users, products and a few orders, then drives each scenario at each
+concurrency level for a fixed duration and reports requests per second,
+p50/p95/p99 latency and the error rate as JSON. Given a baseline file it
+compares every scenario and level against it and exits with status 1 if
+throughput dropped, tail latency grew or errors rose beyond the tolerance.
+
+Usage:
+    python load_test.py --concurrency 1 10 50 --duration 10
+    python load_test.py --baseline baseline.json
+    python load_test.py --save-baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+
+import httpx
+
+ORDER_SERVICE_URL = "http://order-service:8000"
+USER_SERVICE_URL = "http://user-service:8000"
+PRODUCT_SERVICE_URL = "http://product-service:8000"
+
+SCENARIOS = ("get_user", "get_products", "get_order", "post_order")
+
+# Requests in flight at once while seeding
+SEED_CONCURRENCY = 20
+
+# Seconds to wait for the services to accept requests
+READY_TIMEOUT = 60
+
+
+async def gather_limited(calls, limit: int = SEED_CONCURRENCY) -> list:
+    """Await the calls with at most limit in flight and return their results."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(call):
+        async with semaphore:
+            return await call()
+
+    return await asyncio.gather(*(run(call) for call in calls))
+
+
+async def wait_ready(client, urls, timeout: float = READY_TIMEOUT):
+    """Poll the root endpoint of every service until each one answers."""
+    deadline = time.perf_counter() + timeout
+    for url in urls:
+        while True:
+            try:
+                if (await client.get(f"{url}/")).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError(f"{url} did not become ready in {timeout}s")
+            await asyncio.sleep(0.5)
+
+
+async def post_json(client, url: str, body: dict) -> dict:
+    """POST a JSON body and return the JSON response, failing on an error status."""
+    response = await client.post(url, json=body)
+    response.raise_for_status()
+    return response.json()
+
+
+async def seed(client, args):
+    """Create the users, products and orders the scenarios read and order from."""
+    users = await post_json(
+        client,
+        f"{args.user_url}/users/bulk",
+        {"users": [{"name": f"Load {i}"} for i in range(args.users)]},
+    )
+    products = await gather_limited(
+        [
+            lambda i=i: post_json(
+                client,
+                f"{args.product_url}/product",
+                {"name": f"Load Product {i}", "price": 10, "stock_left": 10**9},
+            )
+            for i in range(args.products)
+        ]
+    )
+    user_ids = users["ids"]
+    product_ids = [product["id"] for product in products]
+    orders = await gather_limited(
+        [
+            lambda: post_json(
+                client, f"{args.order_url}/order", order_body(user_ids, product_ids)
+            )
+            for _ in range(args.orders)
+        ]
+    )
+    return user_ids, product_ids, [order["id"] for order in orders]
+
+
+def order_body(user_ids, product_ids) -> dict:
+    """Build an order of one unit of up to three random products."""
+    items = [
+        {"product_id": product_id, "number": 1}
+        for product_id in random.sample(product_ids, min(3, len(product_ids)))
+    ]
+    return {"user_id": random.choice(user_ids), "items": items}
+
+
+def build_scenarios(args, user_ids, product_ids, order_ids):
+    """Map each scenario name to a function that sends one request."""
+
+    def get_user(client):
+        return client.get(f"{args.user_url}/user/{random.choice(user_ids)}")
+
+    def get_products(client):
+        ids = random.sample(product_ids, min(5, len(product_ids)))
+        return client.post(f"{args.product_url}/product/getlist", json={"ids": ids})
+
+    def get_order(client):
+        return client.get(f"{args.order_url}/order/{random.choice(order_ids)}")
+
+    def post_order(client):
+        return client.post(
+            f"{args.order_url}/order", json=order_body(user_ids, product_ids)
+        )
+
+    return {
+        "get_user": get_user,
+        "get_products": get_products,
+        "get_order": get_order,
+        "post_order": post_order,
+    }
+
+
+def percentile(latencies, q: float) -> float:
+    """Return the nearest-rank percentile of sorted latencies."""
+    return latencies[max(math.ceil(q * len(latencies)) - 1, 0)]
+
+
+async def run_scenario(client, send, concurrency: int, duration: float) -> dict:
+    """Run one scenario with concurrency workers for duration seconds."""
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                response = await send(client)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "error_rate": round(errors / len(latencies), 4),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    List the scenarios and levels that regressed against the baseline.
+
+    A level regresses if its throughput is lower or its p99 higher than the
+    baseline by more than the tolerance, or its error rate grew by more than
+    one percentage point. Levels missing from the baseline are skipped.
+    """
+    regressions = []
+    for scenario, levels in results.items():
+        for level, current in levels.items():
+            base = baseline["results"].get(scenario, {}).get(level)
+            if base is None:
+                continue
+            checks = (
+                ("rps", current["rps"] < base["rps"] * (1 - tolerance)),
+                ("p99_ms", current["p99_ms"] > base["p99_ms"] * (1 + tolerance)),
+                ("error_rate", current["error_rate"] > base["error_rate"] + 0.01),
+            )
+            for metric, regressed in checks:
+                if regressed:
+                    regressions.append(
+                        {
+                            "scenario": scenario,
+                            "concurrency": int(level),
+                            "metric": metric,
+                            "baseline": base[metric],
+                            "current": current[metric],
+                        }
+                    )
+    return regressions
+
+
+async def main(args) -> dict:
+    """Seed the services, run every scenario at every level and collect the results."""
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        await wait_ready(client, (args.user_url, args.product_url, args.order_url))
+        user_ids, product_ids, order_ids = await seed(client, args)
+        scenarios = build_scenarios(args, user_ids, product_ids, order_ids)
+        results = {}
+        for name in args.scenarios:
+            results[name] = {}
+            for concurrency in args.concurrency:
+                await run_scenario(client, scenarios[name], concurrency, args.warmup)
+                results[name][str(concurrency)] = await run_scenario(
+                    client, scenarios[name], concurrency, args.duration
+                )
+    config = {
+        key: getattr(args, key)
+        for key in ("users", "products", "orders", "concurrency", "duration")
+    }
+    return {"config": config, "results": results}
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--order-url", default=ORDER_SERVICE_URL)
+    parser.add_argument("--user-url", default=USER_SERVICE_URL)
+    parser.add_argument("--product-url", default=PRODUCT_SERVICE_URL)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--products", type=int, default=100)
+    parser.add_argument("--orders", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=1)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--baseline", help="compare against this results file")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    report = asyncio.run(main(arguments))
+    if arguments.save_baseline:
+        with open(arguments.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if arguments.baseline:
+        with open(arguments.baseline, encoding="utf-8") as f:
+            report["regressions"] = compare(
+                report["results"], json.load(f), arguments.tolerance
+            )
+    print(json.dumps(report, indent=2))
+    if report.get("regressions"):
+        sys.exit(1)
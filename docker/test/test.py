@@ -84,10 +84,15 @@ async def test_post_order():
         assert order_id is not None
 
         # Verify user and product details have been updated
-        # Check if the user has an order_id now
-        response = await client.get(f"{user_service_url}/user/{user_id}")
-        assert response.status_code == 200
-        user_data = response.json()
+        # Check if the user has an order_id now; the order service adds it
+        # through its outbox shortly after responding, so poll for it
+        for _ in range(50):
+            response = await client.get(f"{user_service_url}/user/{user_id}")
+            assert response.status_code == 200
+            user_data = response.json()
+            if order_id in user_data["orders"]:
+                break
+            await asyncio.sleep(0.1)
         assert order_id in user_data["orders"]  # Verify the order was linked to the user
 
         # Check if the product stock has been reduced
@@ -0,0 +1,106 @@
+"""
+Benchmark for creating and reading users one at a time versus in bulk.
+
+It sends requests to the user service app in process, through httpx's ASGI
+transport, so the numbers include request handling but not the network.
+The "single" mode creates every user with POST /user and reads them back with
+GET /user/{id}; the "bulk" mode uses POST /users/bulk and POST /users/getlist
+in chunks. Users written by the benchmark are deleted afterwards.
+
+Usage:
+    ENV=local python bench_users_bulk.py --users 10000 --chunk 1000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from sqlalchemy import delete
+
+import models
+from database import Async_User_Session, dispose_engines, init_engines
+from main import app
+
+BENCH_NAME = "bench-user"
+
+
+async def run_single(client, num_users: int) -> tuple:
+    """Create and read the users one request at a time."""
+    start = time.perf_counter()
+    ids = []
+    for _ in range(num_users):
+        response = await client.post("/user", json={"name": BENCH_NAME})
+        ids.append(response.json()["id"])
+    created = time.perf_counter()
+    for user_id in ids:
+        (await client.get(f"/user/{user_id}")).raise_for_status()
+    return ids, created - start, time.perf_counter() - created
+
+
+async def run_bulk(client, num_users: int, chunk: int) -> tuple:
+    """Create and read the users with the bulk endpoints, chunk users per request."""
+    start = time.perf_counter()
+    ids = []
+    for offset in range(0, num_users, chunk):
+        size = min(chunk, num_users - offset)
+        response = await client.post(
+            "/users/bulk", json={"users": [{"name": BENCH_NAME}] * size}
+        )
+        ids.extend(response.json()["ids"])
+    created = time.perf_counter()
+    for offset in range(0, num_users, chunk):
+        response = await client.post(
+            "/users/getlist", json={"ids": ids[offset : offset + chunk]}
+        )
+        response.raise_for_status()
+    return ids, created - start, time.perf_counter() - created
+
+
+async def cleanup(ids):
+    """Delete the users written by the benchmark."""
+    async with Async_User_Session() as db:
+        await db.execute(delete(models.User).where(models.User.id.in_(ids)))
+        await db.commit()
+
+
+async def run_all(num_users: int, chunk: int) -> list:
+    """Run both modes and summarise users per second for creates and reads."""
+    init_engines()
+    results = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for mode, run in (
+            ("single", run_single),
+            ("bulk", lambda c, n: run_bulk(c, n, chunk)),
+        ):
+            ids, create_seconds, read_seconds = await run(client, num_users)
+            await cleanup(ids)
+            results.append(
+                {
+                    "mode": mode,
+                    "users": num_users,
+                    "create_seconds": round(create_seconds, 3),
+                    "creates_per_sec": round(num_users / create_seconds, 1),
+                    "read_seconds": round(read_seconds, 3),
+                    "reads_per_sec": round(num_users / read_seconds, 1),
+                }
+            )
+    await dispose_engines()
+    return results
+
+
+def main():
+    """Parse arguments, run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--chunk", type=int, default=1000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_all(args.users, args.chunk)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,32 @@
 This module contains the database configuration and session management for the application.
 It defines the connection to the PostgreSQL database -
 and provides a sessionmaker for interacting with the database.
+Request handlers use AsyncSession on an asyncpg engine so database calls never
+block the event loop; the synchronous engine is kept for migrations and scripts.
+Neither engine is created until first needed, so importing a module does not
+touch the database.
 """
 
 import os
+import time
 import base64
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from metrics import instrument_engine
 
 ENV = os.getenv("ENV", "eks")
 
+# Connection pool settings, tunable per deployment
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() == "true"
+
 DATABASE_URLS = {
     "local": "postgresql://andyg:@localhost:5432/postgres",
     "docker": "postgresql://user:password@db:5432/app_db",
@@ -19,46 +36,174 @@ DATABASE_URLS = {
     "eks": None,  # Will be dynamically built from environment variables
 }
 
-if ENV == "eks":
-    DB_USERNAME = os.getenv("DB_USERNAME")
-    DB_ENDPOINT = os.getenv("DB_ENDPOINT")
-    DB_PASSWORD = os.getenv("DB_PASSWORD")
-    DB_NAME = os.getenv("DB_NAME")
 
-    DB_USERNAME = base64.b64decode(DB_USERNAME).decode("utf-8")
-    DB_ENDPOINT = base64.b64decode(DB_ENDPOINT).decode("utf-8")
-    DB_PASSWORD = base64.b64decode(DB_PASSWORD).decode("utf-8")
-    DB_NAME = base64.b64decode(DB_NAME).decode("utf-8")
+def database_url() -> str:
+    """
+    Builds the database URL for ENV.
+
+    On EKS the connection details are decoded from base64-encoded secrets in
+    the environment; this happens when the engines are created, not at import.
+
+    Returns:
+        str: The database URL for the psycopg2 driver.
+
+    Raises:
+        ValueError: If ENV has no database configuration.
+    """
+    if ENV == "eks":
+        username, endpoint, password, name = (
+            base64.b64decode(os.getenv(variable)).decode("utf-8")
+            for variable in ("DB_USERNAME", "DB_ENDPOINT", "DB_PASSWORD", "DB_NAME")
+        )
+        return f"postgresql://{username}:{password}@{endpoint}/{name}"
+    if not DATABASE_URLS.get(ENV):
+        raise ValueError(
+            f"Invalid environment '{ENV}' or missing database configuration."
+        )
+    return DATABASE_URLS[ENV]
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waits for a connection.
+
+    The wait includes opening a new connection when the pool grows, so a
+    high total or maximum means the pool is too small for the pod's load.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """TimedQueuePool variant for asyncio engines."""
+
+
+def create_db_engine(url: str, is_async: bool = False):
+    """
+    Creates a database engine configured from the DB_* environment variables.
+
+    Args:
+        url (str): The database URL.
+        is_async (bool): Create an AsyncEngine for an asyncio driver such as asyncpg.
 
-if ENV == "eks":
-    SQLALCHEMY_DATABASE_URL = (
-        f"postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_ENDPOINT}/{DB_NAME}"
+    Returns:
+        Engine | AsyncEngine: A SQLAlchemy engine with a timed queue pool.
+    """
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS and is_async:
+        connect_args["server_settings"] = {
+            "statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)
+        }
+    elif DB_STATEMENT_TIMEOUT_MS:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    return (create_async_engine if is_async else create_engine)(
+        url,
+        echo=DB_ECHO,
+        poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
     )
-else:
-    SQLALCHEMY_DATABASE_URL = DATABASE_URLS[ENV]
 
-if not SQLALCHEMY_DATABASE_URL:
-    raise ValueError(f"Invalid environment '{ENV}' or missing database configuration.")
 
+def pool_status() -> dict:
+    """
+    Reports the occupancy and checkout wait time of the request connection pool.
+
+    Returns:
+        dict: Pool size, connections in use, overflow and checkout wait statistics.
+    """
+    pool = get_async_engine().sync_engine.pool
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "checkouts": pool.checkouts,
+        "checkout_wait_seconds_total": round(pool.checkout_wait_total, 6),
+        "checkout_wait_seconds_max": round(pool.checkout_wait_max, 6),
+    }
+
+
+# Bound to the engines by init_engines
+User_Session = sessionmaker(autocommit=False, autoflush=False)
+Async_User_Session = sessionmaker(
+    class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
+# Created on first use, so importing the app does not need the database
+ENGINES = {}
+
+
+def init_engines():
+    """
+    Creates the database engines on the first call and binds the session factories.
+
+    Creating an engine does not connect; connections are opened as the pools
+    need them. The app's lifespan calls this before serving, scripts call it
+    through get_engine or get_async_engine.
+
+    Returns:
+        AsyncEngine: The engine used by request handlers.
+    """
+    if not ENGINES:
+        url = database_url()
+        ENGINES["sync"] = create_db_engine(url)
+        ENGINES["async"] = create_db_engine(
+            url.replace("postgresql://", "postgresql+asyncpg://", 1), is_async=True
+        )
+        instrument_engine(ENGINES["async"].sync_engine)
+        User_Session.configure(bind=ENGINES["sync"])
+        Async_User_Session.configure(bind=ENGINES["async"])
+    return ENGINES["async"]
+
+
+def get_engine():
+    """Return the synchronous engine, used for migrations and scripts."""
+    init_engines()
+    return ENGINES["sync"]
+
+
+def get_async_engine():
+    """Return the asyncio engine, used by request handlers."""
+    return init_engines()
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
 
-User_Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async def dispose_engines():
+    """Close the pooled connections of the engines, e.g. on shutdown."""
+    if ENGINES:
+        await ENGINES["async"].dispose()
+        ENGINES["sync"].dispose()
 
 
-def get_db():
+async def get_db():
     """
-    Dependency function to get a database session.
+    Dependency function to get an async database session.
 
     This function can be used as a dependency in FastAPI routes to provide a
     database session for each request. It ensures that the session is closed
     after the request is processed.
 
     Returns:
-        Session: A SQLAlchemy session object.
+        AsyncSession: A SQLAlchemy async session object.
     """
-    db = User_Session()
-    try:
+    async with Async_User_Session() as db:
         yield db
-    finally:
-        db.close()
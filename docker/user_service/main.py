@@ -1,19 +1,100 @@
 # main.py
 """This module provides user-related APIs for user creation and retrieval."""
 
+import asyncio
 import logging
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from fastapi import FastAPI, Depends, HTTPException
+from contextlib import asynccontextmanager
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse
 import models
-from database import engine, get_db
-from schemas import UserCreateSchema, UserSchema, UserOrderUpdateSchema
-
-models.Base.metadata.create_all(engine)
+from database import Async_User_Session, dispose_engines, get_db, get_engine
+from database import init_engines, pool_status
+from metrics import MetricsMiddleware, render_metrics
+from migrate import HEAD, MIGRATE_ON_STARTUP, current_version, migrate
+from schemas import (
+    USER_LIST_ADAPTER,
+    UserCreateSchema,
+    UserSchema,
+    UserOrderUpdateSchema,
+    UserOrderPageSchema,
+    UserBulkCreateSchema,
+    UserRequireSchema,
+)
+from serialization import adapter_response, default_response_class
+from serialization import etag_matches, not_modified
+from singleflight import SingleFlight
+from utils import create_users, get_order_ids, load_user, load_users, read_user_etag
 
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI):
+    """Create the database engines and the single-flight layer for the app lifetime."""
+    init_engines()
+    if MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrate, get_engine())
+    fastapi_app.state.reads = SingleFlight()
+    try:
+        yield
+    finally:
+        await dispose_engines()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=default_response_class())
+app.add_middleware(MetricsMiddleware)
+
+
+def get_reads(http_request: Request):
+    """Dependency returning the single-flight layer for reads."""
+    return http_request.app.state.reads
+
+
+async def read_users(user_ids) -> dict:
+    """
+    Loads users with load_users, in a session of their own.
+
+    Args:
+        user_ids (list): The IDs of the users.
+
+    Returns:
+        dict: The users in UserSchema shape, keyed by ID.
+    """
+    async with Async_User_Session() as db:
+        return await load_users(db, user_ids)
+
+
+async def read_user(user_id: int):
+    """
+    Loads a user with load_user, in a session of their own.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        dict: The user in UserSchema shape, or None if the user does not exist.
+    """
+    async with Async_User_Session() as db:
+        return await load_user(db, user_id)
+
+
+async def current_etag(user_id: int):
+    """
+    Reads the current ETag of a user, in a session of their own.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        str: The ETag, or None if the user does not exist.
+    """
+    async with Async_User_Session() as db:
+        return await read_user_etag(db, user_id)
 
 
 @app.get("/")
@@ -22,8 +103,52 @@ def get_index():
     return {"msg": "User service"}
 
 
+@app.get("/metrics")
+def get_metrics(reads=Depends(get_reads)):
+    """Serve request and database metrics in Prometheus text format."""
+    return Response(
+        render_metrics({"db_pool": pool_status(), "single_flight": reads.stats()}),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/db/pool")
+def get_pool_status():
+    """Report database connection pool occupancy and checkout wait time."""
+    return pool_status()
+
+
+@app.get("/healthz")
+def get_healthz():
+    """Report that the process is up, without touching the database."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def get_readyz(db: AsyncSession = Depends(get_db)):
+    """
+    Report whether the service can take traffic.
+
+    Returns:
+        dict: The schema version, if the database answers and is migrated.
+        A 503 response otherwise.
+    """
+    try:
+        version = await db.run_sync(current_version)
+    except (SQLAlchemyError, OSError) as e:
+        return JSONResponse(
+            {"status": "unavailable", "detail": str(e)}, status_code=503
+        )
+    if version < HEAD:
+        return JSONResponse(
+            {"status": "unmigrated", "schema_version": version, "required": HEAD},
+            status_code=503,
+        )
+    return {"status": "ready", "schema_version": version}
+
+
 @app.post("/user")
-def post_user(request: UserCreateSchema, db: Session = Depends(get_db)):
+async def post_user(request: UserCreateSchema, db: AsyncSession = Depends(get_db)):
     """
     Handle POST request to create a new user.
 
@@ -34,48 +159,150 @@ def post_user(request: UserCreateSchema, db: Session = Depends(get_db)):
     Returns:
         None
     """
-    user = models.User(name=request.name, orders=request.orders)
+    user = models.User(name=request.name)
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.flush()
+    db.add_all(
+        models.UserOrder(user_id=user.id, order_id=order_id)
+        for order_id in set(request.orders)
+    )
+    await db.commit()
     return {"id": user.id}
 
 
+@app.post("/users/bulk")
+async def post_users_bulk(
+    request: UserBulkCreateSchema, db: AsyncSession = Depends(get_db)
+):
+    """
+    Handle POST request to create many users in one transaction.
+
+    Args:
+        request: UserBulkCreateSchema object containing the users.
+        db: Database session dependency.
+
+    Returns:
+        dict: The new user IDs, in the order of the request.
+    """
+    return {"ids": await create_users(db, request.users)}
+
+
+@app.post("/users/getlist", response_model=list[UserSchema])
+async def get_users_by_ids(request: UserRequireSchema, reads=Depends(get_reads)):
+    """
+    Handle POST request to retrieve a list of users by their IDs.
+
+    The users and their order IDs are read with one query each. Concurrent
+    requests for the same IDs, in any order, share those queries.
+
+    Args:
+        request: UserRequireSchema object containing the user IDs.
+        reads: Single-flight layer dependency.
+
+    Returns:
+        list[UserSchema]: The users, in the order of the requested IDs.
+
+    Raises:
+        HTTPException: If any user is not found, returns a 404 error.
+    """
+    ids = list(dict.fromkeys(request.ids))
+    key = tuple(sorted(ids))
+    users = await reads.do("users", key, lambda: read_users(ids))
+
+    if not users:
+        raise HTTPException(status_code=404, detail="No users found for the given IDs")
+
+    missing_ids = set(ids) - set(users)
+    if missing_ids:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Users not found for the following IDs: {missing_ids}",
+        )
+    return adapter_response(USER_LIST_ADAPTER, [users[user_id] for user_id in ids])
+
+
 @app.get("/user/{user_id}", response_model=UserSchema)
-def get_user_by_id(user_id: int, db: Session = Depends(get_db)):
+async def get_user_by_id(
+    user_id: int,
+    response: Response,
+    if_none_match: str = Header(None),
+    reads=Depends(get_reads),
+):
     """
     Handle GET request to retrieve a user by their ID.
 
+    The response carries the user's ETag. With If-None-Match, only the user's
+    version is read, and a 304 is returned if the client's copy is current.
+    Concurrent requests for the same user share one read.
+
     Args:
         user_id: The ID of the user to retrieve.
-        db: Database session dependency.
+        response: The response, to set the ETag header on.
+        if_none_match: The ETags of the client's copies, if any.
+        reads: Single-flight layer dependency.
 
     Returns:
-        UserSchema: A schema representation of the user.
+        UserSchema: A schema representation of the user, or an empty 304.
 
     Raises:
         HTTPException: If the user is not found, returns a 404 error.
     """
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    if if_none_match:
+        etag = await current_etag(user_id)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+    user = await reads.do("user", user_id, lambda: read_user(user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
+    response.headers["ETag"] = user["etag"]
     return user
 
 
+@app.get("/user/{user_id}/orders", response_model=UserOrderPageSchema)
+async def get_user_orders(
+    user_id: int,
+    after: int = None,
+    limit: int = Query(100, gt=0, le=1000),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Handle GET request to read one page of a user's order IDs.
+
+    Args:
+        user_id: The ID of the user.
+        after: Only return order IDs greater than this one (the previous page's next_after).
+        limit: Maximum number of order IDs in the page.
+        db: Database session dependency.
+
+    Returns:
+        UserOrderPageSchema: The order IDs and the cursor for the next page.
+
+    Raises:
+        HTTPException: If the user is not found, returns a 404 error.
+    """
+    if not await db.get(models.User, user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    orders = await get_order_ids(db, user_id, after=after, limit=limit + 1)
+    next_after = orders[limit - 1] if len(orders) > limit else None
+    return {"orders": orders[:limit], "next_after": next_after}
+
+
 @app.put("/user/{user_id}", response_model=UserSchema)
-def user_update_from_order(
-    user_id: int, request: UserOrderUpdateSchema, db: Session = Depends(get_db)
+async def user_update_from_order(
+    user_id: int, request: UserOrderUpdateSchema, db: AsyncSession = Depends(get_db)
 ):
     """
     Update a user's orders by adding a new order ID.
 
-    This endpoint allows updating the user's orders by appending a new order ID
-    to the user's existing list of orders. If the user is not found, a 404 error is returned.
+    This endpoint records a new order ID for the user with a single-row insert
+    and bumps the user's version, which changes their ETag. Recording the same
+    order again is a no-op. If the user is not found, a 404 error is returned.
 
     Args:
     - user_id (int): The ID of the user to update.
     - request (UserOrderUpdateSchema): The request body containing the order ID to be added.
-    - db (Session): The database session dependency.
+    - db (AsyncSession): The database session dependency.
 
     Returns:
     - UserSchema: The updated user object with the new order appended.
@@ -84,10 +311,24 @@ def user_update_from_order(
     - HTTPException: If the user is not found, a 404 error is raised.
     """
 
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    user.orders = func.array_append(user.orders, request.order_id)
-    db.commit()
-    db.refresh(user)
-    return user
+    inserted = await db.execute(
+        insert(models.UserOrder)
+        .values(user_id=user_id, order_id=request.order_id)
+        .on_conflict_do_nothing()
+        .returning(models.UserOrder.order_id)
+    )
+    if inserted.first():
+        # Incremented in SQL, so concurrent orders never share a version.
+        version = await db.scalar(
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(version=models.User.version + 1)
+            .returning(models.User.version)
+            .execution_options(synchronize_session=False)
+        )
+        set_committed_value(user, "version", version)
+    await db.commit()
+    return await load_user(db, user_id)
@@ -0,0 +1,50 @@
+# migrations.py
+"""
+This module lists the schema migrations of the user service, applied in
+order by migrate.py. Add new changes as a new version at the end; never edit
+a migration that has been released, as databases that already have it will
+not run it again.
+"""
+
+SERVICE = "user"
+
+# (version, description, SQL statements run in one transaction)
+MIGRATIONS = (
+    (
+        1,
+        "create users",
+        (
+            "CREATE TABLE IF NOT EXISTS users ("
+            "id SERIAL PRIMARY KEY, "
+            "name VARCHAR NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS ix_users_id ON users (id)",
+        ),
+    ),
+    (
+        2,
+        "move order history from users.orders to user_orders",
+        (
+            "CREATE TABLE IF NOT EXISTS user_orders ("
+            "user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE, "
+            "order_id INTEGER NOT NULL, "
+            "PRIMARY KEY (user_id, order_id))",
+            # Databases from before user_orders keep the IDs in an array column
+            "DO $$ BEGIN "
+            "IF EXISTS (SELECT 1 FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = 'users' "
+            "AND column_name = 'orders') THEN "
+            "INSERT INTO user_orders (user_id, order_id) "
+            "SELECT id, unnest(orders) FROM users ON CONFLICT DO NOTHING; "
+            "ALTER TABLE users DROP COLUMN orders; "
+            "END IF; END $$",
+        ),
+    ),
+    (
+        3,
+        "version users for conditional reads",
+        (
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS "
+            "version INTEGER NOT NULL DEFAULT 1",
+        ),
+    ),
+)
@@ -2,9 +2,10 @@
 # pylint: disable=R0903
 """
 This module contains the SQLAlchemy models for the application. 
-It defines the 'User' model with basic attributes like 'id', 'name', and 'orders'.
+It defines the 'User' model with basic attributes like 'id' and 'name',
+and the 'UserOrder' model linking a user to each of their orders.
 """
-from sqlalchemy import Column, Integer, String, ARRAY
+from sqlalchemy import Column, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -16,14 +17,39 @@ class User(Base):
     Attributes:
         id (int): Primary key for the user.
         name (str): Name of the user.
-        orders (list): A list of integer values representing the user's orders.
+        version (int): Bumped on every write to the user or their orders,
+            for the user's ETag.
     """
 
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
-    orders = Column(ARRAY(Integer), nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
     def __repr__(self):
         # A string representation of the User object
-        return f"<User(name={self.name}, orders={self.orders})>"
+        return f"<User(name={self.name})>"
+
+
+class UserOrder(Base):
+    """
+    UserOrder model recording that an order belongs to a user.
+
+    One row per order, so adding an order is a single-row insert instead of
+    rewriting the user's whole order list. The (user_id, order_id) primary key
+    is the index used to read a user's orders in order.
+
+    Attributes:
+        user_id (int): ID of the user who placed the order.
+        order_id (int): ID of the order.
+    """
+
+    __tablename__ = "user_orders"
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    order_id = Column(Integer, primary_key=True)
+
+    def __repr__(self):
+        # A string representation of the UserOrder object
+        return f"<UserOrder(user_id={self.user_id}, order_id={self.order_id})>"
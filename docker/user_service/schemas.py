@@ -3,11 +3,12 @@
 """
 This module contains the Pydantic schemas for validating and --
 serializing the request and response data.
-It defines two schemas: UserCreateSchema for creating users and --
-UserSchema for representing user data.
+It defines UserCreateSchema for creating users, UserSchema for representing
+user data, UserOrderPageSchema for paginated order history and the schemas
+for the bulk create and multi-get endpoints.
 """
-from typing import List
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter
 
 
 class UserCreateSchema(BaseModel):
@@ -37,16 +38,8 @@ class UserSchema(BaseModel):
     name: str
     orders: List[int]
 
-    class Config:
-        """
-        Configuration for the UserSchema.
-
-        orm_mode = True tells Pydantic to treat the data as ORM models, --
-        allowing automatic conversion
-        from SQLAlchemy model instances to Pydantic models.
-        """
-
-        orm_mode = True
+    # Lets the schema be built from SQLAlchemy model instances
+    model_config = ConfigDict(from_attributes=True)
 
 
 class UserOrderUpdateSchema(BaseModel):
@@ -59,3 +52,43 @@ class UserOrderUpdateSchema(BaseModel):
     """
 
     order_id: int
+
+
+class UserOrderPageSchema(BaseModel):
+    """
+    Schema for one page of a user's order history.
+
+    Attributes:
+        orders (List[int]): Order IDs in ascending order.
+        next_after (Optional[int]): Pass as `after` to read the next page,
+            or None if this is the last page.
+    """
+
+    orders: List[int]
+    next_after: Optional[int] = None
+
+
+class UserBulkCreateSchema(BaseModel):
+    """
+    Schema for creating many users in one request.
+
+    Attributes:
+        users (List[UserCreateSchema]): The users to create, at most 10000.
+    """
+
+    users: List[UserCreateSchema] = Field(min_length=1, max_length=10000)
+
+
+class UserRequireSchema(BaseModel):
+    """
+    Schema for retrieving many users in one request.
+
+    Attributes:
+        ids (List[int]): The IDs of the users to retrieve.
+    """
+
+    ids: List[int]
+
+
+# Built once at import and used by the list routes, see serialization.py
+USER_LIST_ADAPTER = TypeAdapter(List[UserSchema])
@@ -0,0 +1,77 @@
+# serialization.py
+"""
+This module contains the JSON response helpers shared by the routes.
+List responses are validated and dumped to JSON bytes by pydantic-core in one
+pass through a TypeAdapter built once at import, instead of FastAPI checking
+every ORM object against the response model and encoding the result again
+with the json module. Other responses use ORJSONResponse when the optional
+orjson package is installed. Conditional reads compare ETags with etag_matches
+and answer with not_modified.
+"""
+
+import os
+from fastapi import Response
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import TypeAdapter
+
+ORJSON_ENABLED = os.getenv("ORJSON_ENABLED", "true").lower() == "true"
+
+
+def orjson_available() -> bool:
+    """Return True if the optional orjson package is installed."""
+    try:
+        import orjson  # pylint: disable=C0415,W0611
+    except ImportError:
+        return False
+    return True
+
+
+def default_response_class() -> type:
+    """Return the response class for routes returning plain Python data."""
+    if ORJSON_ENABLED and orjson_available():
+        return ORJSONResponse
+    return JSONResponse
+
+
+def adapter_response(adapter: TypeAdapter, value, **dump_options) -> Response:
+    """
+    Serializes a response value with a prebuilt TypeAdapter.
+
+    Args:
+        adapter (TypeAdapter): The adapter for the route's response model.
+        value: ORM objects, dicts or models matching the response model.
+        **dump_options: Options for TypeAdapter.dump_json, e.g. exclude_unset.
+
+    Returns:
+        Response: The JSON response.
+    """
+    body = adapter.dump_json(
+        adapter.validate_python(value, from_attributes=True), **dump_options
+    )
+    return Response(content=body, media_type="application/json")
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against the current ETag of a resource.
+
+    The comparison is weak, as RFC 9110 requires for If-None-Match, so a
+    W/ prefix sent back by a client still matches.
+
+    Args:
+        if_none_match (str): The header value, e.g. '"1.0", "2.0"' or '*'.
+        etag (str): The quoted ETag of the resource, None if it does not exist.
+
+    Returns:
+        bool: True if the client's copy is current.
+    """
+    if not if_none_match or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    """Return an empty 304 response carrying the ETag."""
+    return Response(status_code=304, headers={"ETag": etag})
@@ -4,13 +4,31 @@ This module contains tests for the FastAPI user service,
 including testing the main endpoint, creating a user, and reading user details.
 """
 
+import asyncio
+import httpx
+import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import inspect
+import main
+import migrate
+import models
+from database import get_engine
 from main import app
 
-client = TestClient(app)
 
+@pytest.fixture(name="client", scope="module")
+def fixture_client():
+    """
+    Provide a test client that runs the app's lifespan once for the module,
+    so every request shares one event loop and one async connection pool.
+    The schema is migrated first, as the app no longer creates it.
+    """
+    migrate.migrate(get_engine())
+    with TestClient(app) as test_client:
+        yield test_client
 
-def test_read_main():
+
+def test_read_main(client):
     """
     Test the root endpoint ("/").
     Ensures the main endpoint returns a 200 status code
@@ -21,7 +39,40 @@ def test_read_main():
     assert response.json() == {"msg": "User service"}
 
 
-def test_create_user():
+def test_healthz_readyz(client, monkeypatch):
+    """
+    Test the health endpoints ("/healthz", "/readyz").
+    Ensures readiness reports the schema version and fails while the
+    database is behind the migrations the code needs.
+    """
+    assert client.get("/healthz").json() == {"status": "ok"}
+    response = client.get("/readyz")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ready", "schema_version": migrate.HEAD}
+
+    monkeypatch.setattr(main, "HEAD", migrate.HEAD + 1)
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unmigrated"
+
+
+def test_migrations_match_models():
+    """
+    Test that the migrations create the tables, columns and indexes the models
+    describe, and that running them again applies nothing.
+    """
+    engine = get_engine()
+    migrate.migrate(engine)
+    assert not migrate.migrate(engine)
+    inspector = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        assert columns == {column.name for column in table.columns}
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= indexes
+
+
+def test_create_user(client):
     """
     Test the user creation endpoint ("/user").
     Ensures that a user can be created with valid data
@@ -34,7 +85,7 @@ def test_create_user():
     assert response.status_code == 200
 
 
-def test_read_user():
+def test_read_user(client):
     """
     Test the read user endpoint ("/user/{id}").
     Ensures that user details can be retrieved using a valid user ID.
@@ -42,3 +93,155 @@ def test_read_user():
     response = client.get("/user/1")
     assert response.status_code == 200
     assert response.json() == {"id": 1, "name": "Test User", "orders": []}
+
+
+def test_update_user_orders(client):
+    """
+    Test recording orders for a user ("/user/{id}" PUT).
+    Ensures orders are appended once, even if the same order is sent twice.
+    """
+    for order_id in (3, 1, 3):
+        response = client.put("/user/1", json={"order_id": order_id})
+        assert response.status_code == 200
+    assert response.json() == {"id": 1, "name": "Test User", "orders": [1, 3]}
+    assert client.put("/user/999", json={"order_id": 1}).status_code == 404
+
+
+def test_read_user_orders_paginated(client):
+    """
+    Test the paginated order history endpoint ("/user/{id}/orders").
+    Ensures following next_after walks every order exactly once.
+    """
+    user_id = client.post(
+        "/user", json={"name": "Busy User", "orders": list(range(1, 6))}
+    ).json()["id"]
+    pages, after = [], None
+    while True:
+        params = {"limit": 2} if after is None else {"limit": 2, "after": after}
+        page = client.get(f"/user/{user_id}/orders", params=params).json()
+        pages.append(page["orders"])
+        after = page["next_after"]
+        if after is None:
+            break
+    assert pages == [[1, 2], [3, 4], [5]]
+    assert client.get("/user/999/orders").status_code == 404
+
+
+def test_db_pool_status(client):
+    """
+    Test the connection pool status endpoint ("/db/pool").
+    Ensures pool occupancy and checkout wait statistics are reported.
+    """
+    response = client.get("/db/pool")
+    assert response.status_code == 200
+    status = response.json()
+    assert status["pool_size"] >= 1
+    assert status["checkout_wait_seconds_max"] >= 0
+
+
+def test_metrics_endpoint(client):
+    """
+    Test the metrics endpoint ("/metrics").
+    Ensures requests are labelled by route template and that database time
+    and pool occupancy are reported.
+    """
+    client.get("/user/1")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert (
+        'http_requests_total{method="GET",route="/user/{user_id}",status="200"}' in body
+    )
+    assert 'http_request_db_seconds_count{method="GET",route="/user/{user_id}"}' in body
+    assert "db_query_duration_seconds_count" in body
+    assert "db_pool_checked_out" in body
+
+
+def test_create_users_bulk(client):
+    """
+    Test the bulk user creation endpoint ("/users/bulk").
+    Ensures users are created in order with their orders and the IDs are returned.
+    """
+    response = client.post(
+        "/users/bulk",
+        json={"users": [{"name": "Bulk A", "orders": [5, 4]}, {"name": "Bulk B"}]},
+    )
+    assert response.status_code == 200
+    first, second = response.json()["ids"]
+    assert second == first + 1
+    assert client.get(f"/user/{first}").json() == {
+        "id": first,
+        "name": "Bulk A",
+        "orders": [4, 5],
+    }
+    assert client.post("/users/bulk", json={"users": []}).status_code == 422
+
+
+def test_get_users_by_ids(client):
+    """
+    Test the multi-get endpoint ("/users/getlist").
+    Ensures users come back in request order and missing IDs return a 404.
+    """
+    response = client.post("/users/getlist", json={"ids": [2, 1, 2]})
+    assert response.status_code == 200
+    assert [user["id"] for user in response.json()] == [2, 1]
+    assert response.json()[1]["orders"] == [1, 3]
+
+    response = client.post("/users/getlist", json={"ids": [1, 99999]})
+    assert response.status_code == 404
+
+
+def test_single_flight_reads(client):
+    """
+    Test that concurrent identical reads share one query.
+    Ensures every caller gets the result, and getlist requests for the same
+    IDs in another order count as identical.
+    """
+    reads = app.state.reads
+    calls, coalesced = reads.calls, reads.coalesced
+
+    async def read_concurrently():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://test"
+        ) as http:
+            return await asyncio.gather(
+                *(http.get("/user/1") for _ in range(5)),
+                http.post("/users/getlist", json={"ids": [1, 2]}),
+                http.post("/users/getlist", json={"ids": [2, 1, 2]}),
+            )
+
+    responses = client.portal.call(read_concurrently)
+    assert [response.json()["id"] for response in responses[:5]] == [1] * 5
+    assert [user["id"] for user in responses[6].json()] == [2, 1]
+    assert reads.calls == calls + 2
+    assert reads.coalesced == coalesced + 5
+    assert 'single_flight_coalesced_total{read="user"}' in client.get("/metrics").text
+
+
+def test_conditional_user_reads(client):
+    """
+    Test that GET /user/{id} answers If-None-Match with 304 while the user is
+    unchanged, and that a new order changes the ETag.
+    """
+    response = client.get("/user/1")
+    etag = response.headers["etag"]
+    assert "etag" not in response.json()
+
+    response = client.get("/user/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+    assert (
+        client.get("/user/1", headers={"If-None-Match": f"W/{etag}"}).status_code == 304
+    )
+
+    client.put("/user/1", json={"order_id": 1000})
+    response = client.get("/user/1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert 1000 in response.json()["orders"]
+    assert response.headers["etag"] != etag
+
+    etag = response.headers["etag"]
+    client.put("/user/1", json={"order_id": 1000})
+    assert client.get("/user/1", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/user/9999", headers={"If-None-Match": "*"}).status_code == 404
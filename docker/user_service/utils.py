@@ -0,0 +1,151 @@
+# utils.py
+"""
+This module contains helper functions shared by the user APIs,
+such as loading users together with their order IDs, creating users in bulk
+and building the ETags of users.
+"""
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+import models
+
+
+def user_etag(version: int) -> str:
+    """
+    Builds the strong ETag of a user from their version.
+
+    Args:
+        version (int): The version of the user.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    return f'"{version}"'
+
+
+async def read_user_etag(db: AsyncSession, user_id: int):
+    """
+    Reads the ETag of a user, without reading their orders.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The ID of the user.
+
+    Returns:
+        str: The ETag, or None if the user does not exist.
+    """
+    version = await db.scalar(
+        select(models.User.version).where(models.User.id == user_id)
+    )
+    return None if version is None else user_etag(version)
+
+
+async def get_order_ids(
+    db: AsyncSession, user_id: int, after: int = None, limit: int = None
+):
+    """
+    Reads a user's order IDs in ascending order from the user_orders index.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The ID of the user.
+        after (int): Only return order IDs greater than this one.
+        limit (int): Maximum number of order IDs to return.
+
+    Returns:
+        list: The order IDs.
+    """
+    query = (
+        select(models.UserOrder.order_id)
+        .where(models.UserOrder.user_id == user_id)
+        .order_by(models.UserOrder.order_id)
+    )
+    if after is not None:
+        query = query.where(models.UserOrder.order_id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    result = await db.execute(query)
+    return result.scalars().all()
+
+
+async def load_user(db: AsyncSession, user_id: int):
+    """
+    Loads a user with all of their order IDs.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_id (int): The ID of the user.
+
+    Returns:
+        dict: The user in UserSchema shape plus their ETag, which the response
+        model leaves out of the body, or None if the user does not exist.
+    """
+    user = await db.get(models.User, user_id)
+    if not user:
+        return None
+    return {
+        "id": user.id,
+        "name": user.name,
+        "orders": await get_order_ids(db, user_id),
+        "etag": user_etag(user.version),
+    }
+
+
+async def load_users(db: AsyncSession, user_ids):
+    """
+    Loads many users with all of their order IDs in two queries.
+
+    Args:
+        db (AsyncSession): The database session.
+        user_ids (list): The IDs of the users.
+
+    Returns:
+        dict: The users in UserSchema shape, keyed by ID; missing users are left out.
+    """
+    result = await db.execute(select(models.User).where(models.User.id.in_(user_ids)))
+    users = {
+        user.id: {"id": user.id, "name": user.name, "orders": []}
+        for user in result.scalars()
+    }
+    if users:
+        result = await db.execute(
+            select(models.UserOrder.user_id, models.UserOrder.order_id)
+            .where(models.UserOrder.user_id.in_(list(users)))
+            .order_by(models.UserOrder.user_id, models.UserOrder.order_id)
+        )
+        for user_id, order_id in result:
+            users[user_id]["orders"].append(order_id)
+    return users
+
+
+async def create_users(db: AsyncSession, users):
+    """
+    Creates many users and their order IDs in one transaction.
+
+    IDs are taken from the users sequence up front, so the rows can be written
+    with executemany, one statement per table, and the IDs returned in order.
+
+    Args:
+        db (AsyncSession): The database session.
+        users (list): The UserCreateSchema objects to create.
+
+    Returns:
+        list: The new user IDs, in the order of the users.
+    """
+    sequence = func.pg_get_serial_sequence(models.User.__tablename__, "id")
+    result = await db.execute(
+        select(func.nextval(sequence)).select_from(func.generate_series(1, len(users)))
+    )
+    user_ids = result.scalars().all()
+    await db.execute(
+        insert(models.User),
+        [{"id": user_id, "name": user.name} for user_id, user in zip(user_ids, users)],
+    )
+    orders = [
+        {"user_id": user_id, "order_id": order_id}
+        for user_id, user in zip(user_ids, users)
+        for order_id in set(user.orders)
+    ]
+    if orders:
+        await db.execute(insert(models.UserOrder), orders)
+    await db.commit()
+    return user_ids